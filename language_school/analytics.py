@@ -0,0 +1,164 @@
+import numpy as np
+
+# ==================== موتور تحلیل درآمد و ظرفیت ====================
+# داده‌ها یک‌باره و به صورت ستونی (آرایه‌های numpy) خوانده می‌شوند و همه
+# محاسبات با عملیات برداری (bincount / unique / searchsorted) انجام می‌شود.
+
+GROUP_KEYS = {
+    'course': ('course_id', 'course_title'),
+    'professor': ('professor_id', 'professor_name'),
+    'level': ('course_level', 'course_level')
+}
+
+def _columns(cursor, names):
+    """تبدیل نتیجه کوئری به دیکشنری از آرایه‌های ستونی"""
+    rows = cursor.fetchall()
+    if not rows:
+        return {name: np.array([]) for name in names}
+    return {name: np.array(column) for name, column in zip(names, zip(*rows))}
+
+def fetch_analytics_data(conn):
+    """دریافت ستونی کلاس‌ها و ثبت‌نام‌ها (به همراه پرداخت) با دو کوئری"""
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT cl.class_id, cl.course_id, c.course_title, COALESCE(c.course_level, 'نامشخص'),
+               cl.professor_id, p.first_name || ' ' || p.last_name,
+               COALESCE(cl.capacity, 0), cl.start_date
+        FROM classes cl
+        JOIN courses c ON cl.course_id = c.course_id
+        JOIN professors p ON cl.professor_id = p.professor_id
+        ORDER BY cl.class_id
+    ''')
+    classes = _columns(cursor, ['class_id', 'course_id', 'course_title', 'course_level',
+                                'professor_id', 'professor_name', 'capacity', 'start_date'])
+
+    cursor.execute('''
+        SELECT r.class_id, COALESCE(py.amount, 0)::float8,
+               COALESCE(py.payment_status = %s, FALSE),
+               COALESCE(py.payment_status = %s, FALSE)
+        FROM registrations r
+        LEFT JOIN payments py ON r.payment_id = py.payment_id
+    ''', ('تکمیل', 'انتظار'))
+    registrations = _columns(cursor, ['class_id', 'amount', 'is_completed', 'is_pending'])
+
+    cursor.close()
+    return classes, registrations
+
+def compute_class_metrics(classes, registrations):
+    """محاسبه تعداد ثبت‌نام و درآمد هر کلاس به صورت برداری"""
+    class_ids = classes['class_id'].astype(np.int64)
+    n = len(class_ids)
+
+    reg_class = registrations['class_id'].astype(np.int64)
+    idx = np.searchsorted(class_ids, reg_class)
+    if n:
+        valid = (idx < n) & (class_ids[np.minimum(idx, n - 1)] == reg_class)
+    else:
+        valid = np.zeros(len(reg_class), dtype=bool)
+    idx = idx[valid]
+    amount = registrations['amount'].astype(np.float64)[valid]
+    completed = registrations['is_completed'].astype(bool)[valid]
+    pending = registrations['is_pending'].astype(bool)[valid]
+
+    return {
+        'capacity': classes['capacity'].astype(np.float64),
+        'registered': np.bincount(idx, minlength=n).astype(np.float64),
+        'revenue_completed': np.bincount(idx, weights=amount * completed, minlength=n),
+        'revenue_pending': np.bincount(idx, weights=amount * pending, minlength=n)
+    }
+
+def _ratio(numerator, denominator):
+    """تقسیم برداری با صفر برای مخرج صفر"""
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator, dtype=np.float64),
+                     where=denominator > 0)
+
+def group_metrics(classes, metrics, group_by):
+    """تجمیع شاخص‌ها به تفکیک دوره، استاد یا سطح"""
+    key_column, label_column = GROUP_KEYS[group_by]
+    if len(classes[key_column]) == 0:
+        return []
+
+    keys, first_index, inverse = np.unique(classes[key_column], return_index=True, return_inverse=True)
+    labels = classes[label_column][first_index]
+    size = len(keys)
+
+    totals = {name: np.bincount(inverse, weights=values, minlength=size) for name, values in metrics.items()}
+    class_count = np.bincount(inverse, minlength=size)
+    fill_rate = _ratio(totals['registered'], totals['capacity'])
+    collection = _ratio(totals['revenue_completed'], totals['revenue_completed'] + totals['revenue_pending'])
+
+    order = np.argsort(-totals['revenue_completed'], kind='stable')
+    return [{
+        'key': keys[i].item() if hasattr(keys[i], 'item') else keys[i],
+        'label': labels[i],
+        'class_count': int(class_count[i]),
+        'capacity': int(totals['capacity'][i]),
+        'registered': int(totals['registered'][i]),
+        'fill_rate': float(fill_rate[i]),
+        'revenue': float(totals['revenue_completed'][i]),
+        'pending': float(totals['revenue_pending'][i]),
+        'collection_ratio': float(collection[i])
+    } for i in order]
+
+def term_trends(classes, metrics):
+    """روند ترم به ترم (فصلی بر اساس تاریخ شروع کلاس) و درصد تغییر نسبت به ترم قبل"""
+    start = classes['start_date']
+    has_date = np.array([d is not None for d in start], dtype=bool)
+    if not has_date.any():
+        return []
+
+    dates = start[has_date].astype('datetime64[D]')
+    months = dates.astype('datetime64[M]').astype(np.int64)
+    term_index = months // 3
+
+    terms, inverse = np.unique(term_index, return_inverse=True)
+    size = len(terms)
+    totals = {name: np.bincount(inverse, weights=values[has_date], minlength=size)
+              for name, values in metrics.items()}
+    fill_rate = _ratio(totals['registered'], totals['capacity'])
+    collection = _ratio(totals['revenue_completed'], totals['revenue_completed'] + totals['revenue_pending'])
+
+    previous = np.concatenate(([0.0], totals['revenue_completed'][:-1]))
+    revenue_change = _ratio(totals['revenue_completed'] - previous, previous)
+    previous = np.concatenate(([0.0], totals['registered'][:-1]))
+    registered_change = _ratio(totals['registered'] - previous, previous)
+
+    years = terms // 4 + 1970
+    quarters = terms % 4 + 1
+    return [{
+        'term': f'{years[i]}-Q{quarters[i]}',
+        'registered': int(totals['registered'][i]),
+        'capacity': int(totals['capacity'][i]),
+        'fill_rate': float(fill_rate[i]),
+        'revenue': float(totals['revenue_completed'][i]),
+        'collection_ratio': float(collection[i]),
+        'revenue_change': float(revenue_change[i]) if i else None,
+        'registered_change': float(registered_change[i]) if i else None
+    } for i in range(size)]
+
+def build_analytics_report(conn):
+    """گزارش کامل تحلیلی: به تفکیک دوره، استاد، سطح و روند ترم‌ها"""
+    classes, registrations = fetch_analytics_data(conn)
+    metrics = compute_class_metrics(classes, registrations)
+
+    total_completed = float(metrics['revenue_completed'].sum())
+    total_pending = float(metrics['revenue_pending'].sum())
+
+    return {
+        'summary': {
+            'class_count': int(len(classes['class_id'])),
+            'registered': int(metrics['registered'].sum()),
+            'capacity': int(metrics['capacity'].sum()),
+            'fill_rate': float(_ratio(metrics['registered'].sum(keepdims=True),
+                                      metrics['capacity'].sum(keepdims=True))[0]),
+            'revenue': total_completed,
+            'pending': total_pending,
+            'collection_ratio': total_completed / (total_completed + total_pending)
+                                if total_completed + total_pending else 0.0
+        },
+        'by_course': group_metrics(classes, metrics, 'course'),
+        'by_professor': group_metrics(classes, metrics, 'professor'),
+        'by_level': group_metrics(classes, metrics, 'level'),
+        'terms': term_trends(classes, metrics)
+    }
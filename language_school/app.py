@@ -1,14 +1,108 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash, Response, stream_with_context
 from database_queries import *
 import os
-from datetime import date
+import json
+import time
+from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
 from auth import login_required, check_credentials, logout_user
+from audit import audit_log
+from idempotency import idempotent, new_idempotency_key, mark_idempotent_success
+from analytics import build_analytics_report
+from payroll import build_payroll, payroll_csv
+from realtime import (
+    availability_broadcaster, dashboard_broadcaster, acquire_stream_slot, release_stream_slot, SSE_RETRY_SECONDS
+)
+from page_data import load_page_data
+from scheduling import check_class_conflicts, describe_conflict, get_timetable, format_minutes, TIMETABLE_GROUPS
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY')
+app.add_template_global(new_idempotency_key)
+
+# ==================== مسیریابی خواندن / نوشتن ====================
+# پس از هر درخواست تغییردهنده، خواندن‌های همان کاربر تا این مدت از primary انجام
+# می‌شود تا تغییرات خودش را (حتی با تأخیر replica) ببیند
+READ_YOUR_WRITES_SECONDS = int(os.getenv('READ_YOUR_WRITES_SECONDS', '10'))
+
+def use_replica():
+    """آیا خواندن‌های این کاربر می‌توانند از replica انجام شوند"""
+    return session.get('primary_until', 0) <= time.time()
+
+def get_read_connection():
+    """اتصال برای صفحات فقط‌خواندنی (replica در صورت تنظیم و عدم نیاز به primary)"""
+    return get_db_connection(readonly=use_replica())
+
+# ==================== شعبه جاری ====================
+# نسخه‌ای که فقط برای یک شعبه اجرا می‌شود با BRANCH_ID ثابت می‌شود؛ در غیر این
+# صورت کاربر شعبه را از صفحه اصلی انتخاب می‌کند و «همه شعبه‌ها» یعنی نمای ستاد.
+BRANCH_ID = int(os.getenv('BRANCH_ID')) if os.getenv('BRANCH_ID') else None
+
+def current_branch():
+    """شناسه شعبه جاری (None برای همه شعبه‌ها)"""
+    return BRANCH_ID or session.get('branch_id')
+
+def audit(entity, action, entity_id=None, before=None, after=None):
+    """ثبت یک تغییر در گزارش تغییرات (پس از commit؛ نوشتن در پس‌زمینه انجام می‌شود)"""
+    audit_log.record(entity, action, entity_id, before, after,
+                     actor=session.get('username'), remote_addr=request.remote_addr)
+
+# ==================== تعارض ویرایش هم‌زمان ====================
+# فرم‌های ویرایش نسخه رکورد (row_version) را در فیلد مخفی برمی‌گردانند؛ اگر رکورد
+# پس از باز شدن فرم تغییر کرده باشد تغییرات ذخیره نمی‌شود، تفاوت مقادیر کاربر با
+# مقادیر فعلی نمایش داده می‌شود و فرم با مقادیر جدید دوباره باز می‌شود.
+FIELD_LABELS = {
+    'first_name': 'نام', 'last_name': 'نام خانوادگی', 'specialty': 'تخصص',
+    'phone_number': 'شماره تلفن', 'email': 'ایمیل', 'salary': 'حقوق', 'session_count': 'تعداد جلسات',
+    'national_id': 'کد ملی', 'birth_date': 'تاریخ تولد', 'province': 'استان', 'city': 'شهر',
+    'street': 'خیابان', 'plaque': 'پلاک',
+    'course_title': 'عنوان دوره', 'course_level': 'سطح دوره', 'course_status': 'وضعیت دوره',
+    'course_capacity': 'ظرفیت دوره', 'level_id': 'سطح‌بندی', 'description': 'توضیحات',
+    'prerequisites': 'پیش‌نیازها', 'tuition_fee': 'شهریه',
+    'course_id': 'دوره', 'professor_id': 'استاد', 'capacity': 'ظرفیت', 'start_date': 'تاریخ شروع',
+    'end_date': 'تاریخ پایان', 'class_time': 'ساعت کلاس', 'class_days': 'روزهای کلاس', 'classroom': 'کلاس درس',
+    'membership_id': 'دانش‌آموز', 'class_id': 'کلاس', 'amount': 'مبلغ پرداخت',
+    'payment_method': 'روش پرداخت', 'payment_status': 'وضعیت پرداخت',
+}
+
+def form_row_version():
+    """نسخه رکورد ارسال‌شده با فرم ویرایش (None برای فرم بدون نسخه)"""
+    return request.form.get('row_version', type=int)
+
+def _same_value(current, submitted):
+    current = '' if current is None else current
+    submitted = '' if submitted is None else submitted
+    if str(current) == str(submitted):
+        return True
+    try:
+        return float(current) == float(submitted)
+    except (TypeError, ValueError):
+        return False
+
+def flash_version_conflict(conn, entity, entity_id, submitted):
+    """نمایش تفاوت مقادیر فرم با مقادیر فعلی رکوردی که هم‌زمان تغییر کرده است"""
+    current = get_audit_image(conn, entity, entity_id, current_branch())
+    if current is None:
+        flash('این رکورد در این فاصله توسط کاربر دیگری حذف شده است.', 'danger')
+        return
+    # پرداخت ثبت‌نام در تصویر آن به صورت تو در تو ذخیره شده است
+    current = dict(current, **(current.get('payment') or {}))
+    flash('این رکورد هم‌زمان توسط کاربر دیگری ویرایش شده و تغییرات شما ذخیره نشد؛ '
+          'فرم با مقادیر جدید بارگذاری شد. مقادیری که وارد کرده بودید:', 'warning')
+    for field, value in submitted.items():
+        if field in current and not _same_value(current[field], value):
+            current_value = '' if current[field] is None else current[field]
+            flash(f'{FIELD_LABELS.get(field, field)}: «{value}» (مقدار فعلی: «{current_value}»)', 'warning')
+
+@app.after_request
+def mark_recent_write(response):
+    # حذف‌ها با GET انجام می‌شوند و مانند POST درخواست تغییردهنده محسوب می‌شوند
+    is_write = request.method != 'GET' or (request.endpoint or '').startswith('delete_')
+    if is_write and response.status_code < 400 and 'logged_in' in session:
+        session['primary_until'] = time.time() + READ_YOUR_WRITES_SECONDS
+    return response
 
 # ==================== صفحه ورود ====================
 @app.route('/login', methods=['GET', 'POST'])
@@ -49,39 +143,115 @@ def logout():
 @login_required
 def index():
     try:
-        conn = get_db_connection()
-        if not conn:
-            return render_template('index.html', stats={}, recent_registrations=[], upcoming_classes=[])
+        # آمار آماده تجمیع‌کننده زنده (فقط برای همه شعبه‌ها) در صورت وجود؛ سایر
+        # پرس‌وجوها همزمان اجرا می‌شوند
+        branch_id = current_branch()
+        stats = dashboard_broadcaster.current() if branch_id is None else None
+        loaders = {
+            'recent_registrations': lambda conn: get_recent_registrations(conn, 5, branch_id),
+            'upcoming_classes': lambda conn: get_upcoming_classes(conn, 5, branch_id),
+            'branches': get_branches,
+        }
+        if not stats:
+            loaders['stats'] = lambda conn: get_dashboard_stats(conn, branch_id)
         
         try:
-            stats = get_dashboard_stats(conn)
-            recent_registrations = get_recent_registrations(conn, 5)
-            upcoming_classes = get_upcoming_classes(conn, 5)
-        except:
+            data = load_page_data(loaders, readonly=use_replica())
+            stats = stats or data['stats']
+            recent_registrations = data['recent_registrations']
+            upcoming_classes = data['upcoming_classes']
+            branches = data['branches']
+        except Exception as e:
+            print(f"خطا در بارگذاری صفحه اصلی: {e}")
             stats = {'professors': 0, 'students': 0, 'courses': 0, 'classes': 0, 'registrations': 0, 'payments': 0}
             recent_registrations = []
             upcoming_classes = []
-        finally:
-            conn.close()
+            branches = []
         
         return render_template('index.html', stats=stats, 
                              recent_registrations=recent_registrations, 
                              upcoming_classes=upcoming_classes,
+                             branches=branches,
+                             current_branch=current_branch(),
+                             branch_fixed=BRANCH_ID is not None,
                              date=date)
     
     except:
         return render_template('index.html', stats={}, recent_registrations=[], upcoming_classes=[])
 
+# ==================== مدیریت شعبه‌ها ====================
+@app.route('/branches/select', methods=['POST'])
+@login_required
+def select_branch():
+    branch_id = request.form.get('branch_id', '').strip()
+    if not branch_id.isdigit():
+        session.pop('branch_id', None)
+        return redirect(request.referrer or '/')
+    
+    conn = get_db_connection()
+    if not conn:
+        flash('خطا در اتصال به پایگاه داده', 'danger')
+        return redirect(request.referrer or '/')
+    try:
+        if branch_exists(conn, int(branch_id)):
+            session['branch_id'] = int(branch_id)
+        else:
+            flash('شعبه انتخاب‌شده وجود ندارد.', 'danger')
+    except Exception as e:
+        print(f"خطا در انتخاب شعبه: {e}")
+        flash('خطا در انتخاب شعبه', 'danger')
+    finally:
+        conn.close()
+    return redirect(request.referrer or '/')
+
+@app.route('/branches', methods=['GET', 'POST'])
+@login_required
+def manage_branches():
+    if request.method == 'POST':
+        branch_name = request.form.get('branch_name', '').strip()
+        if not branch_name:
+            flash('نام شعبه را وارد کنید', 'danger')
+            return redirect('/branches')
+        
+        conn = get_unit_of_work()
+        if not conn:
+            flash('اتصال به دیتابیس برقرار نشد', 'danger')
+            return redirect('/branches')
+        try:
+            add_branch_db(conn, branch_name)
+            conn.commit()
+            flash(f'شعبه «{branch_name}» اضافه شد', 'success')
+        except Exception as e:
+            conn.rollback()
+            print(f"خطا در افزودن شعبه: {e}")
+            flash('خطا در افزودن شعبه', 'danger')
+        finally:
+            conn.close()
+        return redirect('/branches')
+    
+    conn = get_read_connection()
+    if not conn:
+        return render_template('branches.html', branches=[], partitioned=[])
+    try:
+        branches = get_branches(conn)
+        partitioned = get_partitioned_tables(conn)
+    except Exception as e:
+        print(f"خطا در دریافت شعبه‌ها: {e}")
+        branches, partitioned = [], []
+    finally:
+        conn.close()
+    return render_template('branches.html', branches=branches, partitioned=partitioned)
+
 # ==================== مدیریت اساتید ====================
 @app.route('/professors')
 @login_required  
 def list_professors():
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         if not conn:
             return render_template('professors/list.html', professors=[])
         
-        professors = get_professors_list(conn)
+        professors = get_professors_list(conn, current_branch())
         conn.close()
         
         return render_template('professors/list.html', professors=professors)
@@ -98,7 +268,7 @@ def add_professor():
             return render_template('professors/add.html')
         
         # POST method
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             print("خطا: اتصال به دیتابیس برقرار نشد")
             return redirect('/professors/add')
@@ -132,10 +302,16 @@ def add_professor():
                 return redirect('/professors/add')
             
             # اضافه کردن استاد به دیتابیس
-            add_professor_db(conn, first_name, last_name, specialty, phone_number, email, salary, session_count)
+            professor_id = add_professor_db(conn, first_name, last_name, specialty, phone_number, email,
+                                            salary, session_count, branch_id=current_branch())
             print("استاد با موفقیت اضافه شد")
             
             conn.commit()  # اضافه کردن commit برای ذخیره تغییرات
+            audit('professors', 'insert', professor_id, after={
+                'first_name': first_name, 'last_name': last_name, 'specialty': specialty,
+                'phone_number': phone_number, 'email': email, 'salary': salary,
+                'session_count': session_count, 'branch_id': current_branch()
+            })
             return redirect('/professors')
             
         except Exception as e:
@@ -159,7 +335,7 @@ def edit_professor(id):
                 return redirect('/professors')
             
             try:
-                professor = get_professor_by_id(conn, id)
+                professor = get_professor_by_id(conn, id, current_branch())
                 conn.close()
                 
                 if not professor:
@@ -173,7 +349,7 @@ def edit_professor(id):
                 return redirect('/professors')
         
         # POST method
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect(f'/professors/edit/{id}')
         
@@ -196,8 +372,20 @@ def edit_professor(id):
             if check_professor_exists(conn, email, phone_number, exclude_id=id):
                 return redirect(f'/professors/edit/{id}')
             
-            update_professor_db(conn, id, first_name, last_name, specialty, phone_number, email, salary, session_count)
+            after = {
+                'first_name': first_name, 'last_name': last_name, 'specialty': specialty,
+                'phone_number': phone_number, 'email': email, 'salary': salary,
+                'session_count': session_count
+            }
+            before = update_professor_db(conn, id, first_name, last_name, specialty, phone_number, email,
+                                         salary, session_count, row_version=form_row_version(),
+                                         branch_id=current_branch())
+            if before is None:
+                conn.rollback()
+                flash_version_conflict(conn, 'professors', id, after)
+                return redirect(f'/professors/edit/{id}')
             conn.commit()
+            audit('professors', 'update', id, before, after)
             return redirect('/professors')
             
         except Exception as e:
@@ -215,14 +403,15 @@ def edit_professor(id):
 @login_required  
 def delete_professor(id):
     try:
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/professors')
         
         try:
-            success, message = delete_professor_db(conn, id)
+            success, message, before = delete_professor_db(conn, id, current_branch())
             if success:
                 conn.commit()
+                audit('professors', 'delete', id, before)
                 print(f"استاد با شناسه {id} حذف شد")
             else:
                 print(f"خطا در حذف استاد: {message}")
@@ -242,11 +431,11 @@ def delete_professor(id):
 @login_required
 def list_students():
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         if not conn:
             return redirect('/')
         
-        students = get_students_list(conn)
+        students = get_students_list(conn, current_branch())
         conn.close()
         
         return render_template('students/list.html', students=students)
@@ -261,7 +450,7 @@ def add_student():
         if request.method == 'GET':
             return render_template('students/add.html')
         
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/students/add')
         
@@ -276,7 +465,8 @@ def add_student():
                 'province': request.form['province'].strip(),
                 'city': request.form['city'].strip(),
                 'street': request.form['street'].strip(),
-                'plaque': request.form['plaque'].strip()
+                'plaque': request.form['plaque'].strip(),
+                'branch_id': current_branch()
             }
             
             if not data['first_name'] or not data['last_name']:
@@ -285,8 +475,9 @@ def add_student():
             if not data['national_id'].isdigit() or len(data['national_id']) != 10:
                 return redirect('/students/add')
             
-            add_student_db(conn, data)
+            membership_id = add_student_db(conn, data)
             conn.commit()
+            audit('students', 'insert', membership_id, after=data)
             return redirect('/students')
             
         except:
@@ -308,7 +499,7 @@ def edit_student(id):
                 return redirect('/students')
             
             try:
-                student = get_student_by_id(conn, id)
+                student = get_student_by_id(conn, id, current_branch())
                 
                 if not student:
                     conn.close()
@@ -324,7 +515,7 @@ def edit_student(id):
                 conn.close()
                 return redirect('/students')
         
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect(f'/students/edit/{id}')
         
@@ -348,8 +539,14 @@ def edit_student(id):
             if not data['national_id'].isdigit() or len(data['national_id']) != 10:
                 return redirect(f'/students/edit/{id}')
             
-            update_student_db(conn, id, data)
+            before = update_student_db(conn, id, data, row_version=form_row_version(),
+                                       branch_id=current_branch())
+            if before is None:
+                conn.rollback()
+                flash_version_conflict(conn, 'students', id, data)
+                return redirect(f'/students/edit/{id}')
             conn.commit()
+            audit('students', 'update', id, before, data)
             return redirect('/students')
             
         except:
@@ -365,31 +562,24 @@ def edit_student(id):
 @login_required
 def view_student(id):
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         if not conn:
             return redirect('/students')
         
         try:
-            student = get_student_by_id(conn, id)
+            page = request.args.get('page', 1, type=int)
+            summary = get_student_summary(conn, id, page, branch_id=current_branch())
             
-            if not student:
+            if not summary:
                 conn.close()
                 return redirect('/students')
             
-            registrations = get_student_registrations(conn, id)
-            
-            stats = {
-                'total_courses': len(registrations),
-                'completed_courses': len([r for r in registrations if r.get('payment_status') == 'تکمیل']),
-                'pending_courses': len([r for r in registrations if r.get('payment_status') == 'انتظار']),
-                'total_payments': sum([r.get('amount', 0) or 0 for r in registrations])
-            }
-            
             conn.close()
             return render_template('students/view.html', 
-                                 student=student, 
-                                 registrations=registrations,
-                                 stats=stats)
+                                 student=summary['student'], 
+                                 registrations=summary['registrations'],
+                                 stats=summary['stats'],
+                                 pagination=summary['pagination'])
             
         except:
             conn.close()
@@ -402,14 +592,15 @@ def view_student(id):
 @login_required
 def delete_student(id):
     try:
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/students')
         
         try:
-            success, message = delete_student_db(conn, id)
+            success, message, before = delete_student_db(conn, id, current_branch())
             if success:
                 conn.commit()
+                audit('students', 'delete', id, before)
         except:
             pass
         finally:
@@ -425,11 +616,11 @@ def delete_student(id):
 @login_required
 def list_courses():
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         if not conn:
             return redirect('/')
         
-        courses = get_courses_list(conn)
+        courses = get_courses_list(conn, current_branch())
         conn.close()
         
         return render_template('courses/list.html', courses=courses)
@@ -443,7 +634,7 @@ def add_course():
     try:
         if request.method == 'GET':
             try:
-                conn = get_db_connection()
+                conn = get_read_connection()
                 levels = get_levels_for_dropdown(conn)
                 conn.close()
             except:
@@ -451,7 +642,7 @@ def add_course():
             
             return render_template('courses/add.html', levels=levels)
         
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/courses/add')
         
@@ -484,9 +675,11 @@ def add_course():
                     data['level_id'] = None
             else:
                 data['level_id'] = None
+            data['branch_id'] = current_branch()
             
-            add_course_db(conn, data)
+            course_id = add_course_db(conn, data)
             conn.commit()
+            audit('courses', 'insert', course_id, after=data)
             return redirect('/courses')
             
         except:
@@ -508,7 +701,7 @@ def edit_course(id):
                 return redirect('/courses')
             
             try:
-                course = get_course_by_id(conn, id)
+                course = get_course_by_id(conn, id, current_branch())
                 
                 if not course:
                     conn.close()
@@ -522,7 +715,7 @@ def edit_course(id):
                 conn.close()
                 return redirect('/courses')
         
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect(f'/courses/edit/{id}')
         
@@ -569,8 +762,14 @@ def edit_course(id):
             else:
                 data['level_id'] = None
             
-            update_course_db(conn, id, data)
+            before = update_course_db(conn, id, data, row_version=form_row_version(),
+                                      branch_id=current_branch())
+            if before is None:
+                conn.rollback()
+                flash_version_conflict(conn, 'courses', id, data)
+                return redirect(f'/courses/edit/{id}')
             conn.commit()
+            audit('courses', 'update', id, before, data)
             return redirect('/courses')
             
         except:
@@ -586,14 +785,15 @@ def edit_course(id):
 @login_required
 def delete_course(id):
     try:
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/courses')
         
         try:
-            success, message = delete_course_db(conn, id)
+            success, message, before = delete_course_db(conn, id, current_branch())
             if success:
                 conn.commit()
+                audit('courses', 'delete', id, before)
         except:
             pass
         finally:
@@ -609,11 +809,11 @@ def delete_course(id):
 @login_required  
 def list_classes():
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         if not conn:
             return redirect('/')
         
-        classes = get_classes_list(conn)
+        classes = get_classes_list(conn, current_branch())
         conn.close()
         
         return render_template('classes/list.html', classes=classes)
@@ -626,14 +826,14 @@ def list_classes():
 def add_class():
     try:
         if request.method == 'GET':
-            conn = get_db_connection()
-            courses = get_courses_for_dropdown(conn)
-            professors = get_professors_for_dropdown(conn)
+            conn = get_read_connection()
+            courses = get_courses_for_dropdown(conn, current_branch())
+            professors = get_professors_for_dropdown(conn, current_branch())
             conn.close()
             
             return render_template('classes/add.html', courses=courses, professors=professors)
         
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/classes/add')
         
@@ -651,11 +851,22 @@ def add_class():
                 'start_date': start_date,
                 'end_date': end_date,
                 'class_time': request.form['class_time'],
-                'class_days': request.form['class_days']
+                'class_days': request.form['class_days'],
+                'classroom': request.form.get('classroom', '').strip() or None,
+                'branch_id': current_branch()
             }
             
-            add_class_db(conn, data)
+            conflicts, warnings = check_class_conflicts(conn, data, class_id=None, branch_id=current_branch())
+            if conflicts:
+                for conflict in conflicts:
+                    flash(describe_conflict(conflict), 'danger')
+                return redirect('/classes/add')
+            for warning in warnings:
+                flash(warning, 'warning')
+            
+            class_id = add_class_db(conn, data)
             conn.commit()
+            audit('classes', 'insert', class_id, after=data)
             return redirect('/classes')
             
         except:
@@ -676,20 +887,20 @@ def edit_class(id):
             if not conn:
                 return redirect('/classes')
             
-            class_info = get_class_by_id(conn, id)
+            class_info = get_class_by_id(conn, id, current_branch())
             
             if not class_info:
                 conn.close()
                 return redirect('/classes')
             
-            courses = get_courses_for_dropdown(conn)
-            professors = get_professors_for_dropdown(conn)
+            courses = get_courses_for_dropdown(conn, current_branch())
+            professors = get_professors_for_dropdown(conn, current_branch())
             
             conn.close()
             
             return render_template('classes/edit.html', class_info=class_info, courses=courses, professors=professors)
         
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect(f'/classes/edit/{id}')
         
@@ -707,11 +918,26 @@ def edit_class(id):
                 'start_date': start_date,
                 'end_date': end_date,
                 'class_time': request.form['class_time'],
-                'class_days': request.form['class_days']
+                'class_days': request.form['class_days'],
+                'classroom': request.form.get('classroom', '').strip() or None
             }
             
-            update_class_db(conn, id, data)
+            conflicts, warnings = check_class_conflicts(conn, data, class_id=id, branch_id=current_branch())
+            if conflicts:
+                for conflict in conflicts:
+                    flash(describe_conflict(conflict), 'danger')
+                return redirect(f'/classes/edit/{id}')
+            for warning in warnings:
+                flash(warning, 'warning')
+            
+            before = update_class_db(conn, id, data, row_version=form_row_version(),
+                                     branch_id=current_branch())
+            if before is None:
+                conn.rollback()
+                flash_version_conflict(conn, 'classes', id, data)
+                return redirect(f'/classes/edit/{id}')
             conn.commit()
+            audit('classes', 'update', id, before, data)
             return redirect('/classes')
             
         except:
@@ -727,14 +953,15 @@ def edit_class(id):
 @login_required  
 def delete_class(id):
     try:
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/classes')
         
         try:
-            success, message = delete_class_db(conn, id)
+            success, message, before = delete_class_db(conn, id, current_branch())
             if success:
                 conn.commit()
+                audit('classes', 'delete', id, before)
         except:
             pass
         finally:
@@ -745,46 +972,140 @@ def delete_class(id):
     except:
         return redirect('/classes')
 
+@app.route('/classes/timetable')
+@login_required
+def class_timetable():
+    try:
+        group_by = request.args.get('group_by', 'professor')
+        if group_by not in TIMETABLE_GROUPS:
+            group_by = 'professor'
+        key = request.args.get('key') or None
+        active_on = request.args.get('date') or None
+        
+        conn = get_db_connection()
+        if not conn:
+            return redirect('/classes')
+        
+        timetable = get_timetable(conn, current_branch())
+        conn.close()
+        
+        active_date = datetime.strptime(active_on, '%Y-%m-%d').date() if active_on else None
+        return render_template('classes/timetable.html',
+                             sections=timetable.view(group_by, key, active_date),
+                             options=timetable.options(group_by),
+                             unscheduled=timetable.unscheduled,
+                             group_by=group_by, key=key, active_on=active_on or '',
+                             format_minutes=format_minutes)
+    
+    except Exception as e:
+        print(f"خطا در نمایش جدول هفتگی: {e}")
+        return redirect('/classes')
+
+@app.route('/classes/<int:id>/attendance', methods=['GET', 'POST'])
+@login_required
+def class_attendance(id):
+    try:
+        if request.method == 'POST':
+            conn = get_unit_of_work()
+            if not conn:
+                flash('خطا در اتصال به پایگاه داده', 'danger')
+                return redirect(f'/classes/{id}/attendance')
+            
+            try:
+                session_number = int(request.form['session'])
+                if session_number < 1:
+                    raise ValueError(session_number)
+                present_ids = [int(registration_id) for registration_id in request.form.getlist('present')]
+                
+                mark_class_attendance_db(conn, id, session_number, present_ids, current_branch())
+                conn.commit()
+                flash(f'حضور و غیاب جلسه {session_number} ثبت شد.', 'success')
+                return redirect(f'/classes/{id}/attendance?session={session_number}')
+            except Exception as e:
+                conn.rollback()
+                print(f"خطا در ثبت حضور و غیاب: {e}")
+                flash('خطا در ثبت حضور و غیاب', 'danger')
+                return redirect(f'/classes/{id}/attendance')
+            finally:
+                conn.close()
+        
+        conn = get_read_connection()
+        if not conn:
+            return redirect('/classes')
+        
+        class_info = get_class_by_id(conn, id, current_branch())
+        if not class_info:
+            conn.close()
+            return redirect('/classes')
+        course = get_course_by_id(conn, class_info['course_id'])
+        rows = get_class_attendance(conn, id, current_branch())
+        conn.close()
+        
+        # تعداد جلسات دوره؛ اگر جلسات بیشتری ثبت شده باشد همه نمایش داده می‌شوند
+        recorded_sessions = max([len(row.recorded.rstrip('0')) for row in rows] or [0])
+        course_sessions = (course['session_count'] if course else None) or 0
+        sessions = max(course_sessions, recorded_sessions, 1)
+        selected = request.args.get('session', type=int) or min(recorded_sessions + 1, sessions)
+        
+        attended = sum(row.attended for row in rows)
+        held = sum(row.held for row in rows)
+        
+        return render_template('classes/attendance.html',
+                             class_info=class_info,
+                             course=course,
+                             rows=rows,
+                             sessions=sessions,
+                             selected=selected,
+                             class_rate=round(100.0 * attended / held, 1) if held else None)
+    
+    except Exception as e:
+        print(f"خطا در نمایش حضور و غیاب: {e}")
+        return redirect('/classes')
+
 # ==================== مدیریت ثبت‌نام‌ها ====================
 @app.route('/registrations')
 @login_required
 def list_registrations():
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         if not conn:
             return redirect('/')
         
         filters = {
             'class_id': request.args.get('class_id'),
             'student_id': request.args.get('student_id'),
-            'payment_status': request.args.get('payment_status')
+            'payment_status': request.args.get('payment_status'),
+            'period': request.args.get('period', 'recent')
         }
         
-        registrations = get_registrations_list(conn, filters)
-        classes = get_classes_for_registration(conn)
+        registrations = get_registrations_list(conn, dict(filters, branch_id=current_branch(),
+                                                          registered_since=registration_period_start(filters['period'])))
+        classes = get_classes_for_registration(conn, current_branch())
         conn.close()
         
         return render_template('registrations/list.html', 
                              registrations=registrations, 
                              classes=classes, 
+                             periods=REGISTRATION_PERIODS,
                              **filters)
     
     except:
-        return render_template('registrations/list.html', registrations=[], classes=[])
+        return render_template('registrations/list.html', registrations=[], classes=[], periods=REGISTRATION_PERIODS)
 
 @app.route('/registrations/add', methods=['GET', 'POST'])
 @login_required
+@idempotent('/registrations')
 def add_registration():
     try:
         if request.method == 'GET':
-            conn = get_db_connection()
-            students = get_students_for_dropdown(conn)
-            classes = get_active_classes_for_dropdown(conn)
+            conn = get_read_connection()
+            students = get_students_for_dropdown(conn, current_branch())
+            classes = get_active_classes_for_dropdown(conn, current_branch())
             conn.close()
             
             return render_template('registrations/add.html', students=students, classes=classes)
         
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/registrations/add')
         
@@ -802,8 +1123,7 @@ def add_registration():
             if class_info and class_info['registered'] >= class_info['capacity']:
                 return redirect('/registrations/add')
             
-            registration_id = add_registration_db(conn, membership_id, class_id)
-            
+            amount = 0
             if request.form.get('amount'):
                 try:
                     amount = float(request.form['amount'])
@@ -811,25 +1131,19 @@ def add_registration():
                         amount = 0
                 except ValueError:
                     amount = 0
-                
-                if amount > 0:
-                    payment_method = request.form.get('payment_method', 'نقدی')
-                    payment_status = request.form.get('payment_status', 'انتظار')
-                    
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        INSERT INTO payments (amount, payment_method, payment_status, payment_date)
-                        VALUES (%s, %s, %s, CURRENT_DATE)
-                        RETURNING payment_id
-                    ''', (amount, payment_method, payment_status))
-                    
-                    payment_id = cursor.fetchone()[0]
-                    cursor.execute('UPDATE registrations SET payment_id = %s WHERE registration_id = %s', 
-                                 (payment_id, registration_id))
-                    cursor.close()
-                    conn.commit()
+            
+            payment_method = request.form.get('payment_method') or 'نقدی'
+            payment_status = request.form.get('payment_status') or 'انتظار'
+            
+            registration_id = create_registration_with_payment(conn, membership_id, class_id, amount,
+                                                               payment_method, payment_status)
             
             conn.commit()
+            mark_idempotent_success()
+            audit('registrations', 'insert', registration_id, after={
+                'membership_id': membership_id, 'class_id': class_id, 'amount': amount,
+                'payment_method': payment_method, 'payment_status': payment_status
+            })
             return redirect('/registrations')
             
         except:
@@ -846,37 +1160,19 @@ def add_registration():
 def edit_registration(id):
     try:
         if request.method == 'GET':
-            conn = get_db_connection()
-            if not conn:
-                return redirect('/registrations')
-            
             try:
-                # دریافت اطلاعات ثبت‌نام
-                registration = get_registration_by_id(conn, id)
+                # پرس‌وجوهای مستقل صفحه به صورت همزمان اجرا می‌شوند
+                branch_id = current_branch()
+                data = load_page_data({
+                    'registration': lambda conn: get_registration_by_id(conn, id, branch_id),
+                    'current_class_info': lambda conn: get_registration_class_info(conn, id),
+                    'students': lambda conn: get_students_for_dropdown(conn, branch_id),
+                    'classes': lambda conn: get_classes_for_registration_edit(conn, id),
+                }, readonly=False)
                 
-                if not registration:
-                    conn.close()
+                if not data['registration']:
                     return redirect('/registrations')
-                
-                # دریافت اطلاعات کلاس جاری برای نمایش
-                current_class_info = None
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT 
-                        c.course_title,
-                        cl.class_time,
-                        cl.class_days,
-                        p.first_name || ' ' || p.last_name as professor_name,
-                        cl.start_date,
-                        cl.end_date
-                    FROM registrations r
-                    JOIN classes cl ON r.class_id = cl.class_id
-                    JOIN courses c ON cl.course_id = c.course_id
-                    JOIN professors p ON cl.professor_id = p.professor_id
-                    WHERE r.registration_id = %s
-                ''', (id,))
-                current_class_info = cursor.fetchone()
-                cursor.close()
+                registration = dict(data['registration'])
                 
                 # اگر اطلاعات پرداخت وجود دارد، فرمت نمایش را تنظیم کنید
                 if registration.get('payment_method'):
@@ -893,68 +1189,18 @@ def edit_registration(id):
                     else:
                         registration['payment_method_display'] = registration['payment_method']
                 
-                # دریافت لیست دانش‌آموزان برای dropdown
-                students = get_students_for_dropdown(conn)
-                
-                # دریافت لیست کلاس‌های فعال برای dropdown
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT 
-                        cl.class_id, 
-                        c.course_title || ' - ' || cl.class_time || ' (' || cl.class_days || ')' as class_name,
-                        cl.capacity, 
-                        (SELECT COUNT(*) FROM registrations WHERE class_id = cl.class_id) as registered,
-                        c.course_title,
-                        cl.class_time,
-                        cl.class_days,
-                        p.first_name || ' ' || p.last_name as professor_name,
-                        cl.start_date,
-                        cl.end_date
-                    FROM classes cl
-                    JOIN courses c ON cl.course_id = c.course_id
-                    JOIN professors p ON cl.professor_id = p.professor_id
-                    WHERE cl.start_date >= CURRENT_DATE OR cl.class_id = %s
-                    ORDER BY cl.start_date
-                ''', (registration['class_id'],))
-                
-                classes = []
-                for row in cursor.fetchall():
-                    class_info = {
-                        'class_id': row[0],
-                        'class_name': row[1],
-                        'capacity': row[2],
-                        'registered': row[3],
-                        'course_title': row[4],
-                        'class_time': row[5],
-                        'class_days': row[6],
-                        'professor_name': row[7],
-                        'start_date': row[8],
-                        'end_date': row[9]
-                    }
-                    # علامت گذاری کلاس فعلی
-                    if row[0] == registration['class_id']:
-                        class_info['is_current'] = True
-                    else:
-                        class_info['is_current'] = False
-                    classes.append(class_info)
-                
-                cursor.close()
-                conn.close()
-                
                 return render_template('registrations/edit.html', 
                                      registration=registration,
-                                     current_class_info=current_class_info,
-                                     students=students, 
-                                     classes=classes)
+                                     current_class_info=data['current_class_info'],
+                                     students=data['students'], 
+                                     classes=data['classes'])
                 
             except Exception as e:
                 print(f"خطا در دریافت اطلاعات برای ویرایش ثبت‌نام: {e}")
-                if conn:
-                    conn.close()
                 return redirect('/registrations')
         
         # POST method - پردازش فرم ویرایش
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/registrations')
         
@@ -975,9 +1221,6 @@ def edit_registration(id):
                     conn.close()
                     return redirect(f'/registrations/edit/{id}')
             
-            # بروزرسانی اطلاعات ثبت‌نام
-            update_registration_db(conn, id, membership_id, class_id)
-            
             amount_str = request.form.get('amount', '').strip()
             payment_method = request.form.get('payment_method', '').strip()
             payment_status = request.form.get('payment_status', '').strip()
@@ -994,6 +1237,8 @@ def edit_registration(id):
             elif payment_method == 'انتقال بانکی':
                 payment_method = 'انتقال بانکی'
             
+            amount = 0
+            payment_action = None
             if amount_str:
                 try:
                     amount = float(amount_str)
@@ -1003,45 +1248,28 @@ def edit_registration(id):
                     amount = 0
                 
                 if amount > 0 and payment_method and payment_status:
-                    cursor = conn.cursor()
-                    # بررسی وجود پرداخت قبلی
-                    cursor.execute('SELECT payment_id FROM registrations WHERE registration_id = %s', (id,))
-                    result = cursor.fetchone()
-                    payment_id = result[0] if result else None
-                    
-                    if payment_id:
-                        # بروزرسانی پرداخت موجود
-                        cursor.execute('''
-                            UPDATE payments 
-                            SET amount = %s, payment_method = %s, payment_status = %s,
-                                payment_date = CURRENT_DATE
-                            WHERE payment_id = %s
-                        ''', (amount, payment_method, payment_status, payment_id))
-                    else:
-                        # ایجاد پرداخت جدید
-                        cursor.execute('''
-                            INSERT INTO payments (amount, payment_method, payment_status, payment_date)
-                            VALUES (%s, %s, %s, CURRENT_DATE)
-                            RETURNING payment_id
-                        ''', (amount, payment_method, payment_status))
-                        
-                        payment_id = cursor.fetchone()[0]
-                        cursor.execute('UPDATE registrations SET payment_id = %s WHERE registration_id = %s', 
-                                     (payment_id, id))
-                    cursor.close()
+                    payment_action = 'upsert'
                 elif amount == 0:
                     # حذف پرداخت اگر مبلغ صفر است
-                    cursor = conn.cursor()
-                    cursor.execute('SELECT payment_id FROM registrations WHERE registration_id = %s', (id,))
-                    result = cursor.fetchone()
-                    payment_id = result[0] if result else None
-                    
-                    if payment_id:
-                        cursor.execute('DELETE FROM payments WHERE payment_id = %s', (payment_id,))
-                        cursor.execute('UPDATE registrations SET payment_id = NULL WHERE registration_id = %s', (id,))
-                    cursor.close()
+                    payment_action = 'delete'
+            
+            # بروزرسانی ثبت‌نام و پرداخت در یک دستور (تصویر قبل برای گزارش تغییرات)
+            before = save_registration_payment(conn, id, payment_action, amount, payment_method, payment_status,
+                                               membership_id=membership_id, class_id=class_id,
+                                               row_version=form_row_version(), branch_id=current_branch())
+            if before is None:
+                conn.rollback()
+                flash_version_conflict(conn, 'registrations', id, {
+                    'membership_id': membership_id, 'class_id': class_id, 'amount': amount,
+                    'payment_method': payment_method, 'payment_status': payment_status
+                })
+                return redirect(f'/registrations/edit/{id}')
             
             conn.commit()
+            audit('registrations', 'update', id, before, {
+                'membership_id': membership_id, 'class_id': class_id, 'payment_action': payment_action,
+                'amount': amount, 'payment_method': payment_method, 'payment_status': payment_status
+            })
             print(f"ثبت‌نام {id} با موفقیت ویرایش شد")
             return redirect('/registrations')
             
@@ -1058,6 +1286,7 @@ def edit_registration(id):
 
 @app.route('/registrations/payment/<int:id>', methods=['GET', 'POST'])
 @login_required
+@idempotent('/registrations')
 def add_registration_payment(id):
     try:
         if request.method == 'GET':
@@ -1066,7 +1295,7 @@ def add_registration_payment(id):
                 return redirect('/registrations')
             
             try:
-                registration = get_registration_for_payment(conn, id)
+                registration = get_registration_for_payment(conn, id, current_branch())
                 
                 if not registration:
                     conn.close()
@@ -1079,17 +1308,25 @@ def add_registration_payment(id):
                 conn.close()
                 return redirect('/registrations')
         
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect(f'/registrations/payment/{id}')
         
         try:
-            amount = request.form['amount']
+            amount = float(request.form['amount'])
             payment_method = request.form['payment_method']
             payment_status = request.form['payment_status']
             
-            add_payment_and_link_to_registration(conn, amount, payment_method, payment_status, id)
+            before = save_registration_payment(conn, id, 'upsert', amount, payment_method, payment_status,
+                                               branch_id=current_branch())
+            if before is None:
+                conn.rollback()
+                return redirect('/registrations')
             conn.commit()
+            mark_idempotent_success()
+            audit('registrations', 'payment', id, before, {
+                'amount': amount, 'payment_method': payment_method, 'payment_status': payment_status
+            })
             return redirect('/registrations')
             
         except:
@@ -1105,13 +1342,15 @@ def add_registration_payment(id):
 @login_required
 def delete_registration(id):
     try:
-        conn = get_db_connection()
+        conn = get_unit_of_work()
         if not conn:
             return redirect('/registrations')
         
         try:
-            delete_registration_db(conn, id)
+            before = delete_registration_db(conn, id, current_branch())
             conn.commit()
+            if before is not None:
+                audit('registrations', 'delete', id, before)
         except:
             pass
         finally:
@@ -1121,6 +1360,150 @@ def delete_registration(id):
     
     except:
         return redirect('/registrations')
+# ==================== حذف و بایگانی گروهی ====================
+def run_batch_action(remove_func, list_url, label, entity):
+    """اجرای حذف یا بایگانی گروهی و بازگشت به صفحه لیست با پیام نتیجه"""
+    action = request.form.get('action', 'delete')
+    ids = request.form.getlist('ids')
+    
+    if action not in BATCH_ACTIONS or not ids:
+        flash('هیچ موردی انتخاب نشده است.', 'warning')
+        return redirect(list_url)
+    
+    conn = get_unit_of_work()
+    if not conn:
+        flash('خطا در اتصال به پایگاه داده', 'danger')
+        return redirect(list_url)
+    
+    try:
+        # done: {شناسه: تصویر پیش از حذف} از همان دستور حذف؛ cascaded: ثبت‌نام‌هایی
+        # که همراه دانش‌آموزان یا کلاس‌ها بایگانی شده‌اند
+        done, blocked, cascaded = remove_func(conn, ids, archive=(action == 'archive'), branch_id=current_branch())
+        conn.commit()
+        for entity_id, before in done.items():
+            audit(entity, action, entity_id, before)
+        for registration_id, before in cascaded.items():
+            audit('registrations', action, registration_id, before)
+        verb = 'بایگانی' if action == 'archive' else 'حذف'
+        flash(f'{len(done)} {label} {verb} شد.', 'success')
+        if blocked:
+            flash(f'{len(blocked)} {label} به دلیل داشتن رکورد وابسته {verb} نشد: '
+                  + '، '.join(str(i) for i in blocked), 'warning')
+    except Exception as e:
+        conn.rollback()
+        print(f"خطا در عملیات گروهی {label}: {e}")
+        flash('خطا در انجام عملیات گروهی', 'danger')
+    finally:
+        conn.close()
+    
+    return redirect(list_url)
+
+@app.route('/professors/batch', methods=['POST'])
+@login_required
+def batch_professors():
+    return run_batch_action(batch_remove_professors, '/professors', 'استاد', 'professors')
+
+@app.route('/students/batch', methods=['POST'])
+@login_required
+def batch_students():
+    return run_batch_action(batch_remove_students, '/students', 'دانش‌آموز', 'students')
+
+@app.route('/classes/batch', methods=['POST'])
+@login_required
+def batch_classes():
+    return run_batch_action(batch_remove_classes, '/classes', 'کلاس', 'classes')
+
+@app.route('/registrations/batch', methods=['POST'])
+@login_required
+def batch_registrations():
+    return run_batch_action(batch_remove_registrations, '/registrations', 'ثبت‌نام', 'registrations')
+
+# ==================== گزارش درآمد ====================
+@app.route('/reports/revenue')
+@login_required
+def revenue_report():
+    filters = {
+        'period': request.args.get('period', 'monthly'),
+        'group_by': request.args.get('group_by', 'status'),
+        'start_date': request.args.get('start_date', ''),
+        'end_date': request.args.get('end_date', '')
+    }
+    
+    try:
+        conn = get_read_connection()
+        if not conn:
+            return redirect('/')
+        
+        try:
+            report = get_revenue_report(conn, filters['period'], filters['group_by'],
+                                        filters['start_date'] or None, filters['end_date'] or None)
+        finally:
+            conn.close()
+        
+        total_amount = sum(row['total_amount'] or 0 for row in report)
+        return render_template('reports/revenue.html', report=report, total_amount=total_amount, **filters)
+    
+    except Exception as e:
+        print(f"خطا در دریافت گزارش درآمد: {e}")
+        return render_template('reports/revenue.html', report=[], total_amount=0, **filters)
+
+@app.route('/reports/analytics')
+@login_required
+def analytics_report():
+    try:
+        conn = get_read_connection()
+        if not conn:
+            return redirect('/')
+        
+        try:
+            report = build_analytics_report(conn)
+        finally:
+            conn.close()
+        
+        return render_template('reports/analytics.html', report=report)
+    
+    except Exception as e:
+        print(f"خطا در تهیه گزارش تحلیلی: {e}")
+        return redirect('/')
+
+@app.route('/reports/payroll')
+@login_required
+def payroll_report():
+    # بازه پیش‌فرض: ماه جاری
+    today = date.today()
+    month_start = today.replace(day=1)
+    month_end = (month_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    filters = {
+        'start_date': request.args.get('start_date') or month_start.isoformat(),
+        'end_date': request.args.get('end_date') or month_end.isoformat()
+    }
+    
+    try:
+        start_date = date.fromisoformat(filters['start_date'])
+        end_date = date.fromisoformat(filters['end_date'])
+        if start_date > end_date:
+            raise ValueError(filters)
+        
+        conn = get_read_connection()
+        if not conn:
+            return redirect('/')
+        
+        try:
+            report = build_payroll(conn, start_date, end_date)
+        finally:
+            conn.close()
+        
+        if request.args.get('format') == 'csv':
+            filename = f'payroll_{start_date.isoformat()}_{end_date.isoformat()}.csv'
+            return Response(payroll_csv(report), mimetype='text/csv',
+                            headers={'Content-Disposition': f'attachment; filename={filename}'})
+        
+        return render_template('reports/payroll.html', report=report, **filters)
+    
+    except Exception as e:
+        print(f"خطا در محاسبه حقوق اساتید: {e}")
+        return render_template('reports/payroll.html', report=None, **filters)
+
 # ==================== جستجوی پیشرفته ====================
 @app.route('/search', methods=['GET', 'POST'])
 @login_required
@@ -1133,7 +1516,7 @@ def search():
             if not query:
                 return render_template('search.html')
             
-            conn = get_db_connection()
+            conn = get_read_connection()
             if not conn:
                 return redirect('/')
             
@@ -1172,7 +1555,7 @@ def api_search_students():
         if not query:
             return jsonify([])
         
-        conn = get_db_connection()
+        conn = get_read_connection()
         if not conn:
             return jsonify([])
         
@@ -1188,7 +1571,7 @@ def api_search_students():
 @login_required
 def api_class_availability(class_id):
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         if not conn:
             return jsonify({'error': 'Database connection failed'})
         
@@ -1207,12 +1590,136 @@ def api_class_availability(class_id):
     except:
         return jsonify({'error': 'Server error'})
 
+@app.route('/api/classes/availability', methods=['GET', 'POST'])
+@login_required
+def api_classes_availability():
+    """ظرفیت چند کلاس در یک درخواست (شناسه‌ها یا فیلتر دوره / سطح)"""
+    try:
+        params = (request.get_json(silent=True) or {}) if request.method == 'POST' else {}
+        if not isinstance(params, dict):
+            return jsonify({'error': 'Invalid request body'}), 400
+        if params.get('class_ids') is not None and not isinstance(params['class_ids'], list):
+            return jsonify({'error': 'class_ids must be a list'}), 400
+        class_ids = params.get('class_ids') or request.args.getlist('class_id')
+        class_ids = [int(class_id) for class_id in class_ids] or None
+        course_id = params.get('course_id') or request.args.get('course_id')
+        course_id = int(course_id) if course_id else None
+        level = params.get('level') or request.args.get('level') or None
+        active_only = bool(params.get('active_only') or request.args.get('active_only'))
+        
+        if len(class_ids or []) > MAX_AVAILABILITY_BATCH:
+            return jsonify({'error': f'Too many classes (max {MAX_AVAILABILITY_BATCH})'}), 400
+        
+        conn = get_read_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'})
+        
+        rows = get_classes_availability_db(conn, class_ids, course_id, level, active_only, current_branch())
+        conn.close()
+        
+        return jsonify({'classes': [dict(row) for row in rows]})
+    
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid class id'}), 400
+    except:
+        return jsonify({'error': 'Server error'})
+
+def sse_response(events):
+    """پاسخ Server-Sent Events با رعایت سقف جریان‌های هم‌زمان این فرایند
+    
+    جایگاه جریان با بسته شدن پاسخ (قطع اتصال مرورگر یا خاموش شدن سرور) آزاد می‌شود.
+    """
+    if not acquire_stream_slot():
+        return jsonify({'error': 'Too many open streams'}), 503, {'Retry-After': str(SSE_RETRY_SECONDS)}
+    response = Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(release_stream_slot)
+    return response
+
+@app.route('/api/classes/availability/stream')
+@login_required
+def api_class_availability_stream():
+    """ارسال لحظه‌ای ظرفیت کلاس‌ها با Server-Sent Events"""
+    class_ids = set(request.args.getlist('class_id', type=int)) or None
+    return sse_response(availability_broadcaster.stream(class_ids))
+
+@app.route('/api/classes/check-conflicts')
+@login_required
+def api_check_class_conflicts():
+    try:
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'})
+        
+        class_id = request.args.get('class_id', type=int)
+        conflicts, warnings = check_class_conflicts(conn, request.args, class_id=class_id,
+                                                      branch_id=current_branch())
+        conn.close()
+        
+        return jsonify({
+            'conflicts': [dict(conflict._asdict(), message=describe_conflict(conflict)) for conflict in conflicts],
+            'warnings': warnings
+        })
+    
+    except:
+        return jsonify({'error': 'Server error'})
+
+@app.route('/api/attendance/rates')
+@login_required
+def api_attendance_rates():
+    """نرخ حضور به تفکیک کلاس یا دانش‌آموز"""
+    group_by = request.args.get('group_by', 'class')
+    if group_by not in ATTENDANCE_RATE_GROUPS:
+        return jsonify({'error': 'Invalid group_by'}), 400
+    try:
+        conn = get_read_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'})
+        
+        rows = get_attendance_rates(conn, group_by,
+                                    class_id=request.args.get('class_id', type=int),
+                                    membership_id=request.args.get('student_id', type=int),
+                                    branch_id=current_branch())
+        conn.close()
+        
+        return jsonify({'rates': [dict(row) for row in rows]})
+    except:
+        return jsonify({'error': 'Server error'})
+
+@app.route('/api/audit')
+@login_required
+def api_audit_log():
+    """آخرین تغییرات ثبت‌شده (فیلتر: entity، entity_id، actor)"""
+    entity = request.args.get('entity') or None
+    if entity and entity not in AUDIT_ENTITIES:
+        return jsonify({'error': 'Invalid entity'}), 400
+    try:
+        conn = get_read_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'})
+
+        rows = get_audit_log(conn, entity, request.args.get('entity_id') or None,
+                             request.args.get('actor') or None,
+                             min(request.args.get('limit', 100, type=int), 1000))
+        conn.close()
+
+        return jsonify({'changes': [dict(row) for row in rows]})
+    except:
+        return jsonify({'error': 'Server error'})
+
 # ==================== API برای آمار لحظه‌ای ====================
 @app.route('/api/dashboard/stats')
 @login_required
 def api_dashboard_stats():
     try:
-        conn = get_db_connection()
+        stats = dashboard_broadcaster.current()
+        if stats:
+            return jsonify(stats)
+        
+        conn = get_read_connection()
         if not conn:
             return jsonify({'error': 'Database connection failed'})
         
@@ -1224,12 +1731,115 @@ def api_dashboard_stats():
     except:
         return jsonify({'error': 'Server error'})
 
+@app.route('/api/dashboard/stream')
+@login_required
+def api_dashboard_stream():
+    """ارسال لحظه‌ای آمار داشبورد؛ همه داشبوردهای باز از یک محاسبه مشترک استفاده می‌کنند"""
+    return sse_response(dashboard_broadcaster.stream())
+
+# ==================== REST API (نسخه ۱) ====================
+# GET /api/v1/<منبع>?fields=a,b&limit=50&after=<cursor>&<فیلترها>
+# پاسخ: {"data": [...], "next_cursor": ...}؛ برای صفحه بعد next_cursor به عنوان after ارسال می‌شود
+API_PAGE_ARGS = ('fields', 'limit', 'after')
+
+# GET /api/v1/events?after=<txid:event_id>&limit=100&aggregate_type=registration|payment
+# رویدادهای تغییر ثبت‌نام و پرداخت به ترتیب commit؛ مصرف‌کننده next_cursor را نگه
+# می‌دارد و دوباره می‌پرسد (رویداد تکراری با event_id قابل تشخیص است)
+@app.route('/api/v1/events')
+@login_required
+def api_v1_events():
+    conn = None
+    try:
+        limit = min(max(int(request.args.get('limit', API_DEFAULT_PAGE_SIZE)), 1), API_MAX_PAGE_SIZE)
+        after = request.args.get('after') or OUTBOX_CURSOR_START
+        parse_outbox_cursor(after)
+        aggregate_type = request.args.get('aggregate_type') or None
+
+        conn = get_read_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 503
+
+        data, next_cursor = get_outbox_page(conn, after, limit, aggregate_type)
+        return Response(f'{{"data":{data},"next_cursor":{json.dumps(next_cursor)}}}',
+                        mimetype='application/json')
+    except ValueError as e:
+        return jsonify({'error': str(e) or 'Invalid parameter'}), 400
+    except:
+        return jsonify({'error': 'Server error'}), 500
+    finally:
+        if conn:
+            conn.close()
+
+@app.route('/api/v1/<resource>')
+@login_required
+def api_v1_list(resource):
+    if resource not in API_RESOURCES:
+        return jsonify({'error': 'Unknown resource'}), 404
+    
+    conn = None
+    try:
+        fields = [name for name in request.args.get('fields', '').split(',') if name] or None
+        limit = min(max(int(request.args.get('limit', API_DEFAULT_PAGE_SIZE)), 1), API_MAX_PAGE_SIZE)
+        after = request.args.get('after') or None
+        filters = {name: value for name, value in request.args.items() if name not in API_PAGE_ARGS}
+        
+        conn = get_read_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 503
+        
+        data, next_cursor = get_api_page(conn, resource, fields, filters, after, limit)
+        # آرایه data از قبل JSON است و بدون بازسازی در پاسخ قرار می‌گیرد
+        return Response(f'{{"data":{data},"next_cursor":{json.dumps(next_cursor)}}}',
+                        mimetype='application/json')
+    except ValueError as e:
+        return jsonify({'error': str(e) or 'Invalid parameter'}), 400
+    except:
+        return jsonify({'error': 'Server error'}), 500
+    finally:
+        if conn:
+            conn.close()
+
 # ==================== راه‌اندازی سرور ====================
-if __name__ == '__main__':
+def init_database():
+    """ایجاد جداول جانبی و جداول تجمیعی (یک بار پیش از شروع سرویس‌دهی)"""
     conn = get_db_connection()
-    if conn:
+    if not conn:
+        return False
+    try:
+        if not init_db_schema(conn):
+            return False
+        try:
+            ensure_term_partitions(conn)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"خطا در ساخت پارتیشن ترم‌های آینده: {e}")
+        ensure_payment_rollups(conn)
+        ensure_student_summaries(conn)
+        return True
+    finally:
         conn.close()
-        print("Server starting at http://localhost:5000")
-        app.run(debug=True, host='0.0.0.0', port=5000)
+
+def create_app():
+    """برنامه آماده سرویس‌دهی
+    
+    مسیرها در سطح ماژول تعریف شده‌اند؛ این تابع فقط آماده‌سازی پایگاه داده را
+    انجام می‌دهد و در صورت شکست اتصال یا ساخت جداول جانبی خطا می‌دهد تا سرور با
+    برنامه ناقص بالا نیاید.
+    سرور تولیدی (gunicorn) از wsgi.py و gunicorn.conf.py استفاده می‌کند.
+    """
+    if not init_database():
+        raise RuntimeError("Database initialization failed!")
+    return app
+
+if __name__ == '__main__':
+    # سرور توسعه؛ برای اجرای تولیدی: gunicorn -c gunicorn.conf.py wsgi:app
+    try:
+        create_app()
+    except RuntimeError as e:
+        print(e)
     else:
-        print("Database connection failed!")
\ No newline at end of file
+        host = os.getenv('SERVER_HOST') or '0.0.0.0'
+        port = int(os.getenv('SERVER_PORT') or '5000')
+        print(f"Server starting at http://localhost:{port}")
+        app.run(debug=os.getenv('FLASK_DEBUG', 'False') == 'True', host=host, port=port)
\ No newline at end of file
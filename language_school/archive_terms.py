@@ -0,0 +1,134 @@
+import argparse
+import gzip
+import os
+import re
+import sys
+from datetime import date
+from database_queries import (
+    get_db_connection, get_term_partition_parents, ensure_term_partitions, create_term_partitions,
+    get_default_partition_terms, term_start, term_after
+)
+
+# ==================== بایگانی ترم‌های تمام‌شده ====================
+# اجرا (مثلاً روزانه با cron):
+#   python archive_terms.py maintain            ساخت پارتیشن ترم‌های آینده
+#   python archive_terms.py archive             بایگانی ترم‌های قدیمی‌تر از ARCHIVE_KEEP_TERMS
+#   python archive_terms.py archive --before 2025-01-01 --dry-run
+#
+# پارتیشن هر ترم تمام‌شده به صورت CSV فشرده (gzip) در ARCHIVE_DIR ذخیره، از جدول
+# اصلی جدا (DETACH) و حذف می‌شود؛ حضور و غیاب ثبت‌نام‌های آن نیز کنار آن ذخیره
+# می‌شود. ردیف‌های ترم‌های قدیمی که در پارتیشن پیش‌فرض مانده‌اند (مثلاً تاریخ
+# گذشته پیش از ساخت پارتیشن ترم) ابتدا به پارتیشن ترم خود منتقل می‌شوند.
+# جداول تجمیعی درآمد تغییر نمی‌کنند و گزارش‌ها سابقه را حفظ می‌کنند.
+# بازگردانی: \copy registrations FROM PROGRAM 'gunzip -c <file>' WITH CSV HEADER
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_KEEP_TERMS = int(os.getenv('ARCHIVE_KEEP_TERMS', '4'))
+
+def finished_partitions(conn, before):
+    """پارتیشن‌های ترمی که پیش از تاریخ before تمام شده‌اند: (جدول، پارتیشن شعبه، پارتیشن ترم، شروع ترم)"""
+    cursor = conn.cursor()
+    partitions = []
+    for table, parent in get_term_partition_parents(conn):
+        cursor.execute('''
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+            ORDER BY 1
+        ''', (parent,))
+        for (name,) in cursor.fetchall():
+            match = re.fullmatch(rf'{parent}_(\d{{4}})_(\d{{2}})', name)
+            if not match:
+                continue
+            start = date(int(match.group(1)), int(match.group(2)), 1)
+            if term_after(start) <= before:
+                partitions.append((table, parent, name, start))
+    cursor.close()
+    return partitions
+
+def partition_default_rows(conn, before, dry_run=False):
+    """انتقال ردیف‌های ترم‌های پیش از before از پارتیشن پیش‌فرض به پارتیشن ترم خود"""
+    for _, parent in get_term_partition_parents(conn):
+        try:
+            for start in get_default_partition_terms(conn, parent, before):
+                if dry_run:
+                    print(f"{parent}_default: ردیف‌های ترم {start}")
+                    continue
+                create_term_partitions(conn, parent, start, start)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"خطا در انتقال ردیف‌های {parent}_default: {e}")
+
+def _export(cursor, query, path):
+    """ذخیره نتیجه پرس‌وجو به صورت CSV فشرده"""
+    with gzip.open(path, 'wb') as output:
+        cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH CSV HEADER', output)
+
+def archive_partition(conn, table, parent, partition):
+    """ذخیره، جدا کردن و حذف یک پارتیشن ترمی در یک تراکنش"""
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT COUNT(*) FROM {partition}')
+    count = cursor.fetchone()[0]
+    _export(cursor, f'SELECT * FROM {partition}', os.path.join(ARCHIVE_DIR, f'{partition}.csv.gz'))
+
+    if table == 'registrations':
+        attendance = f'SELECT a.* FROM attendance a JOIN {partition} r ON r.registration_id = a.registration_id'
+        _export(cursor, attendance, os.path.join(ARCHIVE_DIR, f'{partition}_attendance.csv.gz'))
+        cursor.execute(f'DELETE FROM attendance a USING {partition} r WHERE r.registration_id = a.registration_id')
+
+    cursor.execute(f'ALTER TABLE {parent} DETACH PARTITION {partition}')
+    cursor.execute(f'DROP TABLE {partition}')
+    cursor.close()
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description='نگهداری پارتیشن‌های ترمی ثبت‌نام‌ها و پرداخت‌ها')
+    parser.add_argument('command', choices=['maintain', 'archive'])
+    parser.add_argument('--before', type=date.fromisoformat,
+                        help='بایگانی ترم‌هایی که پیش از این تاریخ تمام شده‌اند')
+    parser.add_argument('--dry-run', action='store_true', help='فقط نمایش ترم‌های قابل بایگانی')
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    if not conn:
+        print("خطا: اتصال به دیتابیس برقرار نشد")
+        return 1
+
+    try:
+        # ترم‌های آینده در هر دو حالت ساخته می‌شوند
+        count = ensure_term_partitions(conn)
+        conn.commit()
+        print(f"پارتیشن ترم‌های آینده برای {count} پارتیشن شعبه بررسی شد")
+        if args.command == 'maintain':
+            return 0
+
+        before = args.before or term_after(term_start(date.today()), -ARCHIVE_KEEP_TERMS)
+        partition_default_rows(conn, before, args.dry_run)
+        partitions = finished_partitions(conn, before)
+        if not partitions:
+            print(f"ترم تمام‌شده‌ای پیش از {before} وجود ندارد")
+            return 0
+
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        for table, parent, partition, start in partitions:
+            if args.dry_run:
+                print(f"{partition}: ترم {start}")
+                continue
+            try:
+                rows = archive_partition(conn, table, parent, partition)
+                conn.commit()
+                print(f"{partition}: {rows} ردیف بایگانی شد")
+            except Exception as e:
+                conn.rollback()
+                print(f"خطا در بایگانی {partition}: {e}")
+        return 0
+    except Exception as e:
+        conn.rollback()
+        print(f"خطا در نگهداری پارتیشن‌ها: {e}")
+        return 1
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
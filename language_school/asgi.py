@@ -0,0 +1,314 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from quart import Quart, Response, render_template, request, redirect, url_for, jsonify, session
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.routing import Map, Rule
+import async_queries
+from app import app as flask_app, BRANCH_ID
+from database_queries import REGISTRATION_PERIODS, registration_period_start
+from realtime import availability_broadcaster, dashboard_broadcaster
+
+# ==================== برنامه ASGI ====================
+# مسیرهای پرترافیک فقط‌خواندنی به صورت ناهمگام (Quart + psycopg 3) اجرا می‌شوند
+# و بقیه مسیرها بدون تغییر به برنامه Flask سپرده می‌شوند. هر دو برنامه از یک
+# کلید و کوکی session استفاده می‌کنند، بنابراین ورود و پیام‌ها مشترک است.
+#
+# اجرا: uvicorn asgi:application --host 0.0.0.0 --port 5000
+#
+# جریان‌های SSE مستقیماً در Quart اجرا می‌شوند و هیچ رشته‌ای را اشغال نمی‌کنند.
+# هر درخواست Flask در یکی از ASGI_FLASK_THREADS رشته اجرا می‌شود (نه یک رشته مشترک)
+# تا درخواست کند یک مسیر بقیه را معطل نکند.
+ASGI_FLASK_THREADS = int(os.getenv('ASGI_FLASK_THREADS', '32'))
+
+async_app = Quart(__name__)
+async_app.secret_key = flask_app.secret_key
+async_app.config['SESSION_COOKIE_NAME'] = flask_app.config['SESSION_COOKIE_NAME']
+
+@async_app.before_serving
+async def startup():
+    await async_queries.open_pools()
+
+@async_app.after_serving
+async def shutdown():
+    await async_queries.close_pools()
+
+def login_required(f):
+    """دکوراتور ورود برای مسیرهای ناهمگام"""
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if 'logged_in' not in session:
+            return redirect(url_for('login'))
+        return await f(*args, **kwargs)
+    return decorated_function
+
+def use_replica():
+    """مانند app.use_replica: پس از تغییر، خواندن‌ها تا مدتی از primary انجام می‌شوند"""
+    return session.get('primary_until', 0) <= time.time()
+
+def current_branch():
+    """مانند app.current_branch: شعبه ثابت نسخه یا شعبه انتخاب‌شده در session"""
+    return BRANCH_ID or session.get('branch_id')
+
+# ==================== صفحات لیست ====================
+@async_app.route('/professors')
+@login_required
+async def list_professors():
+    try:
+        professors = await async_queries.get_professors_list(current_branch(), use_replica())
+        return await render_template('professors/list.html', professors=professors)
+    except Exception as e:
+        print(f"خطا در دریافت لیست اساتید: {e}")
+        return await render_template('professors/list.html', professors=[])
+
+@async_app.route('/students')
+@login_required
+async def list_students():
+    try:
+        students = await async_queries.get_students_list(current_branch(), use_replica())
+        return await render_template('students/list.html', students=students)
+    except:
+        return await render_template('students/list.html', students=[])
+
+@async_app.route('/courses')
+@login_required
+async def list_courses():
+    try:
+        courses = await async_queries.get_courses_list(current_branch(), use_replica())
+        return await render_template('courses/list.html', courses=courses)
+    except:
+        return await render_template('courses/list.html', courses=[])
+
+@async_app.route('/classes')
+@login_required
+async def list_classes():
+    try:
+        classes = await async_queries.get_classes_list(current_branch(), use_replica())
+        return await render_template('classes/list.html', classes=classes)
+    except:
+        return await render_template('classes/list.html', classes=[])
+
+@async_app.route('/registrations')
+@login_required
+async def list_registrations():
+    try:
+        filters = {
+            'class_id': request.args.get('class_id'),
+            'student_id': request.args.get('student_id'),
+            'payment_status': request.args.get('payment_status'),
+            'period': request.args.get('period', 'recent')
+        }
+
+        registrations = await async_queries.get_registrations_list(
+            dict(filters, branch_id=current_branch(), registered_since=registration_period_start(filters['period'])),
+            use_replica())
+        classes = await async_queries.get_classes_for_registration(current_branch(), use_replica())
+
+        return await render_template('registrations/list.html',
+                                     registrations=registrations,
+                                     classes=classes,
+                                     periods=REGISTRATION_PERIODS,
+                                     **filters)
+    except:
+        return await render_template('registrations/list.html', registrations=[], classes=[],
+                                     periods=REGISTRATION_PERIODS)
+
+# ==================== API ====================
+@async_app.route('/api/search/students')
+@login_required
+async def api_search_students():
+    try:
+        query = request.args.get('q', '')
+        if not query:
+            return jsonify([])
+
+        results = await async_queries.api_search_students_db(query, 10, use_replica())
+        return jsonify(results)
+    except:
+        return jsonify([])
+
+@async_app.route('/api/class/<int:class_id>/availability')
+@login_required
+async def api_class_availability(class_id):
+    try:
+        result = await async_queries.get_class_availability_db(class_id, use_replica())
+        if result:
+            return jsonify({
+                'capacity': result['capacity'],
+                'registered': result['registered'],
+                'available': result['capacity'] - result['registered']
+            })
+
+        return jsonify({'error': 'Class not found'})
+    except:
+        return jsonify({'error': 'Server error'})
+
+@async_app.route('/api/dashboard/stats')
+@login_required
+async def api_dashboard_stats():
+    try:
+        stats = dashboard_broadcaster.current()
+        if not stats:
+            stats = await async_queries.get_live_dashboard_stats(use_replica())
+        return jsonify(stats)
+    except:
+        return jsonify({'error': 'Server error'})
+
+# ==================== جریان‌های لحظه‌ای (SSE) ====================
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def _event_stream(events):
+    response = Response(events, mimetype='text/event-stream', headers=SSE_HEADERS)
+    # جریان تا بسته شدن صفحه باز می‌ماند
+    response.timeout = None
+    return response
+
+@async_app.route('/api/classes/availability/stream')
+@login_required
+async def api_class_availability_stream():
+    class_ids = set(request.args.getlist('class_id', type=int)) or None
+    return _event_stream(availability_broadcaster.astream(class_ids))
+
+@async_app.route('/api/dashboard/stream')
+@login_required
+async def api_dashboard_stream():
+    return _event_stream(dashboard_broadcaster.astream())
+
+# ==================== تقسیم درخواست‌ها بین دو برنامه ====================
+ASYNC_ENDPOINTS = set(async_app.view_functions) - {'static'}
+
+async def _served_by_flask(**kwargs):
+    raise NotFound()
+
+# نقاط پایانی Flask فقط برای ساخت آدرس با url_for در قالب‌ها ثبت می‌شوند؛
+# این مسیرها هیچ‌گاه به برنامه ناهمگام نمی‌رسند
+for rule in flask_app.url_map.iter_rules():
+    if rule.endpoint not in async_app.view_functions:
+        async_app.add_url_rule(rule.rule, rule.endpoint, _served_by_flask, methods=rule.methods)
+
+_async_routes = Map([
+    Rule(rule.rule, endpoint=rule.endpoint, methods=rule.methods)
+    for rule in flask_app.url_map.iter_rules() if rule.endpoint in ASYNC_ENDPOINTS
+]).bind('localhost')
+
+# ==================== اجرای Flask (WSGI) زیر ASGI ====================
+# بدنه درخواست پیش از اجرا خوانده می‌شود (بدنه‌های بزرگ روی دیسک)؛ برنامه Flask و
+# پیمایش پاسخ آن در رشته‌ای از _flask_executor اجرا می‌شود و هر قطعه پاسخ همان
+# لحظه از طریق حلقه رویداد ارسال می‌شود، پس پاسخ‌های جریانی هم پشتیبانی می‌شوند.
+FLASK_BODY_MEMORY = 64 * 1024
+
+_flask_executor = ThreadPoolExecutor(max_workers=ASGI_FLASK_THREADS, thread_name_prefix='flask')
+
+async def _read_body(receive):
+    """خواندن کامل بدنه درخواست؛ None اگر کاربر پیش از پایان قطع شود"""
+    body = tempfile.SpooledTemporaryFile(max_size=FLASK_BODY_MEMORY)
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None
+        body.write(message.get('body', b''))
+        if not message.get('more_body'):
+            body.seek(0)
+            return body
+
+def _build_environ(scope, body):
+    """ساخت environ استاندارد WSGI از scope درخواست ASGI"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # بدنه کامل خوانده شده است؛ درخواست‌های chunked بدون Content-Length هم خوانده می‌شوند
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        # سرآیندهای تکراری مانند WSGI با ویرگول به هم می‌پیوندند
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+def _run_flask(environ, send):
+    """اجرای برنامه Flask و ارسال پاسخ (در رشته executor)؛ send یک تابع همگام است"""
+    start = {}
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and start.get('sent'):
+            raise exc_info[1].with_traceback(exc_info[2])
+        start['message'] = {
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        }
+
+    def send_start():
+        if not start.get('sent'):
+            send(start['message'])
+            start['sent'] = True
+
+    result = flask_app(environ, start_response)
+    try:
+        for chunk in result:
+            if chunk:
+                send_start()
+                send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        send_start()
+        send({'type': 'http.response.body', 'body': b''})
+    finally:
+        # close پاسخ کارهای پایانی Flask را اجرا می‌کند (مثلاً آزاد کردن جایگاه SSE)
+        if hasattr(result, 'close'):
+            result.close()
+
+async def _flask_asgi(scope, receive, send):
+    """اجرای درخواست HTTP با برنامه Flask در یکی از رشته‌های _flask_executor"""
+    if scope['type'] != 'http':
+        raise ValueError(f"نوع درخواست {scope['type']} توسط Flask پشتیبانی نمی‌شود")
+    body = await _read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+
+    def send_sync(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    try:
+        await loop.run_in_executor(_flask_executor, _run_flask, _build_environ(scope, body), send_sync)
+    finally:
+        body.close()
+
+def _is_async_request(scope):
+    try:
+        _async_routes.match(scope['path'], method=scope['method'])
+        return True
+    except HTTPException:
+        return False
+
+async def application(scope, receive, send):
+    """ورودی ASGI: مسیرهای ناهمگام به Quart و بقیه به Flask"""
+    if scope['type'] == 'lifespan' or (scope['type'] == 'http' and _is_async_request(scope)):
+        await async_app(scope, receive, send)
+    else:
+        await _flask_asgi(scope, receive, send)
@@ -0,0 +1,92 @@
+import os
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from database_queries import (
+    DB_CONFIG, REPLICA_CONFIG, DB_MIN_CONN,
+    PROFESSORS_LIST_SQL, STUDENTS_LIST_SQL, COURSES_LIST_SQL, CLASSES_LIST_SQL,
+    CLASSES_FOR_REGISTRATION_SQL, STUDENT_SEARCH_SQL, CLASS_AVAILABILITY_SQL, LIVE_DASHBOARD_SQL,
+    build_registrations_list_query
+)
+
+# ==================== لایه دسترسی ناهمگام به داده ====================
+# نسخه asyncio توابع پرترافیک database_queries با psycopg 3؛ متن پرس‌وجوها از
+# همان ماژول گرفته می‌شود تا دو نسخه از هم جدا نشوند. درخواست‌ها هنگام انتظار
+# برای اتصال یا نتیجه پرس‌وجو رشته‌ای را اشغال نمی‌کنند.
+
+DB_ASYNC_MAX_CONN = int(os.getenv('DB_ASYNC_MAX_CONN', '20'))
+
+def _conninfo(config):
+    return make_conninfo(host=config['host'], port=config['port'], dbname=config['database'],
+                         user=config['user'], password=config['password'])
+
+_pools = {}
+
+async def open_pools():
+    """ایجاد pool اتصال‌های ناهمگام (هنگام راه‌اندازی برنامه ASGI)"""
+    configs = {'primary': DB_CONFIG}
+    if REPLICA_CONFIG:
+        configs['replica'] = REPLICA_CONFIG
+    for name, config in configs.items():
+        if name not in _pools:
+            _pools[name] = AsyncConnectionPool(_conninfo(config), min_size=DB_MIN_CONN,
+                                               max_size=DB_ASYNC_MAX_CONN, open=False,
+                                               kwargs={'row_factory': dict_row})
+            await _pools[name].open(wait=False)
+
+async def close_pools():
+    """بستن pool‌ها هنگام خاموش شدن برنامه"""
+    for name in list(_pools):
+        await _pools.pop(name).close()
+
+async def _fetch(query, params=None, readonly=True, one=False):
+    """اجرای پرس‌وجوی خواندنی؛ در صورت خطای replica دوباره روی primary اجرا می‌شود"""
+    names = ['replica', 'primary'] if readonly and 'replica' in _pools else ['primary']
+    for name in names:
+        try:
+            async with _pools[name].connection() as conn:
+                cursor = await conn.execute(query, params)
+                return await (cursor.fetchone() if one else cursor.fetchall())
+        except psycopg.OperationalError as e:
+            if name == names[-1]:
+                raise
+            print(f"خطا در خواندن از replica؛ استفاده از primary: {e}")
+
+async def get_professors_list(branch_id=None, readonly=True):
+    """دریافت لیست اساتید"""
+    return await _fetch(PROFESSORS_LIST_SQL, {'branch_id': branch_id}, readonly=readonly)
+
+async def get_students_list(branch_id=None, readonly=True):
+    """دریافت لیست دانش‌آموزان"""
+    return await _fetch(STUDENTS_LIST_SQL, {'branch_id': branch_id}, readonly=readonly)
+
+async def get_courses_list(branch_id=None, readonly=True):
+    """دریافت لیست دوره‌ها"""
+    return await _fetch(COURSES_LIST_SQL, {'branch_id': branch_id}, readonly=readonly)
+
+async def get_classes_list(branch_id=None, readonly=True):
+    """دریافت لیست کلاس‌ها"""
+    return await _fetch(CLASSES_LIST_SQL, {'branch_id': branch_id}, readonly=readonly)
+
+async def get_registrations_list(filters=None, readonly=True):
+    """دریافت لیست ثبت‌نام‌ها با فیلتر"""
+    query, params = build_registrations_list_query(filters)
+    return await _fetch(query, params, readonly=readonly)
+
+async def get_classes_for_registration(branch_id=None, readonly=True):
+    """دریافت لیست کلاس‌ها برای فیلتر ثبت‌نام"""
+    return await _fetch(CLASSES_FOR_REGISTRATION_SQL, {'branch_id': branch_id}, readonly=readonly)
+
+async def api_search_students_db(query, limit=10, readonly=True):
+    """جستجوی سریع دانش‌آموزان برای API"""
+    pattern = f'%{query}%'
+    return await _fetch(STUDENT_SEARCH_SQL, (pattern, pattern, pattern, limit), readonly=readonly)
+
+async def get_class_availability_db(class_id, readonly=True):
+    """بررسی ظرفیت کلاس برای API"""
+    return await _fetch(CLASS_AVAILABILITY_SQL, (class_id, class_id), readonly=readonly, one=True)
+
+async def get_live_dashboard_stats(readonly=True):
+    """آمار کامل داشبورد در یک پرس‌وجو"""
+    return await _fetch(LIVE_DASHBOARD_SQL, ('تکمیل',), readonly=readonly, one=True)
@@ -0,0 +1,220 @@
+import atexit
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from database_queries import get_db_connection, copy_audit_rows
+
+# ==================== ثبت ناهمگام گزارش تغییرات ====================
+# مسیرها پس از commit هر تغییر را در یک صف محدود داخل حافظه می‌گذارند و منتظر
+# نوشتن آن نمی‌مانند. یک رشته پس‌زمینه صف را به صورت دسته‌ای (تا AUDIT_BATCH_SIZE
+# ردیف یا هر AUDIT_FLUSH_SECONDS) با یک COPY در audit_log می‌نویسد.
+#
+# حافظه محدود است: اگر صف پر باشد (مثلاً هنگام قطع پایگاه داده) ردیف‌ها به جای
+# حذف شدن به فایل AUDIT_SPOOL_PATH افزوده می‌شوند. هنگام خاموش شدن صف تخلیه
+# می‌شود و هر چه نوشته نشود در همان فایل می‌ماند تا در اجرای بعد ثبت شود.
+#
+# هر فرایند پیش از ثبت، فایل را به AUDIT_SPOOL_PATH.<pid> منتقل می‌کند؛ فایلی که
+# فرایند صاحب آن پیش از ثبت متوقف شده باشد در شروع فرایند بعدی ثبت می‌شود. خطوط
+# خراب (مثلاً نیمه‌نوشته هنگام قطع برق) به AUDIT_SPOOL_PATH.rejected منتقل می‌شوند.
+
+AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', '10000'))
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '500'))
+AUDIT_FLUSH_SECONDS = float(os.getenv('AUDIT_FLUSH_SECONDS', '1'))
+AUDIT_RETRY_SECONDS = 5
+AUDIT_REPLAY_SECONDS = 60
+AUDIT_SPOOL_PATH = os.getenv('AUDIT_SPOOL_PATH', 'audit_spool.jsonl')
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _json(image):
+    if image is None:
+        return None
+    if hasattr(image, 'keys'):
+        image = dict(image)
+    return json.dumps(image, ensure_ascii=False, default=str)
+
+class AuditLogger:
+    """صف گزارش تغییرات و رشته نویسنده دسته‌ای آن"""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._spool_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._conn = None
+        self._orphans_checked = False
+
+    def start(self):
+        """راه‌اندازی رشته نویسنده (با اولین رکورد، پس از fork در هر کارگر)"""
+        with self._lock:
+            if self._stopping.is_set():
+                return
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True, name='audit-writer')
+                self._thread.start()
+
+    def record(self, entity, action, entity_id=None, before=None, after=None, actor=None, remote_addr=None):
+        """افزودن یک تغییر به صف (بدون انتظار برای پایگاه داده)"""
+        row = (datetime.now().isoformat(sep=' '), actor, remote_addr, action, entity,
+               None if entity_id is None else str(entity_id), _json(before), _json(after))
+        if self._stopping.is_set():
+            self._spool([row])
+            return
+        self.start()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self._spool([row])
+
+    def stop(self, timeout=10):
+        """تخلیه صف هنگام خاموش شدن؛ ردیف‌های نوشته‌نشده در فایل spool می‌مانند"""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        self._spool(self._drain())
+
+    def _drain(self, limit=None):
+        rows = []
+        while limit is None or len(rows) < limit:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _next_batch(self):
+        """انتظار برای اولین ردیف و جمع کردن ردیف‌های بعدی تا پر شدن دسته یا پایان مهلت"""
+        try:
+            batch = [self._queue.get(timeout=AUDIT_FLUSH_SECONDS)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + AUDIT_FLUSH_SECONDS
+        while len(batch) < AUDIT_BATCH_SIZE and not self._stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch + self._drain(AUDIT_BATCH_SIZE - len(batch))
+
+    def _write(self, rows):
+        """نوشتن یک دسته با اتصال اختصاصی رشته (اتصال مجدد در صورت قطع)"""
+        try:
+            if self._conn is None or self._conn.closed:
+                self._conn = get_db_connection()
+                if self._conn is None:
+                    return False
+            copy_audit_rows(self._conn, rows)
+            self._conn.commit()
+            return True
+        except Exception as e:
+            print(f"خطا در ثبت گزارش تغییرات: {e}")
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+            return False
+
+    def _flush(self, rows):
+        for start in range(0, len(rows), AUDIT_BATCH_SIZE):
+            batch = rows[start:start + AUDIT_BATCH_SIZE]
+            while not self._write(batch):
+                if self._stopping.is_set():
+                    self._spool(rows[start:])
+                    return
+                self._stopping.wait(AUDIT_RETRY_SECONDS)
+
+    def _spool(self, rows):
+        """افزودن ردیف‌ها به فایل spool (JSON هر ردیف در یک خط)"""
+        if not rows:
+            return
+        with self._spool_lock:
+            with open(AUDIT_SPOOL_PATH, 'a', encoding='utf-8') as spool:
+                for row in rows:
+                    spool.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+    def _replay_file(self, path):
+        """ثبت ردیف‌های یک فایل ادعاشده و حذف آن"""
+        rows = []
+        rejected = []
+        with open(path, encoding='utf-8') as spool:
+            for line in spool:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(tuple(json.loads(line)))
+                except json.JSONDecodeError:
+                    rejected.append(line if line.endswith('\n') else line + '\n')
+        if rejected:
+            print(f"{len(rejected)} خط نامعتبر فایل spool به {AUDIT_SPOOL_PATH}.rejected منتقل شد")
+            with open(f'{AUDIT_SPOOL_PATH}.rejected', 'a', encoding='utf-8') as output:
+                output.writelines(rejected)
+        if rows:
+            print(f"ثبت {len(rows)} ردیف گزارش تغییرات از فایل spool")
+            self._flush(rows)
+        os.remove(path)
+
+    def _orphaned_claims(self):
+        """فایل‌های ادعاشده فرایندهایی که دیگر اجرا نمی‌شوند"""
+        orphans = []
+        for path in glob.glob(f'{glob.escape(AUDIT_SPOOL_PATH)}.*'):
+            pid = path[len(AUDIT_SPOOL_PATH) + 1:]
+            if pid.isdigit() and int(pid) != os.getpid() and not _process_alive(int(pid)):
+                orphans.append(path)
+        return orphans
+
+    def _replay_spool(self):
+        """ثبت ردیف‌های باقی‌مانده از اجرای قبل یا سرریز صف"""
+        claimed = f'{AUDIT_SPOOL_PATH}.{os.getpid()}'
+        if not self._orphans_checked:
+            self._orphans_checked = True
+            # فایل همین pid متعلق به فرایند متوقف‌شده‌ای با همان شماره است
+            if os.path.exists(claimed):
+                self._replay_file(claimed)
+            for path in self._orphaned_claims():
+                # انتقال اتمی؛ اگر فرایند دیگری زودتر ادعا کرده باشد فایل وجود ندارد
+                try:
+                    os.replace(path, claimed)
+                except FileNotFoundError:
+                    continue
+                self._replay_file(claimed)
+        with self._spool_lock:
+            try:
+                os.replace(AUDIT_SPOOL_PATH, claimed)
+            except FileNotFoundError:
+                return
+        self._replay_file(claimed)
+
+    def _run(self):
+        replayed_at = 0.0
+        while True:
+            # سرریزهای صف و باقی‌مانده اجرای قبل به صورت دوره‌ای ثبت می‌شوند
+            if not self._stopping.is_set() and time.monotonic() - replayed_at >= AUDIT_REPLAY_SECONDS:
+                self._replay_spool()
+                replayed_at = time.monotonic()
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+            elif self._stopping.is_set():
+                break
+        if self._conn is not None:
+            self._conn.close()
+
+audit_log = AuditLogger()
+atexit.register(audit_log.stop)
@@ -0,0 +1,98 @@
+import argparse
+import tracemalloc
+from datetime import date, datetime
+from psycopg2.extras import DictCursor, DictRow
+from database_queries import get_db_connection, build_registrations_list_query, record_type, RecordCursor
+
+# ==================== مقایسه حافظه DictRow و Record ====================
+# اجرا: python bench_row_memory.py --rows 50000
+# با اتصال به پایگاه داده لیست واقعی ثبت‌نام‌ها با هر دو cursor خوانده می‌شود؛
+# در غیر این صورت (یا با --synthetic) ردیف‌هایی با همان ستون‌ها ساخته می‌شوند.
+
+REGISTRATION_COLUMNS = (
+    'registration_id', 'membership_id', 'class_id', 'registration_date', 'payment_id',
+    'student_name', 'student_phone', 'course_title', 'course_level',
+    'class_time', 'class_days', 'start_date', 'professor_name',
+    'amount', 'payment_status', 'payment_method', 'payment_date'
+)
+
+def _synthetic_values(count):
+    return [
+        (i, 1000 + i, i % 40, datetime(2024, 1, 1, 10, 0), i,
+         f'دانش‌آموز {i}', f'0912{i:07d}', 'زبان انگلیسی', 'متوسط',
+         '16:00-17:30', 'شنبه، دوشنبه', date(2024, 2, 1), 'استاد نمونه',
+         2500000, 'تکمیل', 'کارت به کارت', date(2024, 1, 2))
+        for i in range(count)
+    ]
+
+class _Description:
+    """جایگزین cursor برای ساخت DictRow بدون پایگاه داده"""
+    def __init__(self, columns):
+        self.description = columns
+        self.index = {name: i for i, name in enumerate(columns)}
+
+def _dict_rows(values):
+    fake = _Description(REGISTRATION_COLUMNS)
+    rows = []
+    for value in values:
+        row = DictRow(fake)
+        row[:] = value
+        rows.append(row)
+    return rows
+
+def _records(values):
+    return list(map(record_type(REGISTRATION_COLUMNS), values))
+
+def _fetch(conn, cursor_factory, count):
+    query, params = build_registrations_list_query()
+    cursor = conn.cursor(cursor_factory=cursor_factory)
+    cursor.execute(query + ' LIMIT %s', params + [count])
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def measure(build):
+    """حافظه نگه‌داشته‌شده و بیشینه حافظه هنگام ساخت لیست (بایت)"""
+    tracemalloc.start()
+    rows = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(rows), current, peak
+
+def main():
+    parser = argparse.ArgumentParser(description='مقایسه حافظه ردیف‌های لیست ثبت‌نام‌ها')
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--synthetic', action='store_true', help='بدون پایگاه داده')
+    args = parser.parse_args()
+
+    conn = None if args.synthetic else get_db_connection()
+    if conn:
+        source = 'پایگاه داده'
+        builds = {
+            'DictRow': lambda: _fetch(conn, DictCursor, args.rows),
+            'Record': lambda: _fetch(conn, RecordCursor, args.rows),
+        }
+    else:
+        source = 'ردیف‌های ساختگی'
+        values = _synthetic_values(args.rows)
+        builds = {
+            'DictRow': lambda: _dict_rows(values),
+            'Record': lambda: _records(values),
+        }
+
+    print(f"منبع: {source}")
+    results = {}
+    for name, build in builds.items():
+        count, current, peak = measure(build)
+        results[name] = current
+        print(f"{name:8} ردیف: {count:7}  حافظه: {current / 1024:10.1f} KB  بیشینه: {peak / 1024:10.1f} KB  "
+              f"هر ردیف: {current / max(count, 1):6.1f} B")
+
+    if results['DictRow']:
+        print(f"کاهش حافظه: {100 * (1 - results['Record'] / results['DictRow']):.1f}%")
+
+    if conn:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import sys
+from datetime import date
+from database_queries import (
+    get_db_connection, init_db_schema, get_branches, get_term_partitioned_tables,
+    create_term_partitions, term_start, term_after, add_partition_reference, TERM_PARTITIONS_AHEAD
+)
+
+# ==================== پارتیشن‌بندی جداول بر اساس شعبه و ترم ====================
+# اجرا (یک بار، در زمان کم‌ترافیک): python branch_partitions.py
+#
+# جداول پرحجم ثبت‌نام و پرداخت به جدول پارتیشن‌شده LIST (branch_id) تبدیل
+# می‌شوند و پارتیشن هر شعبه خود بر اساس تاریخ به پارتیشن‌های ترمی (RANGE)
+# تقسیم می‌شود:
+#
+#   registrations
+#   ├── registrations_branch_1            (branch_id = 1)
+#   │   ├── registrations_branch_1_2025_01
+#   │   ├── ...
+#   │   └── registrations_branch_1_default
+#   └── registrations_branch_default      (شعبه‌های بدون پارتیشن)
+#
+# پرس‌وجوهای یک شعبه و یک بازه زمانی فقط پارتیشن‌های همان شعبه و ترم‌ها را
+# می‌خوانند و نمای ستاد بدون تغییر روی جدول اصلی اجرا می‌شود. ترم‌های تمام‌شده
+# با archive_terms.py جدا و بایگانی می‌شوند.
+#
+# کلید اصلی جدول پارتیشن‌شده باید ستون‌های پارتیشن (branch_id و تاریخ) را شامل
+# شود، بنابراین کلیدهای خارجی ورودی به این جداول ممکن نیست؛ هر کلید خارجی با
+# رفتار ON DELETE خود در partition_references ثبت و با trigger جایگزین می‌شود.
+# کل تبدیل، همراه با ساخت دوباره triggerهای جداول جدید، در یک تراکنش انجام
+# می‌شود و در صورت خطا هیچ تغییری باقی نمی‌ماند (خروجی اسکریپت 1).
+# اجرای دوباره جداولی را که قبلاً فقط بر اساس شعبه پارتیشن شده‌اند به ساختار
+# ترمی تبدیل می‌کند.
+
+# ترتیب مهم است: ثبت‌نام‌ها به پرداخت‌ها ارجاع می‌دهند
+PARTITIONED_TABLES = [
+    ('payments', 'payment_id', 'payment_date'),
+    ('registrations', 'registration_id', 'registration_date'),
+]
+
+# رفتار ON DELETE کلید خارجی (confdeltype)؛ بقیه حالت‌ها مانع حذف ردیف مرجع می‌شوند
+FK_ACTIONS = {'c': 'CASCADE', 'n': 'SET NULL'}
+
+def _incoming_foreign_keys(cursor, table):
+    """کلیدهای خارجی جداول دیگر که به جدول ارجاع می‌دهند: (نام، جدول، ستون یا None، رفتار حذف)"""
+    cursor.execute('''
+        SELECT con.conname, con.conrelid::regclass::text,
+               CASE WHEN array_length(con.conkey, 1) = 1 THEN att.attname END, con.confdeltype
+        FROM pg_constraint con
+        JOIN pg_attribute att ON att.attrelid = con.conrelid AND att.attnum = con.conkey[1]
+        WHERE con.contype = 'f' AND con.confrelid = %s::regclass AND con.conrelid <> con.confrelid
+          AND con.conparentid = 0
+        ORDER BY con.conname
+    ''', (table,))
+    return cursor.fetchall()
+
+def _outgoing_foreign_keys(cursor, table):
+    """کلیدهای خارجی جدول، به جز ارجاع به جداول پارتیشن‌شده ترمی"""
+    cursor.execute('''
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE contype = 'f' AND conrelid = %s::regclass AND conparentid = 0
+          AND confrelid::regclass::text <> ALL(%s)
+        ORDER BY conname
+    ''', (table, [name for name, _, _ in PARTITIONED_TABLES]))
+    return cursor.fetchall()
+
+def _secondary_indexes(cursor, table):
+    """تعریف ایندکس‌های غیر از کلید اصلی"""
+    cursor.execute('''
+        SELECT i.indisunique, pg_get_indexdef(i.indexrelid), c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass AND NOT i.indisprimary
+        ORDER BY c.relname
+    ''', (table,))
+    return cursor.fetchall()
+
+def _partitions(cursor, table):
+    """همه پارتیشن‌های یک جدول (در همه سطح‌ها)"""
+    cursor.execute('''
+        SELECT relid::regclass::text FROM pg_partition_tree(%s::regclass)
+        WHERE relid <> %s::regclass
+    ''', (table, table))
+    return [row[0] for row in cursor.fetchall()]
+
+def _is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass", (table,))
+    return cursor.fetchone()[0]
+
+def _date_range(cursor, table, column):
+    cursor.execute(f'SELECT MIN({column})::date, MAX({column})::date FROM {table}')
+    return cursor.fetchone()
+
+def partition_table(cursor, table, key, column, branch_ids):
+    """تبدیل یک جدول به جدول پارتیشن‌شده بر اساس branch_id و ترم"""
+    old_table = f'{table}_unpartitioned'
+    outgoing = _outgoing_foreign_keys(cursor, table)
+    indexes = _secondary_indexes(cursor, table)
+    cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', (table, key))
+    sequence = cursor.fetchone()[0]
+
+    for name, referencing, column, delete_type in _incoming_foreign_keys(cursor, table):
+        cursor.execute(f'ALTER TABLE {referencing} DROP CONSTRAINT {name}')
+        if column is None:
+            print(f"هشدار: کلید خارجی چندستونی {name} از {referencing} به {table} حذف شد")
+            continue
+        add_partition_reference(cursor.connection, referencing, column, table, key,
+                                FK_ACTIONS.get(delete_type, 'RESTRICT'))
+        print(f"{referencing}: کلید خارجی {name} به {table} با trigger جایگزین شد")
+
+    # پارتیشن‌های ساختار قبلی (پارتیشن فقط بر اساس شعبه) تغییر نام می‌دهند
+    if _is_partitioned(cursor, table):
+        for partition in _partitions(cursor, table):
+            cursor.execute(f'ALTER TABLE {partition} RENAME TO {partition}_unpartitioned')
+    cursor.execute(f'ALTER TABLE {table} RENAME TO {old_table}')
+
+    # کلید اصلی شامل تاریخ است؛ تاریخ خالی با تاریخ روز پر می‌شود
+    cursor.execute(f'UPDATE {old_table} SET {column} = CURRENT_DATE WHERE {column} IS NULL')
+    if cursor.rowcount:
+        print(f"{table}: تاریخ خالی {cursor.rowcount} ردیف با تاریخ امروز پر شد")
+
+    cursor.execute(f'''
+        CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY LIST (branch_id)
+    ''')
+    first_day, last_day = _date_range(cursor, old_table, column)
+    current = term_start(date.today())
+    first_day = min(first_day or current, current)
+    last_day = max(last_day or current, term_after(current, TERM_PARTITIONS_AHEAD))
+
+    for branch_id in branch_ids:
+        parent = f'{table}_branch_{branch_id}'
+        cursor.execute(f'''
+            CREATE TABLE {parent} PARTITION OF {table} FOR VALUES IN ({branch_id})
+            PARTITION BY RANGE ({column})
+        ''')
+        cursor.execute(f'CREATE TABLE {parent}_default PARTITION OF {parent} DEFAULT')
+        create_term_partitions(cursor.connection, parent, first_day, last_day)
+    cursor.execute(f'CREATE TABLE {table}_branch_default PARTITION OF {table} DEFAULT')
+
+    cursor.execute(f'INSERT INTO {table} SELECT * FROM {old_table}')
+    print(f"{table}: {cursor.rowcount} ردیف منتقل شد")
+    if sequence:
+        # sequence نباید همراه جدول قدیمی حذف شود
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.{key}')
+    cursor.execute(f'DROP TABLE {old_table}')
+
+    # پس از حذف جدول قدیمی نام کلید اصلی و ایندکس‌ها آزاد است
+    cursor.execute(f'ALTER TABLE {table} ADD PRIMARY KEY ({key}, branch_id, {column})')
+    for name, definition in outgoing:
+        cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition}')
+    for unique, definition, name in indexes:
+        if unique:
+            print(f"هشدار: ایندکس یکتای {name} بدون ستون‌های پارتیشن ممکن نیست و حذف شد")
+            continue
+        # تعریف پیش از تغییر نام خوانده شده و به نام جدول جدید اشاره می‌کند
+        cursor.execute(definition.replace(' ON ONLY ', ' ON '))
+
+def main():
+    conn = get_db_connection()
+    if not conn:
+        print("خطا: اتصال به دیتابیس برقرار نشد")
+        return 1
+
+    try:
+        # جدول شعبه‌ها و ستون branch_id باید پیش از تبدیل وجود داشته باشند
+        if not init_db_schema(conn):
+            print("خطا: ساخت جداول جانبی ناموفق بود؛ پارتیشن‌بندی انجام نشد")
+            return 1
+        done = set(get_term_partitioned_tables(conn))
+        branch_ids = [branch.branch_id for branch in get_branches(conn)]
+
+        cursor = conn.cursor()
+        for table, key, column in PARTITIONED_TABLES:
+            if table in done:
+                print(f"{table}: قبلاً پارتیشن شده است")
+                continue
+            partition_table(cursor, table, key, column, branch_ids)
+        cursor.close()
+
+        # DROP TABLE جدول قدیمی triggerهای آن را هم حذف کرده است؛ triggerها (از جمله
+        # ارجاع‌های partition_references، outbox و اعلان‌ها) و ایندکس‌های ثبت‌شده در
+        # همین تراکنش روی جداول جدید ساخته می‌شوند تا هیچ نوشتنی بدون آن‌ها انجام نشود
+        if not init_db_schema(conn, commit=False):
+            raise RuntimeError('ساخت دوباره triggerها روی جداول جدید ناموفق بود')
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"خطا در پارتیشن‌بندی جداول: {e}")
+        return 1
+    else:
+        print("پارتیشن‌بندی با موفقیت انجام شد")
+        return 0
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
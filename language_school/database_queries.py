@@ -1,8 +1,18 @@
 import psycopg2
+from psycopg2 import pool
 from psycopg2.extras import DictCursor
-from datetime import datetime
+from psycopg2.extensions import cursor as _cursor
+from datetime import datetime, date
+import csv
+import io
 import os
+import time
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
 from dotenv import load_dotenv
+from scheduling import invalidate_schedule_index
 
 load_dotenv()
 
@@ -15,8 +25,85 @@ DB_CONFIG = {
     'password': os.getenv('DB_PASSWORD', 'Zahra123456')
 }
 
-def get_db_connection():
-    """اتصال به PostgreSQL"""
+# تنظیمات replica فقط‌خواندنی (اختیاری)؛ با تعیین DB_REPLICA_HOST فعال می‌شود و
+# سایر مقادیر در صورت عدم تعیین از DB_CONFIG گرفته می‌شوند
+REPLICA_CONFIG = dict(DB_CONFIG,
+    host=os.getenv('DB_REPLICA_HOST'),
+    port=int(os.getenv('DB_REPLICA_PORT', DB_CONFIG['port'])),
+    database=os.getenv('DB_REPLICA_NAME', DB_CONFIG['database']),
+    user=os.getenv('DB_REPLICA_USER', DB_CONFIG['user']),
+    password=os.getenv('DB_REPLICA_PASSWORD', DB_CONFIG['password'])
+) if os.getenv('DB_REPLICA_HOST') else None
+
+# حداکثر تأخیر مجاز replica (ثانیه) و فاصله بررسی دوباره وضعیت آن
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('DB_REPLICA_MAX_LAG', '5'))
+REPLICA_CHECK_SECONDS = 5
+_replica_state = {'healthy': True, 'checked_at': 0.0}
+
+def _replica_lag(conn):
+    """تأخیر replica نسبت به primary بر حسب ثانیه (صفر اگر همه WAL دریافتی اعمال شده باشد)"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    ''')
+    lag = float(cursor.fetchone()[0])
+    cursor.close()
+    conn.rollback()
+    return lag
+
+def _replica_recheck_due(now):
+    return now - _replica_state['checked_at'] >= REPLICA_CHECK_SECONDS
+
+def _check_replica_lag(conn, now):
+    """بررسی تأخیر replica با اتصال conn و ثبت نتیجه؛ True اگر قابل استفاده باشد"""
+    lag = _replica_lag(conn)
+    _replica_state['checked_at'] = now
+    _replica_state['healthy'] = lag <= REPLICA_MAX_LAG_SECONDS
+    if not _replica_state['healthy']:
+        print(f"تأخیر replica ({lag:.1f} ثانیه) بیش از حد مجاز است؛ خواندن از primary")
+    return _replica_state['healthy']
+
+def _replica_failed(error):
+    print(f"خطا در اتصال به replica؛ خواندن از primary: {error}")
+    _replica_state['healthy'] = False
+    _replica_state['checked_at'] = time.monotonic()
+
+def _get_replica_connection():
+    """اتصال به replica؛ در صورت قطع بودن یا تأخیر زیاد None برمی‌گرداند"""
+    now = time.monotonic()
+    recheck = _replica_recheck_due(now)
+    if not _replica_state['healthy'] and not recheck:
+        return None
+    
+    conn = None
+    try:
+        conn = psycopg2.connect(connect_timeout=2, **REPLICA_CONFIG)
+        if recheck and not _check_replica_lag(conn, now):
+            conn.close()
+            return None
+        conn.set_session(readonly=True)
+        return conn
+    except Exception as e:
+        _replica_failed(e)
+        if conn:
+            conn.close()
+        return None
+
+def get_db_connection(readonly=False):
+    """اتصال به PostgreSQL
+    
+    readonly=True: برای توابع فقط‌خواندنی؛ در صورت تنظیم replica و سالم بودن
+    آن، اتصال به replica برگردانده می‌شود و در غیر این صورت به primary.
+    """
+    if readonly and REPLICA_CONFIG:
+        conn = _get_replica_connection()
+        if conn:
+            return conn
+    
     try:
         conn = psycopg2.connect(**DB_CONFIG)
         return conn
@@ -24,29 +111,740 @@ def get_db_connection():
         print(f" خطا در اتصال به پایگاه داده: {e}")
         return None
 
+# ==================== Connection Pool ====================
+# اتصال‌های مشترک برای اجرای همزمان پرس‌وجوهای یک صفحه (page_data)، کلیدهای
+# idempotency و گرم کردن فرایند
+DB_MIN_CONN = int(os.getenv('DB_MIN_CONN', '1'))
+DB_MAX_CONN = int(os.getenv('DB_MAX_CONN', '10'))
+# حداکثر انتظار (ثانیه) برای آزاد شدن یک اتصال وقتی همه اتصال‌های pool در حال استفاده‌اند
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+_pools = {}
+_pools_lock = threading.Lock()
+
+class BlockingConnectionPool(pool.ThreadedConnectionPool):
+    """ThreadedConnectionPool که در صورت تمام شدن اتصال‌ها به جای PoolError منتظر می‌ماند
+    
+    هر getconn یکی از maxconn جایگاه را می‌گیرد و putconn آن را آزاد می‌کند؛ پس از
+    DB_POOL_TIMEOUT ثانیه انتظار همان PoolError قبلی داده می‌شود.
+    """
+    
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+    
+    def getconn(self, key=None, timeout=None):
+        """timeout=None: انتظار تا DB_POOL_TIMEOUT ثانیه؛ timeout=0: بدون انتظار"""
+        timeout = DB_POOL_TIMEOUT if timeout is None else timeout
+        acquired = self._slots.acquire(timeout=timeout) if timeout > 0 else self._slots.acquire(blocking=False)
+        if not acquired:
+            raise pool.PoolError(f"اتصال آزادی در pool نیست (انتظار {timeout:g} ثانیه)")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+    
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+def _get_pool(readonly):
+    """pool مربوط به replica (در صورت تنظیم و سالم بودن یا رسیدن زمان بررسی دوباره) یا primary"""
+    with _pools_lock:
+        if readonly and REPLICA_CONFIG and (_replica_state['healthy'] or _replica_recheck_due(time.monotonic())):
+            if 'replica' not in _pools:
+                try:
+                    _pools['replica'] = BlockingConnectionPool(DB_MIN_CONN, DB_MAX_CONN, **REPLICA_CONFIG)
+                except psycopg2.Error as e:
+                    _replica_failed(e)
+            if 'replica' in _pools:
+                return 'replica', _pools['replica']
+        
+        if 'primary' not in _pools:
+            _pools['primary'] = BlockingConnectionPool(DB_MIN_CONN, DB_MAX_CONN, **DB_CONFIG)
+        return 'primary', _pools['primary']
+
+def _checkout_replica(db_pool):
+    """اتصال replica از pool با همان بررسی تأخیر get_db_connection؛ None برای خواندن از primary"""
+    now = time.monotonic()
+    conn = None
+    try:
+        # بدون انتظار؛ اگر اتصال آزاد replica نباشد از primary خوانده می‌شود
+        conn = db_pool.getconn(timeout=0)
+        if not conn.readonly:
+            conn.set_session(readonly=True)
+        if _replica_recheck_due(now) and not _check_replica_lag(conn, now):
+            db_pool.putconn(conn)
+            return None
+        return conn
+    except pool.PoolError as e:
+        print(f"اتصال آزاد replica در pool نیست؛ خواندن از primary: {e}")
+        return None
+    except psycopg2.Error as e:
+        _replica_failed(e)
+        if conn is not None:
+            db_pool.putconn(conn, close=True)
+        return None
+
+@contextmanager
+def pooled_connection(readonly=False):
+    """گرفتن اتصال از pool و بازگرداندن آن (تراکنش باز در پایان rollback می‌شود)
+    
+    readonly=True: اتصال replica در صورت سالم بودن و تأخیر مجاز، و در غیر این
+    صورت primary. خطای اتصال replica در حین استفاده آن را تا بررسی بعدی کنار
+    می‌گذارد (تکرار خواندن روی primary با فراخواننده است، مثل page_data).
+    """
+    name, db_pool = _get_pool(readonly)
+    conn = _checkout_replica(db_pool) if name == 'replica' else None
+    if conn is None:
+        name, db_pool = _get_pool(False)
+        conn = db_pool.getconn()
+    try:
+        yield conn
+    except psycopg2.OperationalError as e:
+        if name == 'replica':
+            _replica_failed(e)
+        raise
+    finally:
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        db_pool.putconn(conn, close=broken)
+
+def close_pools(close=True):
+    """کنار گذاشتن pool‌ها
+    
+    close=False برای فرایند فرزند پس از fork: اتصال‌های به ارث رسیده متعلق به
+    فرایند والد هستند و بستن آن‌ها اتصال والد را هم قطع می‌کند؛ فقط رها می‌شوند.
+    """
+    with _pools_lock:
+        if close:
+            for db_pool in _pools.values():
+                db_pool.closeall()
+        _pools.clear()
+
+# ==================== واحد کار (Unit of Work) ====================
+class UnitOfWork:
+    """تراکنش در سطح درخواست
+    
+    توابع کمکی دیگر commit نمی‌کنند؛ دستورات تغییردهنده‌ای که خروجی ندارند
+    (از طریق _write) در صف می‌مانند و پیش از اولین خواندن بعدی یا هنگام commit
+    همگی در یک رفت‌وبرگشت به پایگاه داده ارسال می‌شوند. مسیر (route) در پایان
+    فقط یک بار commit می‌کند و کارهای وابسته به commit (مثل باطل کردن کش)
+    پس از آن اجرا می‌شوند.
+    
+    سایر متدهای اتصال (close، notifies و ...) به اتصال اصلی ارجاع داده می‌شوند.
+    """
+    
+    def __init__(self, conn, batch_size=100):
+        self.conn = conn
+        self.batch_size = batch_size
+        self._pending = []
+        self._after_commit = []
+    
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+    
+    def cursor(self, *args, **kwargs):
+        # دستورات صف‌شده باید پیش از هر خواندن اجرا شوند تا ترتیب حفظ شود
+        self.flush()
+        return self.conn.cursor(*args, **kwargs)
+    
+    def execute(self, query, params=None):
+        """افزودن یک دستور به صف"""
+        cursor = self.conn.cursor()
+        self._pending.append(cursor.mogrify(query, params))
+        cursor.close()
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        """ارسال دستورات صف‌شده در یک رفت‌وبرگشت"""
+        if not self._pending:
+            return
+        statements, self._pending = self._pending, []
+        cursor = self.conn.cursor()
+        cursor.execute(b';\n'.join(statements))
+        cursor.close()
+    
+    def after_commit(self, callback):
+        """ثبت کاری که فقط پس از commit موفق اجرا می‌شود"""
+        self._after_commit.append(callback)
+    
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+    
+    def rollback(self):
+        self._pending = []
+        self._after_commit = []
+        self.conn.rollback()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+def get_unit_of_work():
+    """اتصال جدید در قالب یک واحد کار (None در صورت خطای اتصال)"""
+    conn = get_db_connection()
+    return UnitOfWork(conn) if conn else None
+
+def _write(conn, query, params=None):
+    """اجرای دستور تغییردهنده بدون خروجی؛ در واحد کار تا ارسال گروهی صف می‌شود"""
+    if isinstance(conn, UnitOfWork):
+        conn.execute(query, params)
+    else:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        cursor.close()
+
+def _on_commit(conn, callback):
+    """اجرای callback پس از commit واحد کار (یا بلافاصله برای اتصال معمولی)"""
+    if isinstance(conn, UnitOfWork):
+        conn.after_commit(callback)
+    else:
+        callback()
+
+def _insert_returning_id(conn, query, params=None):
+    """اجرای INSERT ... RETURNING و برگرداندن شناسه ردیف جدید (None اگر ردیفی درج نشود)"""
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+# ==================== ردیف‌های سبک برای لیست‌ها ====================
+class Record(tuple):
+    """ردیف فقط‌خواندنی با دسترسی از طریق نام ستون (row['name']) و ویژگی (row.name)
+    
+    برخلاف DictRow (یک list به ازای هر ردیف) هر ردیف فقط یک tuple است؛ نام ستون‌ها
+    یک بار برای هر شکل پرس‌وجو در کلاس ساخته‌شده توسط record_type نگهداری می‌شود.
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+    
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+    
+    def __contains__(self, key):
+        return key in self._index
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+    
+    def keys(self):
+        return iter(self._index)
+    
+    def values(self):
+        return (tuple.__getitem__(self, i) for i in self._index.values())
+    
+    def items(self):
+        return ((name, tuple.__getitem__(self, i)) for name, i in self._index.items())
+    
+    def __repr__(self):
+        return f'Record({dict(self.items())})'
+
+@lru_cache(maxsize=256)
+def record_type(fields):
+    """کلاس ردیف برای یک شکل پرس‌وجو (تکرار نام ستون مانند DictRow: آخرین ستون)"""
+    index = {name: i for i, name in enumerate(fields)}
+    namespace = {'__slots__': (), '_fields': fields, '_index': index}
+    for name, i in index.items():
+        if name.isidentifier() and name not in vars(Record):
+            namespace[name] = property(itemgetter(i))
+    return type('Record', (Record,), namespace)
+
+class RecordCursor(_cursor):
+    """cursor با خروجی Record؛ جایگزین DictCursor برای توابع لیست و جستجو"""
+    
+    def _record_type(self):
+        return record_type(tuple(column.name for column in self.description))
+    
+    def fetchone(self):
+        row = super().fetchone()
+        return self._record_type()(row) if row is not None else None
+    
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        return list(map(self._record_type(), rows))
+    
+    def fetchall(self):
+        return list(map(self._record_type(), super().fetchall()))
+    
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+# ==================== ساختار جداول تکمیلی ====================
+# دستورات CREATE ... IF NOT EXISTS جداول جانبی؛ هر بخش جداول خود را ثبت می‌کند
+SCHEMA_STATEMENTS = []
+
+def register_schema(*statements):
+    """ثبت دستورات ساخت جداول جانبی"""
+    SCHEMA_STATEMENTS.extend(statements)
+
+def init_db_schema(conn, commit=True):
+    """ایجاد جداول جانبی در صورت عدم وجود
+    
+    هر دستور در یک SAVEPOINT اجرا می‌شود تا خطای یک بخش ساختار بخش‌های دیگر را
+    برنگرداند؛ دستورات ناموفق گزارش می‌شوند و خروجی False است تا برنامه و
+    اسکریپت‌ها با ساختار ناقص اجرا نشوند.
+    commit: با False تغییرات در تراکنش فراخواننده می‌مانند (branch_partitions.py)
+    """
+    cursor = conn.cursor()
+    failed = 0
+    try:
+        for statement in SCHEMA_STATEMENTS:
+            cursor.execute('SAVEPOINT schema_statement')
+            try:
+                cursor.execute(statement)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT schema_statement')
+                failed += 1
+                print(f"خطا در ایجاد جداول جانبی ({' '.join(statement.split())[:120]}): {e}")
+            else:
+                cursor.execute('RELEASE SAVEPOINT schema_statement')
+        if commit:
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"خطا در ایجاد جداول جانبی: {e}")
+        return False
+    finally:
+        cursor.close()
+    
+    if failed:
+        print(f"{failed} دستور از {len(SCHEMA_STATEMENTS)} دستور ساخت جداول جانبی اجرا نشد")
+    return failed == 0
+
+# ==================== کنترل هم‌زمانی خوش‌بینانه (row_version) ====================
+# فرم ویرایش نسخه رکورد را همراه خود برمی‌گرداند و UPDATE فقط در صورتی انجام می‌شود
+# که نسخه تغییر نکرده باشد (و نسخه را یکی افزایش می‌دهد). تغییر هم‌زمان کاربر
+# دیگر به جای بازنویسی بی‌صدا به صورت تعارض به مسیر گزارش می‌شود. نتیجه و تصویر
+# قبل از تغییر (برای گزارش تغییرات) در همان رفت‌وبرگشت UPDATE مشخص می‌شوند.
+VERSIONED_TABLES = ('professors', 'students', 'courses', 'classes', 'registrations')
+
+for _table in VERSIONED_TABLES:
+    register_schema(f'ALTER TABLE {_table} ADD COLUMN IF NOT EXISTS row_version INTEGER NOT NULL DEFAULT 1')
+
+def _versioned_update(conn, entity, entity_id, assignments, params, row_version=None, branch_id=None):
+    """UPDATE مشروط به row_version و شعبه (هر کدام در صورت تعیین)
+    
+    تصویر رکورد پیش از تغییر را برمی‌گرداند؛ None اگر رکورد هم‌زمان تغییر کرده،
+    حذف شده یا متعلق به شعبه دیگری باشد. ردیف قدیمی در CTE همان دستور خوانده و قفل می‌شود.
+    """
+    key, query = AUDIT_ENTITIES[entity]
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        WITH old AS (
+            {query}
+            WHERE t.{key} = %s AND (%s::integer IS NULL OR t.row_version = %s::integer)
+              AND (%s::integer IS NULL OR t.branch_id = %s::integer)
+            FOR UPDATE OF t
+        )
+        UPDATE {entity} u
+        SET {assignments.strip()}, row_version = u.row_version + 1
+        FROM old
+        WHERE u.{key} = old.entity_id
+        RETURNING old.image
+    ''', (entity_id, row_version, row_version, branch_id, branch_id) + tuple(params))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+# ==================== شعبه‌ها ====================
+# هر ردیف اساتید، دانش‌آموزان، دوره‌ها، کلاس‌ها، ثبت‌نام‌ها و پرداخت‌ها به یک شعبه
+# تعلق دارد. توابع لیست با branch_id=None همه شعبه‌ها (گزارش‌های ستاد) و با
+# شناسه شعبه فقط داده همان شعبه را برمی‌گردانند. ثبت‌نام و پرداخت همیشه شعبه
+# کلاس مربوط را می‌گیرند. تبدیل جداول پرحجم به پارتیشن‌های هر شعبه با
+# branch_partitions.py انجام می‌شود.
+DEFAULT_BRANCH_ID = 1
+BRANCH_TABLES = ('professors', 'students', 'courses', 'classes', 'registrations', 'payments')
+
+register_schema('''
+    CREATE TABLE IF NOT EXISTS branches (
+        branch_id SERIAL PRIMARY KEY,
+        branch_name VARCHAR(100) NOT NULL UNIQUE,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+''', f'''
+    INSERT INTO branches (branch_id, branch_name) VALUES ({DEFAULT_BRANCH_ID}, 'شعبه مرکزی')
+    ON CONFLICT (branch_id) DO NOTHING
+''', '''
+    SELECT setval(pg_get_serial_sequence('branches', 'branch_id'), (SELECT MAX(branch_id) FROM branches))
+''')
+
+for _table in BRANCH_TABLES:
+    register_schema(
+        f'ALTER TABLE {_table} ADD COLUMN IF NOT EXISTS branch_id INTEGER NOT NULL '
+        f'DEFAULT {DEFAULT_BRANCH_ID} REFERENCES branches (branch_id)',
+        f'CREATE INDEX IF NOT EXISTS idx_{_table}_branch ON {_table} (branch_id)'
+    )
+
+def get_branches(conn):
+    """لیست شعبه‌ها"""
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute('SELECT branch_id, branch_name FROM branches ORDER BY branch_id')
+    branches = cursor.fetchall()
+    cursor.close()
+    return branches
+
+def branch_exists(conn, branch_id):
+    """بررسی وجود شعبه"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM branches WHERE branch_id = %s)', (branch_id,))
+    exists = cursor.fetchone()[0]
+    cursor.close()
+    return exists
+
+def _branch_ids(conn, table, key, ids, branch_id):
+    """شناسه‌هایی از ids که به شعبه branch_id تعلق دارند (همه شناسه‌ها اگر branch_id=None باشد)
+    
+    مسیرهای حذف با شناسه پیش از هر تغییری با این تابع به شعبه جاری محدود می‌شوند.
+    """
+    if branch_id is None or not ids:
+        return list(ids)
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT {key} FROM {table} WHERE {key} = ANY(%s) AND branch_id = %s', (list(ids), branch_id))
+    in_branch = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return [i for i in ids if i in in_branch]
+
+def get_partitioned_tables(conn):
+    """جداولی از BRANCH_TABLES که به جدول پارتیشن‌شده تبدیل شده‌اند"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT c.relname FROM pg_class c
+        WHERE c.relkind = 'p' AND c.relname = ANY(%s)
+          AND c.relnamespace = 'public'::regnamespace
+    ''', (list(BRANCH_TABLES),))
+    tables = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return tables
+
+def add_branch_db(conn, branch_name):
+    """افزودن شعبه و ساخت پارتیشن آن در جداول پارتیشن‌شده"""
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO branches (branch_name) VALUES (%s) RETURNING branch_id', (branch_name,))
+    branch_id = cursor.fetchone()[0]
+    cursor.close()
+    
+    term_tables = get_term_partitioned_tables(conn)
+    for table in get_partitioned_tables(conn):
+        parent = f'{table}_branch_{branch_id}'
+        if table not in term_tables:
+            _write(conn, f'''
+                CREATE TABLE IF NOT EXISTS {parent}
+                PARTITION OF {table} FOR VALUES IN ({branch_id})
+            ''')
+            continue
+
+        _write(conn, f'''
+            CREATE TABLE IF NOT EXISTS {parent}
+            PARTITION OF {table} FOR VALUES IN ({branch_id})
+            PARTITION BY RANGE ({TERM_PARTITION_COLUMNS[table]})
+        ''')
+        _write(conn, f'CREATE TABLE IF NOT EXISTS {parent}_default PARTITION OF {parent} DEFAULT')
+        create_term_partitions(conn, parent, date.today(), term_after(term_start(date.today()), TERM_PARTITIONS_AHEAD))
+    return branch_id
+
+# ==================== پارتیشن‌های زمانی (ترم) ====================
+# پارتیشن هر شعبه در جداول ثبت‌نام و پرداخت بر اساس تاریخ به پارتیشن‌های ترمی
+# (سه‌ماهه) تقسیم می‌شود؛ پرس‌وجوهای ترم جاری فقط پارتیشن‌های اخیر را می‌خوانند.
+# پارتیشن ترم‌های آینده هنگام راه‌اندازی برنامه (و با archive_terms.py) ساخته
+# می‌شوند و ترم‌های تمام‌شده با archive_terms.py جدا و به صورت فشرده بایگانی می‌شوند.
+TERM_MONTHS = 3
+TERM_PARTITIONS_AHEAD = int(os.getenv('TERM_PARTITIONS_AHEAD', '2'))
+TERM_PARTITION_COLUMNS = {'registrations': 'registration_date', 'payments': 'payment_date'}
+
+def term_start(day):
+    """تاریخ شروع ترمی که day در آن است"""
+    return date(day.year, (day.month - 1) // TERM_MONTHS * TERM_MONTHS + 1, 1)
+
+def term_after(start, count=1):
+    """تاریخ شروع count ترم بعد (با count منفی، ترم‌های قبل)"""
+    month = start.month - 1 + count * TERM_MONTHS
+    return date(start.year + month // 12, month % 12 + 1, 1)
+
+def term_partition_name(parent, start):
+    return f'{parent}_{start:%Y_%m}'
+
+def get_term_partition_parents(conn):
+    """(جدول، پارتیشن شعبه) برای پارتیشن‌های شعبه‌ای که خود پارتیشن‌شده‌اند"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT p.relname, c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE c.relkind = 'p' AND p.relname = ANY(%s)
+          AND p.relnamespace = 'public'::regnamespace
+        ORDER BY 1, 2
+    ''', (list(TERM_PARTITION_COLUMNS),))
+    parents = cursor.fetchall()
+    cursor.close()
+    return parents
+
+def get_term_partitioned_tables(conn):
+    """جداولی که پارتیشن‌های شعبه آن‌ها بر اساس ترم تقسیم شده‌اند"""
+    return sorted({table for table, _ in get_term_partition_parents(conn)})
+
+def _move_default_rows(cursor, parent, column, name, start, end):
+    """ساخت پارتیشن ترمی که ردیف‌هایش در پارتیشن پیش‌فرض مانده‌اند
+    
+    پارتیشن پیش‌فرض جدا می‌شود (تا triggerهای جدول اصلی برای جابه‌جایی اجرا
+    نشوند)، ردیف‌ها به جدول ترم منتقل می‌شوند و هر دو به جدول اصلی متصل می‌شوند.
+    """
+    default = f'{parent}_default'
+    cursor.execute(f'ALTER TABLE {parent} DETACH PARTITION {default}')
+    cursor.execute(f'CREATE TABLE {name} (LIKE {parent} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    cursor.execute(f'''
+        WITH moved AS (
+            DELETE FROM {default} WHERE {column} >= %s AND {column} < %s RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    ''', (start, end))
+    print(f"{name}: {cursor.rowcount} ردیف از {default} منتقل شد")
+    cursor.execute(f"ALTER TABLE {parent} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+    cursor.execute(f'ALTER TABLE {parent} ATTACH PARTITION {default} DEFAULT')
+
+def create_term_partitions(conn, parent, first_day, last_day):
+    """ساخت پارتیشن ترم‌هایی که first_day تا last_day را پوشش می‌دهند (در صورت عدم وجود)
+    
+    ردیف‌هایی از این ترم‌ها که پیش‌تر در پارتیشن پیش‌فرض ذخیره شده‌اند به پارتیشن
+    ترم منتقل می‌شوند.
+    """
+    column = TERM_PARTITION_COLUMNS[parent.rsplit('_branch_', 1)[0]]
+    default = f'{parent}_default'
+    cursor = conn.cursor()
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (default,))
+    has_default = cursor.fetchone()[0]
+    start = term_start(first_day)
+    while start <= last_day:
+        end = term_after(start)
+        name = term_partition_name(parent, start)
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (name,))
+        if not cursor.fetchone()[0]:
+            has_rows = False
+            if has_default:
+                cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {default} WHERE {column} >= %s AND {column} < %s)',
+                               (start, end))
+                has_rows = cursor.fetchone()[0]
+            if has_rows:
+                _move_default_rows(cursor, parent, column, name, start, end)
+            else:
+                cursor.execute(f'''
+                    CREATE TABLE {name}
+                    PARTITION OF {parent} FOR VALUES FROM ('{start}') TO ('{end}')
+                ''')
+        start = end
+    cursor.close()
+
+def get_default_partition_terms(conn, parent, before):
+    """شروع ترم‌های پیش از before که ردیف‌هایشان در پارتیشن پیش‌فرض مانده‌اند"""
+    column = TERM_PARTITION_COLUMNS[parent.rsplit('_branch_', 1)[0]]
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT DISTINCT date_trunc('month', {column})::date
+        FROM {parent}_default WHERE {column} < %s
+    ''', (before,))
+    terms = sorted({term_start(row[0]) for row in cursor.fetchall()})
+    cursor.close()
+    return terms
+
+def ensure_term_partitions(conn, ahead=TERM_PARTITIONS_AHEAD):
+    """ساخت پارتیشن ترم جاری و ترم‌های آینده برای همه شعبه‌ها
+    
+    هر شعبه در یک savepoint جدا ساخته می‌شود تا خطای یک شعبه مانع بقیه نشود.
+    """
+    current = term_start(date.today())
+    parents = get_term_partition_parents(conn)
+    cursor = conn.cursor()
+    for _, parent in parents:
+        cursor.execute('SAVEPOINT term_partitions')
+        try:
+            create_term_partitions(conn, parent, current, term_after(current, ahead))
+            cursor.execute('RELEASE SAVEPOINT term_partitions')
+        except Exception as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT term_partitions')
+            print(f"خطا در ساخت پارتیشن ترم‌های {parent}: {e}")
+    cursor.close()
+    return len(parents)
+
+REGISTRATION_PERIODS = {
+    'recent': 'ترم جاری و قبلی',
+    'term': 'ترم جاری',
+    'all': 'همه',
+}
+
+def registration_period_start(period):
+    """تاریخ شروع بازه لیست ثبت‌نام‌ها (None برای همه)"""
+    current = term_start(date.today())
+    if period == 'term':
+        return current
+    if period == 'all':
+        return None
+    return term_after(current, -1)
+
+# ==================== ارجاع به جداول پارتیشن‌شده ====================
+# کلید اصلی ثبت‌نام‌ها و پرداخت‌های پارتیشن‌شده شامل شعبه و تاریخ است، بنابراین
+# کلید خارجی تک‌ستونی به آن‌ها ممکن نیست. ارجاع‌ها در partition_references ثبت
+# می‌شوند و برای هر کدام دو trigger ساخته می‌شود: بررسی وجود ردیف مرجع هنگام
+# درج/تغییر (با قفل FOR KEY SHARE مانند کلید خارجی) و اجرای رفتار ON DELETE
+# (CASCADE، SET NULL یا جلوگیری از حذف) پس از حذف ردیف مرجع. تا زمانی که جدول
+# مرجع پارتیشن نشده باشد کلید خارجی معمولی برقرار است و triggerها ساخته نمی‌شوند.
+# کلیدها عددی هستند.
+register_schema('''
+    CREATE TABLE IF NOT EXISTS partition_references (
+        referencing_table VARCHAR(63) NOT NULL,
+        referencing_column VARCHAR(63) NOT NULL,
+        parent_table VARCHAR(63) NOT NULL,
+        parent_key VARCHAR(63) NOT NULL,
+        on_delete VARCHAR(10) NOT NULL CHECK (on_delete IN ('CASCADE', 'SET NULL', 'RESTRICT')),
+        PRIMARY KEY (referencing_table, referencing_column)
+    )
+''', '''
+    CREATE OR REPLACE FUNCTION check_partitioned_reference() RETURNS trigger AS $$
+    DECLARE
+        value TEXT := to_jsonb(NEW) ->> TG_ARGV[0];
+        referenced BOOLEAN;
+    BEGIN
+        IF value IS NOT NULL THEN
+            EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I = $1::BIGINT FOR KEY SHARE)',
+                           TG_ARGV[1], TG_ARGV[2])
+            INTO referenced USING value;
+            IF NOT referenced THEN
+                RAISE EXCEPTION '%.% = % در %.% وجود ندارد', TG_TABLE_NAME, TG_ARGV[0], value, TG_ARGV[1], TG_ARGV[2]
+                    USING ERRCODE = 'foreign_key_violation';
+            END IF;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+''', '''
+    CREATE OR REPLACE FUNCTION apply_partitioned_reference_delete() RETURNS trigger AS $$
+    DECLARE
+        parent_table TEXT := TG_ARGV[0];
+        parent_key TEXT := TG_ARGV[1];
+        referencing_table TEXT := TG_ARGV[2];
+        referencing_column TEXT := TG_ARGV[3];
+        value TEXT := to_jsonb(OLD) ->> TG_ARGV[1];
+        referenced BOOLEAN;
+    BEGIN
+        -- تغییر شعبه یا تاریخ ردیف را به پارتیشن دیگری منتقل می‌کند (حذف و درج)؛
+        -- در این حالت ردیف مرجع هنوز وجود دارد
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I = $1::BIGINT)', parent_table, parent_key)
+        INTO referenced USING value;
+        IF referenced THEN
+            RETURN NULL;
+        END IF;
+
+        IF TG_ARGV[4] = 'CASCADE' THEN
+            EXECUTE format('DELETE FROM %I WHERE %I = $1::BIGINT', referencing_table, referencing_column)
+            USING value;
+        ELSIF TG_ARGV[4] = 'SET NULL' THEN
+            EXECUTE format('UPDATE %I SET %I = NULL WHERE %I = $1::BIGINT',
+                           referencing_table, referencing_column, referencing_column)
+            USING value;
+        ELSE
+            EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I = $1::BIGINT)', referencing_table, referencing_column)
+            INTO referenced USING value;
+            IF referenced THEN
+                RAISE EXCEPTION '%.% = % هنوز در %.% استفاده می‌شود', parent_table, parent_key, value,
+                    referencing_table, referencing_column
+                    USING ERRCODE = 'foreign_key_violation';
+            END IF;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+''', '''
+    CREATE OR REPLACE FUNCTION install_partition_references() RETURNS void AS $$
+    DECLARE
+        ref RECORD;
+    BEGIN
+        FOR ref IN
+            SELECT r.* FROM partition_references r
+            JOIN pg_class p ON p.oid = to_regclass(r.parent_table)
+            WHERE p.relkind = 'p' AND to_regclass(r.referencing_table) IS NOT NULL
+        LOOP
+            EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I',
+                           ref.referencing_column || '_reference', ref.referencing_table);
+            EXECUTE format('CREATE TRIGGER %I AFTER INSERT OR UPDATE OF %I ON %I FOR EACH ROW '
+                           'EXECUTE FUNCTION check_partitioned_reference(%L, %L, %L)',
+                           ref.referencing_column || '_reference', ref.referencing_column, ref.referencing_table,
+                           ref.referencing_column, ref.parent_table, ref.parent_key);
+            EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I',
+                           ref.referencing_table || '_' || ref.referencing_column || '_reference', ref.parent_table);
+            EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I FOR EACH ROW '
+                           'EXECUTE FUNCTION apply_partitioned_reference_delete(%L, %L, %L, %L, %L)',
+                           ref.referencing_table || '_' || ref.referencing_column || '_reference', ref.parent_table,
+                           ref.parent_table, ref.parent_key, ref.referencing_table, ref.referencing_column,
+                           ref.on_delete);
+        END LOOP;
+    END;
+    $$ LANGUAGE plpgsql
+''')
+
+def add_partition_reference(conn, referencing_table, referencing_column, parent_table, parent_key, on_delete):
+    """ثبت ارجاع به جدول پارتیشن‌شده (به جای کلید خارجی)؛ triggerها با init_db_schema ساخته می‌شوند"""
+    _write(conn, '''
+        INSERT INTO partition_references
+        (referencing_table, referencing_column, parent_table, parent_key, on_delete)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (referencing_table, referencing_column) DO UPDATE
+        SET parent_table = EXCLUDED.parent_table, parent_key = EXCLUDED.parent_key,
+            on_delete = EXCLUDED.on_delete
+    ''', (referencing_table, referencing_column, parent_table, parent_key, on_delete))
+
+def _register_partition_reference(referencing_table, referencing_column, parent_table, parent_key, on_delete):
+    """ارجاع‌های شناخته‌شده برنامه (رفتار ثبت‌شده توسط branch_partitions.py تغییر نمی‌کند)"""
+    register_schema(f'''
+        INSERT INTO partition_references
+        (referencing_table, referencing_column, parent_table, parent_key, on_delete)
+        VALUES ('{referencing_table}', '{referencing_column}', '{parent_table}', '{parent_key}', '{on_delete}')
+        ON CONFLICT (referencing_table, referencing_column) DO NOTHING
+    ''', 'SELECT install_partition_references()')
+
+# حذف پرداخت پیوند آن را از ثبت‌نام برمی‌دارد (save_registration_payment)
+_register_partition_reference('registrations', 'payment_id', 'payments', 'payment_id', 'SET NULL')
+
 # ==================== توابع داشبورد ====================
-def get_dashboard_stats(conn):
-    """دریافت آمار کلی داشبورد"""
+def get_dashboard_stats(conn, branch_id=None):
+    """دریافت آمار کلی داشبورد (همه شعبه‌ها یا یک شعبه)"""
     cursor = conn.cursor(cursor_factory=DictCursor)
     stats = {}
+    branch_filter = '%s::integer IS NULL OR branch_id = %s::integer'
     
     try:
-        cursor.execute('SELECT COUNT(*) FROM professors')
-        stats['professors'] = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM students')
-        stats['students'] = cursor.fetchone()[0]
+        for table in ('professors', 'students', 'courses', 'classes', 'registrations'):
+            cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE {branch_filter}', (branch_id, branch_id))
+            stats[table] = cursor.fetchone()[0]
         
-        cursor.execute('SELECT COUNT(*) FROM courses')
-        stats['courses'] = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM classes')
-        stats['classes'] = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM registrations')
-        stats['registrations'] = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT SUM(amount) FROM payments WHERE payment_status = %s', ('تکمیل',))
+        cursor.execute(f'SELECT SUM(total_amount) FROM payment_rollup_monthly WHERE payment_status = %s AND ({branch_filter})',
+                       ('تکمیل', branch_id, branch_id))
         total_payments = cursor.fetchone()[0]
         stats['payments'] = total_payments if total_payments else 0
         
@@ -58,7 +856,7 @@ def get_dashboard_stats(conn):
     
     return stats
 
-def get_recent_registrations(conn, limit=5):
+def get_recent_registrations(conn, limit=5, branch_id=None):
     """دریافت آخرین ثبت‌نام‌ها"""
     cursor = conn.cursor(cursor_factory=DictCursor)
     
@@ -71,8 +869,9 @@ def get_recent_registrations(conn, limit=5):
             JOIN classes cl ON r.class_id = cl.class_id
             JOIN courses c ON cl.course_id = c.course_id
             JOIN professors p ON cl.professor_id = p.professor_id
+            WHERE %s::integer IS NULL OR r.branch_id = %s::integer
             ORDER BY r.registration_date DESC LIMIT %s
-        ''', (limit,))
+        ''', (branch_id, branch_id, limit))
         return cursor.fetchall()
     except Exception as e:
         print(f"خطا در دریافت آخرین ثبت‌نام‌ها: {e}")
@@ -80,7 +879,7 @@ def get_recent_registrations(conn, limit=5):
     finally:
         cursor.close()
 
-def get_upcoming_classes(conn, limit=5):
+def get_upcoming_classes(conn, limit=5, branch_id=None):
     """دریافت کلاس‌های آینده"""
     cursor = conn.cursor(cursor_factory=DictCursor)
     
@@ -94,8 +893,9 @@ def get_upcoming_classes(conn, limit=5):
             JOIN courses cr ON c.course_id = cr.course_id
             JOIN professors p ON c.professor_id = p.professor_id
             WHERE c.start_date >= CURRENT_DATE
+              AND (%s::integer IS NULL OR c.branch_id = %s::integer)
             ORDER BY c.start_date LIMIT %s
-        ''', (limit,))
+        ''', (branch_id, branch_id, limit))
         return cursor.fetchall()
     except Exception as e:
         print(f"خطا در دریافت کلاس‌های آینده: {e}")
@@ -104,15 +904,18 @@ def get_upcoming_classes(conn, limit=5):
         cursor.close()
 
 # ==================== توابع اساتید ====================
-def get_professors_list(conn):
+PROFESSORS_LIST_SQL = '''
+    SELECT p.*, 
+           (SELECT COUNT(*) FROM classes WHERE professor_id = p.professor_id) as class_count
+    FROM professors p 
+    WHERE %(branch_id)s::integer IS NULL OR p.branch_id = %(branch_id)s::integer
+    ORDER BY p.professor_id
+'''
+
+def get_professors_list(conn, branch_id=None):
     """دریافت لیست اساتید"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('''
-        SELECT p.*, 
-               (SELECT COUNT(*) FROM classes WHERE professor_id = p.professor_id) as class_count
-        FROM professors p 
-        ORDER BY p.professor_id
-    ''')
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute(PROFESSORS_LIST_SQL, {'branch_id': branch_id})
     professors = cursor.fetchall()
     cursor.close()
     return professors
@@ -132,40 +935,42 @@ def check_professor_exists(conn, email, phone_number, exclude_id=None):
     cursor.close()
     return count > 0
 
-def get_professor_by_id(conn, professor_id):
-    """دریافت اطلاعات استاد با ID"""
+def get_professor_by_id(conn, professor_id, branch_id=None):
+    """دریافت اطلاعات استاد با ID (با تعیین شعبه، فقط از همان شعبه)"""
     cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('SELECT * FROM professors WHERE professor_id = %s', (professor_id,))
+    cursor.execute('''
+        SELECT * FROM professors
+        WHERE professor_id = %s AND (%s::integer IS NULL OR branch_id = %s::integer)
+    ''', (professor_id, branch_id, branch_id))
     professor = cursor.fetchone()
     cursor.close()
     return professor
 
-def add_professor_db(conn, first_name, last_name, specialty, phone_number, email, salary, session_count):
-    """افزودن استاد جدید"""
-    cursor = conn.cursor()
-    cursor.execute('''
+def add_professor_db(conn, first_name, last_name, specialty, phone_number, email, salary, session_count,
+                     branch_id=None):
+    """افزودن استاد جدید؛ شناسه استاد را برمی‌گرداند"""
+    return _insert_returning_id(conn, '''
         INSERT INTO professors 
-        (first_name, last_name, specialty, phone_number, email, salary, session_count)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-    ''', (first_name, last_name, specialty, phone_number, email, salary, session_count))
-    conn.commit()
-    cursor.close()
+        (first_name, last_name, specialty, phone_number, email, salary, session_count, branch_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING professor_id
+    ''', (first_name, last_name, specialty, phone_number, email, salary, session_count,
+          branch_id or DEFAULT_BRANCH_ID))
 
-def update_professor_db(conn, professor_id, first_name, last_name, specialty, phone_number, email, salary, session_count):
-    """به‌روزرسانی اطلاعات استاد"""
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE professors 
-        SET first_name = %s, last_name = %s, specialty = %s, 
-            phone_number = %s, email = %s, salary = %s,
-            session_count = %s
-        WHERE professor_id = %s
-    ''', (first_name, last_name, specialty, phone_number, email, salary, session_count, professor_id))
-    conn.commit()
-    cursor.close()
+def update_professor_db(conn, professor_id, first_name, last_name, specialty, phone_number, email, salary, session_count,
+                        row_version=None, branch_id=None):
+    """به‌روزرسانی اطلاعات استاد؛ تصویر قبل از تغییر (None در صورت تعارض نسخه)"""
+    return _versioned_update(conn, 'professors', professor_id, '''
+        first_name = %s, last_name = %s, specialty = %s, 
+        phone_number = %s, email = %s, salary = %s,
+        session_count = %s
+    ''', (first_name, last_name, specialty, phone_number, email, salary, session_count), row_version, branch_id)
 
-def delete_professor_db(conn, professor_id):
-    """حذف استاد"""
+def delete_professor_db(conn, professor_id, branch_id=None):
+    """حذف استاد (با تعیین شعبه، فقط از همان شعبه)"""
+    if not _branch_ids(conn, 'professors', 'professor_id', [professor_id], branch_id):
+        return False, 'استاد مورد نظر یافت نشد.', None
+    
     cursor = conn.cursor()
     
     # بررسی وجود کلاس‌های فعال
@@ -174,68 +979,67 @@ def delete_professor_db(conn, professor_id):
     
     if class_count > 0:
         cursor.close()
-        return False, 'امکان حذف استاد وجود ندارد زیرا در کلاس‌هایی تدریس می‌کند.'
+        return False, 'امکان حذف استاد وجود ندارد زیرا در کلاس‌هایی تدریس می‌کند.', None
+    
+    cursor.close()
     
     # حذف زبان‌های مرتبط
-    cursor.execute('DELETE FROM professor_languages WHERE professor_id = %s', (professor_id,))
+    _write(conn, 'DELETE FROM professor_languages WHERE professor_id = %s', (professor_id,))
     
     # حذف استاد
-    cursor.execute('DELETE FROM professors WHERE professor_id = %s', (professor_id,))
-    conn.commit()
-    cursor.close()
+    before = _audited_delete(conn, 'professors', professor_id)
     
-    return True, 'استاد با موفقیت حذف شد.'
+    return True, 'استاد با موفقیت حذف شد.', before
 
 # ==================== توابع دانش‌آموزان ====================
-def get_students_list(conn):
+STUDENTS_LIST_SQL = '''
+    SELECT s.*, 
+           (SELECT COUNT(*) FROM registrations WHERE membership_id = s.membership_id) as registration_count
+    FROM students s 
+    WHERE %(branch_id)s::integer IS NULL OR s.branch_id = %(branch_id)s::integer
+    ORDER BY s.membership_id
+'''
+
+def get_students_list(conn, branch_id=None):
     """دریافت لیست دانش‌آموزان"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('''
-        SELECT s.*, 
-               (SELECT COUNT(*) FROM registrations WHERE membership_id = s.membership_id) as registration_count
-        FROM students s 
-        ORDER BY s.membership_id
-    ''')
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute(STUDENTS_LIST_SQL, {'branch_id': branch_id})
     students = cursor.fetchall()
     cursor.close()
     return students
 
 def add_student_db(conn, data):
-    """افزودن دانش‌آموز جدید"""
-    cursor = conn.cursor()
-    cursor.execute('''
+    """افزودن دانش‌آموز جدید؛ شماره عضویت را برمی‌گرداند"""
+    return _insert_returning_id(conn, '''
         INSERT INTO students (first_name, last_name, national_id, birth_date, 
-                            phone_number, email, province, city, street, plaque)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            phone_number, email, province, city, street, plaque, branch_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING membership_id
     ''', (
         data['first_name'], data['last_name'], data['national_id'], data['birth_date'],
         data['phone_number'], data['email'], data['province'], data['city'],
-        data['street'], data['plaque']
+        data['street'], data['plaque'], data.get('branch_id') or DEFAULT_BRANCH_ID
     ))
-    conn.commit()
-    cursor.close()
 
-def update_student_db(conn, student_id, data):
-    """به‌روزرسانی اطلاعات دانش‌آموز"""
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE students 
-        SET first_name = %s, last_name = %s, national_id = %s, birth_date = %s,
-            phone_number = %s, email = %s, province = %s, city = %s, 
-            street = %s, plaque = %s
-        WHERE membership_id = %s
+def update_student_db(conn, student_id, data, row_version=None, branch_id=None):
+    """به‌روزرسانی اطلاعات دانش‌آموز؛ تصویر قبل از تغییر (None در صورت تعارض نسخه)"""
+    return _versioned_update(conn, 'students', student_id, '''
+        first_name = %s, last_name = %s, national_id = %s, birth_date = %s,
+        phone_number = %s, email = %s, province = %s, city = %s, 
+        street = %s, plaque = %s
     ''', (
         data['first_name'], data['last_name'], data['national_id'], data['birth_date'],
         data['phone_number'], data['email'], data['province'], data['city'],
-        data['street'], data['plaque'], student_id
-    ))
-    conn.commit()
-    cursor.close()
+        data['street'], data['plaque']
+    ), row_version, branch_id)
 
-def get_student_by_id(conn, student_id):
-    """دریافت اطلاعات دانش‌آموز با ID"""
+def get_student_by_id(conn, student_id, branch_id=None):
+    """دریافت اطلاعات دانش‌آموز با ID (با تعیین شعبه، فقط از همان شعبه)"""
     cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('SELECT * FROM students WHERE membership_id = %s', (student_id,))
+    cursor.execute('''
+        SELECT * FROM students
+        WHERE membership_id = %s AND (%s::integer IS NULL OR branch_id = %s::integer)
+    ''', (student_id, branch_id, branch_id))
     student = cursor.fetchone()
     cursor.close()
     return student
@@ -270,8 +1074,144 @@ def get_student_registrations(conn, student_id):
     cursor.close()
     return registrations
 
-def delete_student_db(conn, student_id):
-    """حذف دانش‌آموز"""
+# خلاصه آماری هر دانش‌آموز؛ در تغییرات ثبت‌نام و پرداخت تازه‌سازی می‌شود
+register_schema('''
+    CREATE TABLE IF NOT EXISTS student_summaries (
+        membership_id INTEGER PRIMARY KEY REFERENCES students (membership_id) ON DELETE CASCADE,
+        total_courses INTEGER NOT NULL DEFAULT 0,
+        completed_courses INTEGER NOT NULL DEFAULT 0,
+        pending_courses INTEGER NOT NULL DEFAULT 0,
+        total_payments NUMERIC(16, 2) NOT NULL DEFAULT 0,
+        refreshed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+''')
+
+STUDENT_SUMMARY_FIELDS = ('total_courses', 'completed_courses', 'pending_courses', 'total_payments')
+
+def refresh_student_summaries(conn, membership_ids=None, registration_id=None):
+    """تازه‌سازی خلاصه آماری دانش‌آموزان (با شناسه دانش‌آموز یا شناسه ثبت‌نام؛ بدون هر دو برای همه)"""
+    cursor = conn.cursor()
+
+    query = '''
+        INSERT INTO student_summaries AS ss
+            (membership_id, total_courses, completed_courses, pending_courses, total_payments, refreshed_at)
+        SELECT s.membership_id,
+               COUNT(r.registration_id),
+               COUNT(*) FILTER (WHERE py.payment_status = %s),
+               COUNT(*) FILTER (WHERE py.payment_status = %s),
+               COALESCE(SUM(py.amount), 0),
+               CURRENT_TIMESTAMP
+        FROM students s
+        LEFT JOIN registrations r ON r.membership_id = s.membership_id
+        LEFT JOIN payments py ON r.payment_id = py.payment_id
+    '''
+    params = ['تکمیل', 'انتظار']
+
+    if registration_id is not None:
+        query += ' WHERE s.membership_id IN (SELECT membership_id FROM registrations WHERE registration_id = %s)'
+        params.append(registration_id)
+    elif membership_ids is not None:
+        query += ' WHERE s.membership_id = ANY(%s)'
+        params.append([int(m) for m in membership_ids if m])
+
+    query += '''
+        GROUP BY s.membership_id
+        ON CONFLICT (membership_id) DO UPDATE
+        SET total_courses = EXCLUDED.total_courses,
+            completed_courses = EXCLUDED.completed_courses,
+            pending_courses = EXCLUDED.pending_courses,
+            total_payments = EXCLUDED.total_payments,
+            refreshed_at = EXCLUDED.refreshed_at
+    '''
+
+    cursor.execute(query, params)
+    cursor.close()
+
+def ensure_student_summaries(conn):
+    """پر کردن اولیه خلاصه دانش‌آموزان برای پایگاه داده‌های موجود"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT NOT EXISTS (SELECT 1 FROM student_summaries) AND EXISTS (SELECT 1 FROM students)')
+    needs_refresh = cursor.fetchone()[0]
+    cursor.close()
+
+    if needs_refresh:
+        refresh_student_summaries(conn)
+        conn.commit()
+
+def get_student_summary(conn, student_id, page=1, per_page=10, branch_id=None):
+    """دریافت مشخصات، خلاصه آماری و یک صفحه از سوابق ثبت‌نام دانش‌آموز در یک کوئری"""
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    page = max(int(page), 1)
+
+    # اگر خلاصه ذخیره‌شده وجود نداشته باشد، همان لحظه محاسبه می‌شود
+    cursor.execute('''
+        SELECT s.*,
+               COALESCE(ss.total_courses, agg.total_courses) AS total_courses,
+               COALESCE(ss.completed_courses, agg.completed_courses) AS completed_courses,
+               COALESCE(ss.pending_courses, agg.pending_courses) AS pending_courses,
+               COALESCE(ss.total_payments, agg.total_payments) AS total_payments,
+               COALESCE((
+                   SELECT json_agg(page_rows ORDER BY page_rows.registration_date DESC, page_rows.registration_id DESC)
+                   FROM (
+                       SELECT r.registration_id, r.registration_date,
+                              c.course_title, c.course_level,
+                              cr.class_time, cr.class_days, cr.start_date, cr.end_date,
+                              p.first_name || ' ' || p.last_name AS professor_name,
+                              py.amount, py.payment_status, py.payment_method, py.payment_date
+                       FROM registrations r
+                       JOIN classes cr ON r.class_id = cr.class_id
+                       JOIN courses c ON cr.course_id = c.course_id
+                       JOIN professors p ON cr.professor_id = p.professor_id
+                       LEFT JOIN payments py ON r.payment_id = py.payment_id
+                       WHERE r.membership_id = s.membership_id
+                       ORDER BY r.registration_date DESC, r.registration_id DESC
+                       LIMIT %s OFFSET %s
+                   ) page_rows
+               ), '[]'::json) AS registrations_page
+        FROM students s
+        LEFT JOIN student_summaries ss ON ss.membership_id = s.membership_id
+        LEFT JOIN LATERAL (
+            SELECT COUNT(r.registration_id) AS total_courses,
+                   COUNT(*) FILTER (WHERE py.payment_status = %s) AS completed_courses,
+                   COUNT(*) FILTER (WHERE py.payment_status = %s) AS pending_courses,
+                   COALESCE(SUM(py.amount), 0) AS total_payments
+            FROM registrations r
+            LEFT JOIN payments py ON r.payment_id = py.payment_id
+            WHERE r.membership_id = s.membership_id AND ss.membership_id IS NULL
+        ) agg ON TRUE
+        WHERE s.membership_id = %s AND (%s::integer IS NULL OR s.branch_id = %s::integer)
+    ''', (per_page, (page - 1) * per_page, 'تکمیل', 'انتظار', student_id, branch_id, branch_id))
+    row = cursor.fetchone()
+    cursor.close()
+
+    if not row:
+        return None
+
+    student = dict(row)
+    registrations = student.pop('registrations_page') or []
+    stats = {field: student.pop(field) or 0 for field in STUDENT_SUMMARY_FIELDS}
+
+    # تاریخ‌ها در JSON به صورت رشته برمی‌گردند
+    for registration in registrations:
+        for field in ('registration_date', 'start_date', 'end_date', 'payment_date'):
+            if registration.get(field):
+                registration[field] = date.fromisoformat(registration[field][:10])
+
+    total_pages = max((stats['total_courses'] + per_page - 1) // per_page, 1)
+    pagination = {
+        'page': page,
+        'per_page': per_page,
+        'total_pages': total_pages,
+        'offset': (page - 1) * per_page
+    }
+
+    return {'student': student, 'registrations': registrations, 'stats': stats, 'pagination': pagination}
+
+def delete_student_db(conn, student_id, branch_id=None):
+    """حذف دانش‌آموز (با تعیین شعبه، فقط از همان شعبه)"""
+    if not _branch_ids(conn, 'students', 'membership_id', [student_id], branch_id):
+        return False, 'دانش‌آموز مورد نظر یافت نشد.', None
+    
     cursor = conn.cursor()
     
     # بررسی وجود ثبت‌نام‌های فعال
@@ -280,81 +1220,83 @@ def delete_student_db(conn, student_id):
     
     if reg_count > 0:
         cursor.close()
-        return False, 'امکان حذف دانش‌آموز وجود ندارد زیرا در دوره‌هایی ثبت‌نام کرده است.'
+        return False, 'امکان حذف دانش‌آموز وجود ندارد زیرا در دوره‌هایی ثبت‌نام کرده است.', None
     
-    # حذف دانش‌آموز
-    cursor.execute('DELETE FROM students WHERE membership_id = %s', (student_id,))
-    conn.commit()
     cursor.close()
     
-    return True, 'دانش‌آموز با موفقیت حذف شد.'
+    # حذف دانش‌آموز
+    before = _audited_delete(conn, 'students', student_id)
+    
+    return True, 'دانش‌آموز با موفقیت حذف شد.', before
 
 # ==================== توابع دوره‌ها ====================
-def get_courses_list(conn):
+COURSES_LIST_SQL = '''
+    SELECT c.*, 
+           (SELECT COUNT(*) FROM classes WHERE course_id = c.course_id) as class_count,
+           (SELECT COUNT(*) FROM registrations r 
+            JOIN classes cl ON r.class_id = cl.class_id 
+            WHERE cl.course_id = c.course_id) as student_count
+    FROM courses c 
+    WHERE %(branch_id)s::integer IS NULL OR c.branch_id = %(branch_id)s::integer
+    ORDER BY c.course_id
+'''
+
+def get_courses_list(conn, branch_id=None):
     """دریافت لیست دوره‌ها"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('''
-        SELECT c.*, 
-               (SELECT COUNT(*) FROM classes WHERE course_id = c.course_id) as class_count,
-               (SELECT COUNT(*) FROM registrations r 
-                JOIN classes cl ON r.class_id = cl.class_id 
-                WHERE cl.course_id = c.course_id) as student_count
-        FROM courses c 
-        ORDER BY c.course_id
-    ''')
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute(COURSES_LIST_SQL, {'branch_id': branch_id})
     courses = cursor.fetchall()
     cursor.close()
     return courses
 
 def add_course_db(conn, data):
-    """افزودن دوره جدید"""
-    cursor = conn.cursor()
-    cursor.execute('''
+    """افزودن دوره جدید؛ شناسه دوره را برمی‌گرداند"""
+    return _insert_returning_id(conn, '''
         INSERT INTO courses (
             course_title, course_level, session_count, 
-            course_status, course_capacity, level_id
-        ) VALUES (%s, %s, %s, %s, %s, %s)
+            course_status, course_capacity, level_id, branch_id
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+        RETURNING course_id
     ''', (
         data['course_title'], data['course_level'], data['session_count'],
-        data['course_status'], data['course_capacity'], data.get('level_id')
+        data['course_status'], data['course_capacity'], data.get('level_id'),
+        data.get('branch_id') or DEFAULT_BRANCH_ID
     ))
-    conn.commit()
-    cursor.close()
 
-def update_course_db(conn, course_id, data):
-    """به‌روزرسانی دوره"""
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE courses 
-        SET course_title = %s, 
-            course_level = %s, 
-            session_count = %s,
-            course_status = %s, 
-            course_capacity = %s, 
-            level_id = %s,
-            description = %s, 
-            prerequisites = %s, 
-            tuition_fee = %s
-        WHERE course_id = %s
+def update_course_db(conn, course_id, data, row_version=None, branch_id=None):
+    """به‌روزرسانی دوره؛ تصویر قبل از تغییر (None در صورت تعارض نسخه)"""
+    return _versioned_update(conn, 'courses', course_id, '''
+        course_title = %s, 
+        course_level = %s, 
+        session_count = %s,
+        course_status = %s, 
+        course_capacity = %s, 
+        level_id = %s,
+        description = %s, 
+        prerequisites = %s, 
+        tuition_fee = %s
     ''', (
         data['course_title'], data['course_level'], data['session_count'],
         data['course_status'], data['course_capacity'], data.get('level_id'),
-        data.get('description', ''), data.get('prerequisites', ''), data.get('tuition_fee', 0),
-        course_id
-    ))
-    conn.commit()
-    cursor.close()
+        data.get('description', ''), data.get('prerequisites', ''), data.get('tuition_fee', 0)
+    ), row_version, branch_id)
 
-def get_course_by_id(conn, course_id):
-    """دریافت اطلاعات دوره با ID"""
+def get_course_by_id(conn, course_id, branch_id=None):
+    """دریافت اطلاعات دوره با ID (با تعیین شعبه، فقط از همان شعبه)"""
     cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('SELECT * FROM courses WHERE course_id = %s', (course_id,))
+    cursor.execute('''
+        SELECT * FROM courses
+        WHERE course_id = %s AND (%s::integer IS NULL OR branch_id = %s::integer)
+    ''', (course_id, branch_id, branch_id))
     course = cursor.fetchone()
     cursor.close()
     return course
 
-def delete_course_db(conn, course_id):
-    """حذف دوره"""
+def delete_course_db(conn, course_id, branch_id=None):
+    """حذف دوره (با تعیین شعبه، فقط از همان شعبه)"""
+    if not _branch_ids(conn, 'courses', 'course_id', [course_id], branch_id):
+        return False, 'دوره مورد نظر یافت نشد.', None
+    
     cursor = conn.cursor()
     
     # بررسی وجود کلاس‌های فعال
@@ -363,73 +1305,111 @@ def delete_course_db(conn, course_id):
     
     if class_count > 0:
         cursor.close()
-        return False, 'امکان حذف دوره وجود ندارد زیرا کلاس‌های فعال دارد.'
+        return False, 'امکان حذف دوره وجود ندارد زیرا کلاس‌های فعال دارد.', None
     
-    cursor.execute('DELETE FROM courses WHERE course_id = %s', (course_id,))
-    conn.commit()
     cursor.close()
+    before = _audited_delete(conn, 'courses', course_id)
     
-    return True, 'دوره با موفقیت حذف شد.'
+    return True, 'دوره با موفقیت حذف شد.', before
 
 # ==================== توابع کلاس‌ها ====================
-def get_classes_list(conn):
+CLASSES_LIST_SQL = '''
+    SELECT cl.*, 
+           c.course_title, c.course_level,
+           p.first_name || ' ' || p.last_name as professor_name,
+           (SELECT COUNT(*) FROM registrations WHERE class_id = cl.class_id) as student_count
+    FROM classes cl
+    JOIN courses c ON cl.course_id = c.course_id
+    JOIN professors p ON cl.professor_id = p.professor_id
+    WHERE %(branch_id)s::integer IS NULL OR cl.branch_id = %(branch_id)s::integer
+    ORDER BY cl.start_date DESC
+'''
+
+def get_classes_list(conn, branch_id=None):
     """دریافت لیست کلاس‌ها"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('''
-        SELECT cl.*, 
-               c.course_title, c.course_level,
-               p.first_name || ' ' || p.last_name as professor_name,
-               (SELECT COUNT(*) FROM registrations WHERE class_id = cl.class_id) as student_count
-        FROM classes cl
-        JOIN courses c ON cl.course_id = c.course_id
-        JOIN professors p ON cl.professor_id = p.professor_id
-        ORDER BY cl.start_date DESC
-    ''')
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute(CLASSES_LIST_SQL, {'branch_id': branch_id})
     classes = cursor.fetchall()
     cursor.close()
     return classes
 
+# ستون کلاس درس برای بررسی تداخل کلاس‌ها در یک مکان
+register_schema('ALTER TABLE classes ADD COLUMN IF NOT EXISTS classroom VARCHAR(50)')
+
+# شمارنده تغییر برنامه کلاس‌ها برای باطل کردن کش زمان‌بندی همه فرایندها (scheduling.py)؛
+# هم‌زمان با commit تغییر دیده می‌شود. تغییر نام دوره یا استاد هم جدول هفتگی را تغییر می‌دهد.
+register_schema('''
+    CREATE TABLE IF NOT EXISTS schedule_version (
+        singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+        version BIGINT NOT NULL DEFAULT 0
+    )
+''', '''
+    INSERT INTO schedule_version (singleton) VALUES (TRUE) ON CONFLICT DO NOTHING
+''', '''
+    CREATE OR REPLACE FUNCTION bump_schedule_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE schedule_version SET version = version + 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+''')
+for _table, _events in (('classes', 'INSERT OR UPDATE OR DELETE OR TRUNCATE'),
+                        ('courses', 'UPDATE OF course_title, course_level'),
+                        ('professors', 'UPDATE OF first_name, last_name')):
+    register_schema(f'''
+        DROP TRIGGER IF EXISTS {_table}_schedule_version ON {_table};
+        CREATE TRIGGER {_table}_schedule_version
+            AFTER {_events} ON {_table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_schedule_version()
+    ''')
+
 def add_class_db(conn, data):
-    """افزودن کلاس جدید"""
-    cursor = conn.cursor()
-    cursor.execute('''
+    """افزودن کلاس جدید؛ شناسه کلاس را برمی‌گرداند (None اگر دوره وجود نداشته باشد)"""
+    class_id = _insert_returning_id(conn, '''
         INSERT INTO classes (course_id, professor_id, capacity, 
-                           start_date, end_date, class_time, class_days)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                           start_date, end_date, class_time, class_days, classroom, branch_id)
+        SELECT %s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, c.branch_id)
+        FROM courses c WHERE c.course_id = %s
+        RETURNING class_id
     ''', (
         data['course_id'], data['professor_id'], data['capacity'],
-        data['start_date'], data['end_date'], data['class_time'], data['class_days']
+        data['start_date'], data['end_date'], data['class_time'], data['class_days'],
+        data.get('classroom'), data.get('branch_id'), data['course_id']
     ))
-    conn.commit()
-    cursor.close()
+    _on_commit(conn, invalidate_schedule_index)
+    return class_id
 
-def update_class_db(conn, class_id, data):
-    """به‌روزرسانی کلاس"""
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE classes 
-        SET course_id = %s, professor_id = %s, capacity = %s,
-            start_date = %s, end_date = %s, class_time = %s,
-            class_days = %s
-        WHERE class_id = %s
+def update_class_db(conn, class_id, data, row_version=None, branch_id=None):
+    """به‌روزرسانی کلاس؛ تصویر قبل از تغییر (None در صورت تعارض نسخه)"""
+    before = _versioned_update(conn, 'classes', class_id, '''
+        course_id = %s, professor_id = %s, capacity = %s,
+        start_date = %s, end_date = %s, class_time = %s,
+        class_days = %s, classroom = %s
     ''', (
         data['course_id'], data['professor_id'], data['capacity'],
         data['start_date'], data['end_date'], data['class_time'],
-        data['class_days'], class_id
-    ))
-    conn.commit()
-    cursor.close()
+        data['class_days'], data.get('classroom')
+    ), row_version, branch_id)
+    if before is not None:
+        _on_commit(conn, invalidate_schedule_index)
+    return before
 
-def get_class_by_id(conn, class_id):
-    """دریافت اطلاعات کلاس با ID"""
+def get_class_by_id(conn, class_id, branch_id=None):
+    """دریافت اطلاعات کلاس با ID (با تعیین شعبه، فقط از همان شعبه)"""
     cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('SELECT * FROM classes WHERE class_id = %s', (class_id,))
+    cursor.execute('''
+        SELECT * FROM classes
+        WHERE class_id = %s AND (%s::integer IS NULL OR branch_id = %s::integer)
+    ''', (class_id, branch_id, branch_id))
     class_info = cursor.fetchone()
     cursor.close()
     return class_info
 
-def delete_class_db(conn, class_id):
-    """حذف کلاس"""
+def delete_class_db(conn, class_id, branch_id=None):
+    """حذف کلاس (با تعیین شعبه، فقط از همان شعبه)"""
+    if not _branch_ids(conn, 'classes', 'class_id', [class_id], branch_id):
+        return False, 'کلاس مورد نظر یافت نشد.', None
+    
     cursor = conn.cursor()
     
     # بررسی وجود ثبت‌نام
@@ -438,18 +1418,20 @@ def delete_class_db(conn, class_id):
     
     if reg_count > 0:
         cursor.close()
-        return False, 'امکان حذف کلاس وجود ندارد زیرا دانش‌آموزانی در آن ثبت‌نام کرده‌اند.'
+        return False, 'امکان حذف کلاس وجود ندارد زیرا دانش‌آموزانی در آن ثبت‌نام کرده‌اند.', None
     
-    cursor.execute('DELETE FROM classes WHERE class_id = %s', (class_id,))
-    conn.commit()
     cursor.close()
+    before = _audited_delete(conn, 'classes', class_id)
+    _on_commit(conn, invalidate_schedule_index)
     
-    return True, 'کلاس با موفقیت حذف شد.'
+    return True, 'کلاس با موفقیت حذف شد.', before
 
 # ==================== توابع ثبت‌نام‌ها ====================
-def get_registrations_list(conn, filters=None):
-    """دریافت لیست ثبت‌نام‌ها با فیلتر"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
+def build_registrations_list_query(filters=None):
+    """ساخت پرس‌وجوی لیست ثبت‌نام‌ها با فیلتر (مشترک بین نسخه همگام و ناهمگام)"""
+    # فقط پارتیشن‌های ترم‌های بازه از ثبت‌نام‌ها خوانده می‌شوند؛ تاریخ پرداخت
+    # محدود نمی‌شود تا ثبت‌نامی که پرداخت آن قدیمی‌تر است پرداخت‌نشده دیده نشود
+    since = filters.get('registered_since') if filters else None
     
     query = '''
         SELECT r.*, 
@@ -469,6 +1451,10 @@ def get_registrations_list(conn, filters=None):
     '''
     params = []
     
+    if since:
+        query += ' AND r.registration_date >= %s'
+        params.append(since)
+    
     if filters:
         if filters.get('class_id'):
             query += ' AND r.class_id = %s'
@@ -481,23 +1467,34 @@ def get_registrations_list(conn, filters=None):
         if filters.get('payment_status'):
             query += ' AND py.payment_status = %s'
             params.append(filters['payment_status'])
+        
+        if filters.get('branch_id'):
+            query += ' AND r.branch_id = %s'
+            params.append(filters['branch_id'])
     
     query += ' ORDER BY r.registration_date DESC'
-    
-    cursor.execute(query, params)
+    return query, params
+
+def get_registrations_list(conn, filters=None):
+    """دریافت لیست ثبت‌نام‌ها با فیلتر"""
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute(*build_registrations_list_query(filters))
     registrations = cursor.fetchall()
     cursor.close()
     return registrations
 
-def get_classes_for_registration(conn):
+CLASSES_FOR_REGISTRATION_SQL = '''
+    SELECT cl.class_id, c.course_title || ' - ' || cl.class_time || ' (' || cl.class_days || ')' as class_name 
+    FROM classes cl
+    JOIN courses c ON cl.course_id = c.course_id
+    WHERE %(branch_id)s::integer IS NULL OR cl.branch_id = %(branch_id)s::integer
+    ORDER BY cl.start_date
+'''
+
+def get_classes_for_registration(conn, branch_id=None):
     """دریافت لیست کلاس‌ها برای ثبت‌نام"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('''
-        SELECT cl.class_id, c.course_title || ' - ' || cl.class_time || ' (' || cl.class_days || ')' as class_name 
-        FROM classes cl
-        JOIN courses c ON cl.course_id = c.course_id
-        ORDER BY cl.start_date
-    ''')
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute(CLASSES_FOR_REGISTRATION_SQL, {'branch_id': branch_id})
     classes = cursor.fetchall()
     cursor.close()
     return classes
@@ -506,13 +1503,12 @@ def add_registration_db(conn, membership_id, class_id):
     """افزودن ثبت‌نام جدید"""
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO registrations (membership_id, class_id, registration_date)
-        VALUES (%s, %s, CURRENT_DATE)
+        INSERT INTO registrations (membership_id, class_id, registration_date, branch_id)
+        SELECT %s, class_id, CURRENT_DATE, branch_id FROM classes WHERE class_id = %s
         RETURNING registration_id
     ''', (membership_id, class_id))
     
     registration_id = cursor.fetchone()[0]
-    conn.commit()
     cursor.close()
     return registration_id
 
@@ -546,17 +1542,14 @@ def get_class_capacity(conn, class_id):
 
 def update_registration_db(conn, registration_id, membership_id, class_id):
     """به‌روزرسانی ثبت‌نام"""
-    cursor = conn.cursor()
-    cursor.execute('''
+    _write(conn, '''
         UPDATE registrations 
-        SET membership_id = %s, class_id = %s
+        SET membership_id = %s, class_id = %s, row_version = row_version + 1
         WHERE registration_id = %s
     ''', (membership_id, class_id, registration_id))
-    conn.commit()
-    cursor.close()
 
-def get_registration_by_id(conn, registration_id):
-    """دریافت اطلاعات ثبت‌نام با ID"""
+def get_registration_by_id(conn, registration_id, branch_id=None):
+    """دریافت اطلاعات ثبت‌نام با ID (با تعیین شعبه، فقط از همان شعبه)"""
     cursor = conn.cursor(cursor_factory=DictCursor)
     cursor.execute('''
         SELECT r.*, s.first_name || ' ' || s.last_name as student_name,
@@ -565,35 +1558,418 @@ def get_registration_by_id(conn, registration_id):
         FROM registrations r
         JOIN students s ON r.membership_id = s.membership_id
         LEFT JOIN payments p ON r.payment_id = p.payment_id
-        WHERE r.registration_id = %s
-    ''', (registration_id,))
+        WHERE r.registration_id = %s AND (%s::integer IS NULL OR r.branch_id = %s::integer)
+    ''', (registration_id, branch_id, branch_id))
     registration = cursor.fetchone()
     cursor.close()
     return registration
 
-def delete_registration_db(conn, registration_id):
-    """حذف ثبت‌نام"""
+def get_registration_class_info(conn, registration_id):
+    """اطلاعات کلاس فعلی یک ثبت‌نام برای نمایش"""
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute('''
+        SELECT 
+            c.course_title,
+            cl.class_time,
+            cl.class_days,
+            p.first_name || ' ' || p.last_name as professor_name,
+            cl.start_date,
+            cl.end_date
+        FROM registrations r
+        JOIN classes cl ON r.class_id = cl.class_id
+        JOIN courses c ON cl.course_id = c.course_id
+        JOIN professors p ON cl.professor_id = p.professor_id
+        WHERE r.registration_id = %s
+    ''', (registration_id,))
+    class_info = cursor.fetchone()
+    cursor.close()
+    return class_info
+
+def get_classes_for_registration_edit(conn, registration_id):
+    """کلاس‌های قابل انتخاب در ویرایش ثبت‌نام (کلاس‌های آینده به همراه کلاس فعلی)
+    
+    کلاس فعلی با زیرپرس‌وجو مشخص می‌شود تا این تابع به نتیجه خواندن ثبت‌نام
+    وابسته نباشد و بتواند همزمان با آن اجرا شود.
+    """
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute('''
+        WITH current_class AS (
+            SELECT class_id FROM registrations WHERE registration_id = %s
+        )
+        SELECT 
+            cl.class_id, 
+            c.course_title || ' - ' || cl.class_time || ' (' || cl.class_days || ')' as class_name,
+            cl.capacity, 
+            (SELECT COUNT(*) FROM registrations WHERE class_id = cl.class_id) as registered,
+            c.course_title,
+            cl.class_time,
+            cl.class_days,
+            p.first_name || ' ' || p.last_name as professor_name,
+            cl.start_date,
+            cl.end_date,
+            cl.class_id IN (SELECT class_id FROM current_class) as is_current
+        FROM classes cl
+        JOIN courses c ON cl.course_id = c.course_id
+        JOIN professors p ON cl.professor_id = p.professor_id
+        WHERE cl.start_date >= CURRENT_DATE OR cl.class_id IN (SELECT class_id FROM current_class)
+        ORDER BY cl.start_date
+    ''', (registration_id,))
+    classes = [dict(row) for row in cursor.fetchall()]
+    cursor.close()
+    return classes
+
+def delete_registration_db(conn, registration_id, branch_id=None):
+    """حذف ثبت‌نام و پرداخت آن؛ تصویر قبل از حذف را برمی‌گرداند (None اگر وجود نداشته باشد)"""
+    if not _branch_ids(conn, 'registrations', 'registration_id', [registration_id], branch_id):
+        return None
+    rows = _remove_registrations(conn, 'registration_id', [registration_id], archive=False)
+    if not rows:
+        return None
+    
+    refresh_student_summaries(conn, [rows[0]['membership_id']])
+    return rows[0]['image']
+
+# ==================== حذف و بایگانی گروهی ====================
+# حذف یا انتقال گروهی رکوردها به جداول بایگانی در یک تراکنش؛ وابستگی‌ها
+# برای همه شناسه‌ها با یک کوئری بررسی می‌شوند. هر رکورد بایگانی‌شده به صورت
+# JSONB نگه داشته می‌شود تا با تغییر ستون‌های جدول اصلی ناسازگار نشود.
+# با تعیین branch_id شناسه‌های متعلق به شعبه‌های دیگر نادیده گرفته می‌شوند.
+register_schema('''
+    CREATE TABLE IF NOT EXISTS professors_archive (
+        professor_id INTEGER PRIMARY KEY,
+        record JSONB NOT NULL,
+        archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+''', '''
+    CREATE TABLE IF NOT EXISTS students_archive (
+        membership_id INTEGER PRIMARY KEY,
+        record JSONB NOT NULL,
+        archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+''', '''
+    CREATE TABLE IF NOT EXISTS classes_archive (
+        class_id INTEGER PRIMARY KEY,
+        record JSONB NOT NULL,
+        archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+''', '''
+    CREATE TABLE IF NOT EXISTS registrations_archive (
+        registration_id INTEGER PRIMARY KEY,
+        record JSONB NOT NULL,
+        payment_record JSONB,
+        archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+''')
+
+BATCH_ACTIONS = ('delete', 'archive')
+
+def _parse_ids(ids):
+    """تبدیل لیست شناسه‌های فرم به اعداد صحیح یکتا"""
+    parsed = set()
+    for value in ids:
+        try:
+            parsed.add(int(value))
+        except (TypeError, ValueError):
+            continue
+    return sorted(parsed)
+
+def _remove_registrations(conn, column, ids, archive):
+    """حذف یا بایگانی گروهی ثبت‌نام‌ها و پرداخت‌هایشان بر اساس یک ستون (registration_id، membership_id یا class_id)"""
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute(f'''
+        WITH removed AS (
+            DELETE FROM registrations WHERE {column} = ANY(%(ids)s)
+            RETURNING *
+        ), removed_payments AS (
+            DELETE FROM payments py
+            USING removed
+            WHERE py.payment_id = removed.payment_id
+            RETURNING py.*
+        ), archived AS (
+            INSERT INTO registrations_archive (registration_id, record, payment_record)
+            SELECT removed.registration_id, to_jsonb(removed), to_jsonb(rp)
+            FROM removed
+            LEFT JOIN removed_payments rp ON rp.payment_id = removed.payment_id
+            WHERE %(archive)s
+            ON CONFLICT (registration_id) DO UPDATE
+            SET record = EXCLUDED.record, payment_record = EXCLUDED.payment_record,
+                archived_at = CURRENT_TIMESTAMP
+        )
+        SELECT removed.registration_id, removed.membership_id,
+               rp.payment_id, rp.payment_date, rp.payment_status, rp.payment_method, rp.amount,
+               rp.branch_id, cl.course_id, cl.professor_id,
+               to_jsonb(removed) || jsonb_build_object('payment', to_jsonb(rp)) AS image
+        FROM removed
+        LEFT JOIN removed_payments rp ON rp.payment_id = removed.payment_id
+        LEFT JOIN classes cl ON cl.class_id = removed.class_id
+    ''', {'ids': ids, 'archive': archive})
+    rows = cursor.fetchall()
+    cursor.close()
+    
+    # پرداخت‌های حذف‌شده از جداول تجمیعی کسر می‌شوند؛ بایگانی سابقه درآمد را حفظ می‌کند
+    # (rebuild_payment_rollups نیز پرداخت‌های registrations_archive را می‌شمارد)
+    if not archive:
+        apply_payment_rollup_deltas(conn, removed=[dict(row) for row in rows if row['payment_id']])
+    
+    return rows
+
+def _blocked_ids(conn, query, ids):
+    """شناسه‌هایی که رکورد وابسته دارند (بررسی یکجا برای همه شناسه‌ها)"""
     cursor = conn.cursor()
+    cursor.execute(query, (ids,))
+    blocked = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return blocked
+
+def _move_rows(conn, table, key, ids, archive, archive_record='to_jsonb(moved)', extra_ctes=''):
+    """حذف گروهی رکوردها و در صورت نیاز انتقال آن‌ها به جدول بایگانی
     
-    # پیدا کردن payment_id مرتبط
-    cursor.execute('SELECT payment_id FROM registrations WHERE registration_id = %s', (registration_id,))
-    result = cursor.fetchone()
-    payment_id = result[0] if result else None
+    خروجی: {شناسه: تصویر رکورد پیش از حذف} برای گزارش تغییرات
+    """
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        WITH {extra_ctes} moved AS (
+            DELETE FROM {table} WHERE {key} = ANY(%(ids)s)
+            RETURNING *
+        ), archived AS (
+            INSERT INTO {table}_archive ({key}, record)
+            SELECT moved.{key}, {archive_record}
+            FROM moved
+            WHERE %(archive)s
+            ON CONFLICT ({key}) DO UPDATE
+            SET record = EXCLUDED.record, archived_at = CURRENT_TIMESTAMP
+        )
+        SELECT {key}, to_jsonb(moved) FROM moved
+    ''', {'ids': ids, 'archive': archive})
+    moved = dict(cursor.fetchall())
+    cursor.close()
+    return moved
+
+def batch_remove_professors(conn, ids, archive=False, branch_id=None):
+    """حذف یا بایگانی گروهی اساتید (اساتید دارای کلاس حذف نمی‌شوند)
     
-    # حذف ثبت‌نام
-    cursor.execute('DELETE FROM registrations WHERE registration_id = %s', (registration_id,))
+    خروجی: (تصویر رکوردهای حذف‌شده، شناسه‌های دارای وابستگی، تصویر ثبت‌نام‌های
+    بایگانی‌شده همراه آن‌ها) مانند سایر توابع batch_remove_*
+    """
+    ids = _branch_ids(conn, 'professors', 'professor_id', _parse_ids(ids), branch_id)
+    if not ids:
+        return {}, [], {}
     
-    # حذف پرداخت مرتبط
-    if payment_id:
-        cursor.execute('DELETE FROM payments WHERE payment_id = %s', (payment_id,))
+    blocked = _blocked_ids(conn, 'SELECT DISTINCT professor_id FROM classes WHERE professor_id = ANY(%s)', ids)
+    allowed = [i for i in ids if i not in blocked]
     
-    conn.commit()
+    moved = {}
+    if allowed:
+        moved = _move_rows(
+            conn, 'professors', 'professor_id', allowed, archive,
+            archive_record='''to_jsonb(moved) || jsonb_build_object('languages', COALESCE(
+                (SELECT jsonb_agg(to_jsonb(l)) FROM languages l WHERE l.professor_id = moved.professor_id),
+                '[]'::jsonb))''',
+            extra_ctes='languages AS (DELETE FROM professor_languages WHERE professor_id = ANY(%(ids)s) RETURNING *),'
+        )
+    return moved, sorted(blocked), {}
+
+def batch_remove_students(conn, ids, archive=False, branch_id=None):
+    """حذف یا بایگانی گروهی دانش‌آموزان
+    
+    در حالت حذف، دانش‌آموزان دارای ثبت‌نام حذف نمی‌شوند؛ در حالت بایگانی
+    ثبت‌نام‌ها و پرداخت‌های آن‌ها نیز به بایگانی منتقل می‌شوند.
+    """
+    ids = _branch_ids(conn, 'students', 'membership_id', _parse_ids(ids), branch_id)
+    if not ids:
+        return {}, [], {}
+    
+    blocked = set()
+    cascaded = {}
+    if archive:
+        rows = _remove_registrations(conn, 'membership_id', ids, archive=True)
+        cascaded = {row['registration_id']: row['image'] for row in rows}
+    else:
+        blocked = _blocked_ids(conn, 'SELECT DISTINCT membership_id FROM registrations WHERE membership_id = ANY(%s)', ids)
+    allowed = [i for i in ids if i not in blocked]
+    
+    moved = _move_rows(conn, 'students', 'membership_id', allowed, archive) if allowed else {}
+    return moved, sorted(blocked), cascaded
+
+def batch_remove_classes(conn, ids, archive=False, branch_id=None):
+    """حذف یا بایگانی گروهی کلاس‌ها
+    
+    در حالت حذف، کلاس‌های دارای ثبت‌نام حذف نمی‌شوند؛ در حالت بایگانی
+    ثبت‌نام‌ها و پرداخت‌های کلاس نیز به بایگانی منتقل می‌شوند.
+    """
+    ids = _branch_ids(conn, 'classes', 'class_id', _parse_ids(ids), branch_id)
+    if not ids:
+        return {}, [], {}
+    
+    blocked = set()
+    cascaded = {}
+    if archive:
+        rows = _remove_registrations(conn, 'class_id', ids, archive=True)
+        cascaded = {row['registration_id']: row['image'] for row in rows}
+        refresh_student_summaries(conn, {row['membership_id'] for row in rows})
+    else:
+        blocked = _blocked_ids(conn, 'SELECT DISTINCT class_id FROM registrations WHERE class_id = ANY(%s)', ids)
+    allowed = [i for i in ids if i not in blocked]
+    
+    moved = _move_rows(conn, 'classes', 'class_id', allowed, archive) if allowed else {}
+    _on_commit(conn, invalidate_schedule_index)
+    return moved, sorted(blocked), cascaded
+
+def batch_remove_registrations(conn, ids, archive=False, branch_id=None):
+    """حذف یا بایگانی گروهی ثبت‌نام‌ها به همراه پرداخت‌هایشان"""
+    ids = _branch_ids(conn, 'registrations', 'registration_id', _parse_ids(ids), branch_id)
+    if not ids:
+        return {}, [], {}
+    
+    rows = _remove_registrations(conn, 'registration_id', ids, archive)
+    refresh_student_summaries(conn, {row['membership_id'] for row in rows})
+    return {row['registration_id']: row['image'] for row in rows}, [], {}
+
+# ==================== حضور و غیاب ====================
+# برای هر ثبت‌نام یک ردیف با دو رشته بیتی: present (حاضر بودن) و recorded (جلساتی
+# که حضور و غیاب آن‌ها ثبت شده)؛ بیت n-ام (از چپ، از صفر) مربوط به جلسه n+1 است.
+# نرخ حضور با شمارش بیت‌های یک محاسبه می‌شود و نیازی به یک ردیف برای هر جلسه نیست.
+register_schema('''
+    CREATE TABLE IF NOT EXISTS attendance (
+        registration_id INTEGER PRIMARY KEY,
+        present BIT VARYING NOT NULL DEFAULT B'',
+        recorded BIT VARYING NOT NULL DEFAULT B'',
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+''', '''
+    DO $$
+    BEGIN
+        -- کلید خارجی فقط تا زمانی که ثبت‌نام‌ها پارتیشن نشده‌اند (پس از آن partition_references)
+        IF (SELECT relkind FROM pg_class WHERE oid = 'registrations'::regclass) <> 'p'
+           AND NOT EXISTS (SELECT 1 FROM pg_constraint
+                           WHERE conrelid = 'attendance'::regclass AND contype = 'f'
+                             AND confrelid = 'registrations'::regclass) THEN
+            ALTER TABLE attendance ADD CONSTRAINT attendance_registration_id_fkey
+                FOREIGN KEY (registration_id) REFERENCES registrations(registration_id) ON DELETE CASCADE;
+        END IF;
+    END $$
+''', f'''
+    ALTER TABLE attendance ADD COLUMN IF NOT EXISTS branch_id INTEGER NOT NULL DEFAULT {DEFAULT_BRANCH_ID}
+''', '''
+    DROP TRIGGER IF EXISTS registrations_attendance_delete ON registrations;
+    DROP FUNCTION IF EXISTS delete_registration_attendance()
+''', '''
+    CREATE OR REPLACE FUNCTION attendance_set_bit(bits BIT VARYING, session INTEGER, value INTEGER)
+    RETURNS BIT VARYING AS $$
+        SELECT set_bit(
+            CASE WHEN length(bits) < session
+                 THEN bits || repeat('0', session - length(bits))::BIT VARYING
+                 ELSE bits END,
+            session - 1, value)
+    $$ LANGUAGE SQL IMMUTABLE
+''', '''
+    DO $$
+    BEGIN
+        -- bit_count از PostgreSQL 14 موجود است؛ در نسخه‌های قدیمی‌تر از متن بیت‌ها شمرده می‌شود
+        IF current_setting('server_version_num')::INTEGER >= 140000 THEN
+            CREATE OR REPLACE FUNCTION attendance_bit_count(bits BIT VARYING) RETURNS INTEGER
+            AS $f$ SELECT bit_count(bits)::INTEGER $f$ LANGUAGE SQL IMMUTABLE;
+        ELSE
+            CREATE OR REPLACE FUNCTION attendance_bit_count(bits BIT VARYING) RETURNS INTEGER
+            AS $f$ SELECT length(replace(bits::TEXT, '0', '')) $f$ LANGUAGE SQL IMMUTABLE;
+        END IF;
+    END $$
+''')
+
+# با حذف ثبت‌نام حضور و غیاب آن هم حذف می‌شود
+_register_partition_reference('attendance', 'registration_id', 'registrations', 'registration_id', 'CASCADE')
+
+def mark_class_attendance_db(conn, class_id, session, present_ids, branch_id=None):
+    """ثبت حضور و غیاب یک جلسه برای همه ثبت‌نام‌های کلاس در یک دستور
+    
+    present_ids: شناسه ثبت‌نام‌های حاضر؛ بقیه ثبت‌نام‌های کلاس غایب ثبت می‌شوند.
+    branch_id: در صورت تعیین، فقط ثبت‌نام‌های همان شعبه
+    """
+    _write(conn, '''
+        INSERT INTO attendance (registration_id, branch_id, present, recorded)
+        SELECT r.registration_id, r.branch_id,
+               attendance_set_bit(B'', %(session)s,
+                                  CASE WHEN r.registration_id = ANY(%(present)s::INTEGER[]) THEN 1 ELSE 0 END),
+               attendance_set_bit(B'', %(session)s, 1)
+        FROM registrations r
+        WHERE r.class_id = %(class_id)s
+          AND (%(branch_id)s::integer IS NULL OR r.branch_id = %(branch_id)s::integer)
+        ON CONFLICT (registration_id) DO UPDATE SET
+            present = attendance_set_bit(attendance.present, %(session)s, get_bit(EXCLUDED.present, %(session)s - 1)),
+            recorded = attendance_set_bit(attendance.recorded, %(session)s, 1),
+            updated_at = CURRENT_TIMESTAMP
+    ''', {'class_id': class_id, 'session': session, 'present': list(present_ids), 'branch_id': branch_id})
+
+def mark_attendance_db(conn, registration_id, session, present):
+    """ثبت یا اصلاح حضور یک ثبت‌نام در یک جلسه"""
+    _write(conn, '''
+        INSERT INTO attendance (registration_id, branch_id, present, recorded)
+        SELECT registration_id, branch_id,
+               attendance_set_bit(B'', %(session)s, %(present)s),
+               attendance_set_bit(B'', %(session)s, 1)
+        FROM registrations WHERE registration_id = %(registration_id)s
+        ON CONFLICT (registration_id) DO UPDATE SET
+            present = attendance_set_bit(attendance.present, %(session)s, %(present)s),
+            recorded = attendance_set_bit(attendance.recorded, %(session)s, 1),
+            updated_at = CURRENT_TIMESTAMP
+    ''', {'registration_id': registration_id, 'session': session, 'present': 1 if present else 0})
+
+def get_class_attendance(conn, class_id, branch_id=None):
+    """جدول حضور و غیاب کلاس: هر ثبت‌نام با رشته بیت‌ها و نرخ حضور"""
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute('''
+        SELECT r.registration_id, r.membership_id,
+               s.first_name || ' ' || s.last_name as student_name,
+               COALESCE(a.present::TEXT, '') as present,
+               COALESCE(a.recorded::TEXT, '') as recorded,
+               COALESCE(attendance_bit_count(a.present), 0) as attended,
+               COALESCE(attendance_bit_count(a.recorded), 0) as held,
+               ROUND(100.0 * attendance_bit_count(a.present) / NULLIF(attendance_bit_count(a.recorded), 0), 1)::FLOAT as rate
+        FROM registrations r
+        JOIN students s ON r.membership_id = s.membership_id
+        LEFT JOIN attendance a ON a.registration_id = r.registration_id
+        WHERE r.class_id = %s
+          AND (%s::integer IS NULL OR r.branch_id = %s::integer)
+        ORDER BY s.last_name, s.first_name
+    ''', (class_id, branch_id, branch_id))
+    rows = cursor.fetchall()
     cursor.close()
+    return rows
+
+ATTENDANCE_RATE_GROUPS = {
+    'class': ('r.class_id', "c.course_title || ' - ' || cl.class_time"),
+    'student': ('r.membership_id', "s.first_name || ' ' || s.last_name"),
+}
+
+def get_attendance_rates(conn, group_by='class', class_id=None, membership_id=None, branch_id=None):
+    """نرخ حضور به تفکیک کلاس یا دانش‌آموز (مجموع بیت‌ها، بدون شمارش ردیف جلسات)"""
+    key, label = ATTENDANCE_RATE_GROUPS[group_by]
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute(f'''
+        SELECT {key} as id, {label} as name,
+               SUM(attendance_bit_count(a.present)) as attended,
+               SUM(attendance_bit_count(a.recorded)) as held,
+               ROUND(100.0 * SUM(attendance_bit_count(a.present))
+                     / NULLIF(SUM(attendance_bit_count(a.recorded)), 0), 1)::FLOAT as rate
+        FROM attendance a
+        JOIN registrations r ON a.registration_id = r.registration_id
+        JOIN students s ON r.membership_id = s.membership_id
+        JOIN classes cl ON r.class_id = cl.class_id
+        JOIN courses c ON cl.course_id = c.course_id
+        WHERE (%(class_id)s IS NULL OR r.class_id = %(class_id)s)
+          AND (%(membership_id)s IS NULL OR r.membership_id = %(membership_id)s)
+          AND (%(branch_id)s::integer IS NULL OR r.branch_id = %(branch_id)s::integer)
+        GROUP BY {key}, {label}
+        ORDER BY rate NULLS LAST, name
+    ''', {'class_id': class_id, 'membership_id': membership_id, 'branch_id': branch_id})
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
 
 # ==================== توابع پرداخت‌ها ====================
 def get_payments_list(conn, filters=None):
     """دریافت لیست پرداخت‌ها"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor = conn.cursor(cursor_factory=RecordCursor)
     
     query = '''
         SELECT p.*, 
@@ -620,6 +1996,10 @@ def get_payments_list(conn, filters=None):
         if filters.get('end_date'):
             query += ' AND p.payment_date <= %s'
             params.append(filters['end_date'])
+        
+        if filters.get('branch_id'):
+            query += ' AND p.branch_id = %s'
+            params.append(filters['branch_id'])
     
     query += ' ORDER BY p.payment_date DESC'
     
@@ -629,17 +2009,16 @@ def get_payments_list(conn, filters=None):
     return payments
 
 def get_payment_stats(conn):
-    """دریافت آمار پرداخت‌ها"""
+    """دریافت آمار پرداخت‌ها از جدول تجمیعی ماهانه"""
     cursor = conn.cursor(cursor_factory=DictCursor)
     
-    cursor.execute('SELECT SUM(amount) FROM payments WHERE payment_status = %s', ('تکمیل',))
-    total_completed = cursor.fetchone()[0] or 0
-    
-    cursor.execute('SELECT SUM(amount) FROM payments WHERE payment_status = %s', ('انتظار',))
-    total_pending = cursor.fetchone()[0] or 0
-    
-    cursor.execute('SELECT COUNT(*) FROM payments')
-    payment_count = cursor.fetchone()[0]
+    cursor.execute('''
+        SELECT COALESCE(SUM(total_amount) FILTER (WHERE payment_status = %s), 0),
+               COALESCE(SUM(total_amount) FILTER (WHERE payment_status = %s), 0),
+               COALESCE(SUM(payment_count), 0)
+        FROM payment_rollup_monthly
+    ''', ('تکمیل', 'انتظار'))
+    total_completed, total_pending, payment_count = cursor.fetchone()
     
     cursor.close()
     
@@ -651,14 +2030,11 @@ def get_payment_stats(conn):
 
 def update_payment_db(conn, payment_id, amount, payment_method, payment_status):
     """به‌روزرسانی پرداخت"""
-    cursor = conn.cursor()
-    cursor.execute('''
+    _write(conn, '''
         UPDATE payments 
         SET amount = %s, payment_method = %s, payment_status = %s
         WHERE payment_id = %s
     ''', (amount, payment_method, payment_status, payment_id))
-    conn.commit()
-    cursor.close()
 
 def get_payment_by_id(conn, payment_id):
     """دریافت اطلاعات پرداخت با ID"""
@@ -667,10 +2043,411 @@ def get_payment_by_id(conn, payment_id):
     payment = cursor.fetchone()
     cursor.close()
     return payment
+
+def get_registration_for_payment(conn, registration_id, branch_id=None):
+    """دریافت اطلاعات ثبت‌نام برای صفحه ثبت پرداخت (با تعیین شعبه، فقط از همان شعبه)"""
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute('''
+        SELECT r.registration_id, r.payment_id,
+               s.first_name || ' ' || s.last_name as student_name,
+               c.course_title, cl.class_time, cl.class_days
+        FROM registrations r
+        JOIN students s ON r.membership_id = s.membership_id
+        JOIN classes cl ON r.class_id = cl.class_id
+        JOIN courses c ON cl.course_id = c.course_id
+        WHERE r.registration_id = %s AND (%s::integer IS NULL OR r.branch_id = %s::integer)
+    ''', (registration_id, branch_id, branch_id))
+    registration = cursor.fetchone()
+    cursor.close()
+    return registration
+
+# ثبت‌نام و پرداخت آن در یک دستور (CTE) نوشته می‌شوند؛ تصویر قبل و بعد پرداخت
+# از همان دستور برمی‌گردد تا جداول تجمیعی بدون کوئری اضافه به‌روز شوند.
+def _payment_image(row, prefix):
+    """ساخت تصویر پرداخت (برای جداول تجمیعی) از ستون‌های بازگشتی"""
+    if row[prefix + 'payment_id'] is None:
+        return None
+    return {
+        'payment_date': row[prefix + 'payment_date'],
+        'payment_status': row[prefix + 'payment_status'],
+        'payment_method': row[prefix + 'payment_method'],
+        'course_id': row[prefix + 'course_id'],
+        'professor_id': row[prefix + 'professor_id'],
+        'branch_id': row[prefix + 'branch_id'],
+        'amount': row[prefix + 'amount']
+    }
+
+def create_registration_with_payment(conn, membership_id, class_id, amount=0, payment_method=None, payment_status=None):
+    """ایجاد ثبت‌نام و پرداخت اختیاری آن در یک دستور"""
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute('''
+        WITH class_branch AS (
+            SELECT branch_id FROM classes WHERE class_id = %(class_id)s
+        ), new_payment AS (
+            INSERT INTO payments (amount, payment_method, payment_status, payment_date, branch_id)
+            SELECT %(amount)s, %(payment_method)s, %(payment_status)s, CURRENT_DATE, branch_id
+            FROM class_branch
+            WHERE %(amount)s > 0
+            RETURNING payment_id, amount, payment_status, payment_method, payment_date, branch_id
+        ), new_registration AS (
+            INSERT INTO registrations (membership_id, class_id, registration_date, payment_id, branch_id)
+            SELECT %(membership_id)s, %(class_id)s, CURRENT_DATE, (SELECT payment_id FROM new_payment), branch_id
+            FROM class_branch
+            RETURNING registration_id, membership_id, class_id
+        )
+        SELECT nr.registration_id, nr.membership_id,
+               np.payment_id AS new_payment_id, np.amount AS new_amount,
+               np.payment_status AS new_payment_status, np.payment_method AS new_payment_method,
+               np.payment_date AS new_payment_date, np.branch_id AS new_branch_id,
+               cl.course_id AS new_course_id, cl.professor_id AS new_professor_id
+        FROM new_registration nr
+        JOIN classes cl ON cl.class_id = nr.class_id
+        LEFT JOIN new_payment np ON TRUE
+    ''', {
+        'membership_id': membership_id, 'class_id': class_id, 'amount': amount or 0,
+        'payment_method': payment_method, 'payment_status': payment_status
+    })
+    row = cursor.fetchone()
+    cursor.close()
+    
+    apply_payment_rollup_delta(conn, None, _payment_image(row, 'new_'))
+    refresh_student_summaries(conn, [row['membership_id']])
+    return row['registration_id']
+
+def save_registration_payment(conn, registration_id, payment_action, amount=0, payment_method=None,
+                              payment_status=None, membership_id=None, class_id=None, row_version=None,
+                              branch_id=None):
+    """به‌روزرسانی ثبت‌نام و درج/ویرایش/حذف پرداخت آن در یک دستور
+    
+    payment_action: 'upsert' برای ثبت یا ویرایش پرداخت، 'delete' برای حذف آن و None برای عدم تغییر
+    membership_id / class_id: در صورت None مقدار فعلی حفظ می‌شود
+    row_version: در صورت تعیین، فقط اگر ثبت‌نام از آن نسخه تغییر نکرده باشد
+    branch_id: در صورت تعیین، فقط اگر ثبت‌نام متعلق به همان شعبه باشد
+    خروجی: تصویر ثبت‌نام پیش از تغییر برای گزارش تغییرات (None در صورت تعارض نسخه یا نبود ثبت‌نام)
+    """
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute('''
+        WITH current_row AS (
+            SELECT r.registration_id, r.membership_id, r.class_id, r.payment_id, r.branch_id,
+                   py.amount, py.payment_status, py.payment_method, py.payment_date,
+                   py.branch_id AS payment_branch_id, cl.course_id, cl.professor_id,
+                   to_jsonb(r) || jsonb_build_object('payment', to_jsonb(py)) AS before_image
+            FROM registrations r
+            JOIN classes cl ON r.class_id = cl.class_id
+            LEFT JOIN payments py ON r.payment_id = py.payment_id
+            WHERE r.registration_id = %(registration_id)s
+              AND (%(row_version)s::integer IS NULL OR r.row_version = %(row_version)s::integer)
+              AND (%(branch_id)s::integer IS NULL OR r.branch_id = %(branch_id)s::integer)
+            FOR UPDATE OF r
+        ), updated_payment AS (
+            UPDATE payments py
+            SET amount = %(amount)s, payment_method = %(payment_method)s,
+                payment_status = %(payment_status)s, payment_date = CURRENT_DATE
+            FROM current_row
+            WHERE py.payment_id = current_row.payment_id AND %(payment_action)s = 'upsert'
+            RETURNING py.payment_id, py.amount, py.payment_status, py.payment_method, py.payment_date, py.branch_id
+        ), inserted_payment AS (
+            INSERT INTO payments (amount, payment_method, payment_status, payment_date, branch_id)
+            SELECT %(amount)s, %(payment_method)s, %(payment_status)s, CURRENT_DATE, current_row.branch_id
+            FROM current_row
+            WHERE current_row.payment_id IS NULL AND %(payment_action)s = 'upsert'
+            RETURNING payment_id, amount, payment_status, payment_method, payment_date, branch_id
+        ), deleted_payment AS (
+            DELETE FROM payments py
+            USING current_row
+            WHERE py.payment_id = current_row.payment_id AND %(payment_action)s = 'delete'
+            RETURNING py.payment_id
+        ), new_payment AS (
+            SELECT * FROM updated_payment
+            UNION ALL
+            SELECT * FROM inserted_payment
+        ), updated_registration AS (
+            UPDATE registrations r
+            SET membership_id = COALESCE(%(membership_id)s, r.membership_id),
+                class_id = COALESCE(%(class_id)s, r.class_id),
+                payment_id = CASE WHEN %(payment_action)s = 'delete' THEN NULL
+                                  ELSE COALESCE((SELECT payment_id FROM new_payment), r.payment_id) END,
+                row_version = r.row_version + 1
+            FROM current_row
+            WHERE r.registration_id = current_row.registration_id
+            RETURNING r.registration_id, r.membership_id, r.class_id
+        )
+        SELECT ur.registration_id, ur.membership_id, cr.membership_id AS old_membership_id,
+               cr.payment_id AS old_payment_id, cr.amount AS old_amount,
+               cr.payment_status AS old_payment_status, cr.payment_method AS old_payment_method,
+               cr.payment_date AS old_payment_date, cr.payment_branch_id AS old_branch_id,
+               cr.course_id AS old_course_id, cr.professor_id AS old_professor_id,
+               COALESCE(np.payment_id, CASE WHEN %(payment_action)s IS NULL THEN cr.payment_id END) AS new_payment_id,
+               COALESCE(np.amount, cr.amount) AS new_amount,
+               COALESCE(np.payment_status, cr.payment_status) AS new_payment_status,
+               COALESCE(np.payment_method, cr.payment_method) AS new_payment_method,
+               COALESCE(np.payment_date, cr.payment_date) AS new_payment_date,
+               COALESCE(np.branch_id, cr.payment_branch_id) AS new_branch_id,
+               cl.course_id AS new_course_id, cl.professor_id AS new_professor_id,
+               cr.before_image
+        FROM updated_registration ur
+        JOIN current_row cr ON cr.registration_id = ur.registration_id
+        JOIN classes cl ON cl.class_id = ur.class_id
+        LEFT JOIN new_payment np ON TRUE
+    ''', {
+        'registration_id': registration_id, 'payment_action': payment_action,
+        'amount': amount or 0, 'payment_method': payment_method, 'payment_status': payment_status,
+        'membership_id': membership_id, 'class_id': class_id, 'row_version': row_version,
+        'branch_id': branch_id
+    })
+    row = cursor.fetchone()
+    cursor.close()
+    
+    if not row:
+        return None
+    
+    apply_payment_rollup_delta(conn, _payment_image(row, 'old_'), _payment_image(row, 'new_'))
+    refresh_student_summaries(conn, {row['membership_id'], row['old_membership_id']})
+    return row['before_image']
+
+# ==================== جداول تجمیعی درآمد ====================
+# جمع مبالغ پرداخت به تفکیک روز/ماه، وضعیت، روش پرداخت، دوره، استاد و شعبه
+# (شعبه خود پرداخت، نه شعبه فعلی دوره).
+# این جداول در مسیرهای ثبت و ویرایش پرداخت به‌صورت افزایشی به‌روز می‌شوند
+# تا گزارش‌ها نیازی به پیمایش کامل جدول payments نداشته باشند.
+register_schema('''
+    CREATE TABLE IF NOT EXISTS payment_rollup_daily (
+        rollup_date DATE NOT NULL,
+        payment_status VARCHAR(50) NOT NULL,
+        payment_method VARCHAR(50) NOT NULL,
+        course_id INTEGER NOT NULL,
+        professor_id INTEGER NOT NULL,
+        branch_id INTEGER NOT NULL,
+        total_amount NUMERIC(16, 2) NOT NULL DEFAULT 0,
+        payment_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (rollup_date, payment_status, payment_method, course_id, professor_id, branch_id)
+    )
+''', '''
+    CREATE TABLE IF NOT EXISTS payment_rollup_monthly (
+        rollup_month DATE NOT NULL,
+        payment_status VARCHAR(50) NOT NULL,
+        payment_method VARCHAR(50) NOT NULL,
+        course_id INTEGER NOT NULL,
+        professor_id INTEGER NOT NULL,
+        branch_id INTEGER NOT NULL,
+        total_amount NUMERIC(16, 2) NOT NULL DEFAULT 0,
+        payment_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (rollup_month, payment_status, payment_method, course_id, professor_id, branch_id)
+    )
+''')
+
+# ردیف‌های جداول قدیمی بدون ستون شعبه حذف نمی‌شوند (ممکن است سابقه ترم‌های
+# بایگانی‌شده در فایل را داشته باشند)؛ شعبه آن‌ها از دوره هر ردیف گرفته می‌شود
+for _table, _period in (('payment_rollup_daily', 'rollup_date'), ('payment_rollup_monthly', 'rollup_month')):
+    register_schema(f'''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_attribute
+                           WHERE attrelid = '{_table}'::regclass AND attname = 'branch_id' AND NOT attisdropped) THEN
+                ALTER TABLE {_table} ADD COLUMN branch_id INTEGER NOT NULL DEFAULT 0;
+                UPDATE {_table} t SET branch_id = c.branch_id FROM courses c WHERE c.course_id = t.course_id;
+                ALTER TABLE {_table} ALTER COLUMN branch_id DROP DEFAULT;
+                ALTER TABLE {_table} DROP CONSTRAINT {_table}_pkey;
+                ALTER TABLE {_table} ADD PRIMARY KEY
+                    ({_period}, payment_status, payment_method, course_id, professor_id, branch_id);
+            END IF;
+        END $$
+    ''')
+
+ROLLUP_GROUPS = {
+    'status': 'payment_status',
+    'method': 'payment_method',
+    'course': 'course_id',
+    'professor': 'professor_id',
+    'branch': 'branch_id'
+}
+
+def get_payment_snapshot(conn, registration_id):
+    """دریافت وضعیت فعلی پرداخت یک ثبت‌نام برای به‌روزرسانی جداول تجمیعی"""
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute('''
+        SELECT py.payment_date, py.payment_status, py.payment_method,
+               cl.course_id, cl.professor_id, py.branch_id, py.amount
+        FROM registrations r
+        JOIN payments py ON r.payment_id = py.payment_id
+        JOIN classes cl ON r.class_id = cl.class_id
+        WHERE r.registration_id = %s
+    ''', (registration_id,))
+    snapshot = cursor.fetchone()
+    cursor.close()
+    return dict(snapshot) if snapshot else None
+
+def apply_payment_rollup_delta(conn, before, after):
+    """اعمال تغییر یک پرداخت (حذف مقدار قبلی و افزودن مقدار جدید) روی جداول تجمیعی"""
+    if before == after:
+        return
+    
+    apply_payment_rollup_deltas(conn, removed=[before] if before else [], added=[after] if after else [])
+
+def apply_payment_rollup_deltas(conn, removed=(), added=()):
+    """اعمال گروهی حذف/افزودن چند پرداخت روی جداول تجمیعی در یک دستور"""
+    deltas = []
+    snapshots = [(snapshot, -1) for snapshot in removed] + [(snapshot, 1) for snapshot in added]
+    for snapshot, sign in snapshots:
+        if snapshot and snapshot['payment_date']:
+            deltas.append((
+                snapshot['payment_date'], snapshot['payment_status'] or '',
+                snapshot['payment_method'] or '', snapshot['course_id'] or 0,
+                snapshot['professor_id'] or 0, snapshot['branch_id'] or 0,
+                sign * (snapshot['amount'] or 0), sign
+            ))
+    if not deltas:
+        return
+    
+    cursor = conn.cursor()
+    values = ', '.join(
+        cursor.mogrify('(%s::date, %s, %s, %s::integer, %s::integer, %s::integer, %s::numeric, %s::integer)',
+                       row).decode()
+        for row in deltas
+    )
+    # هر دو جدول در یک دستور به‌روز می‌شوند
+    cursor.execute(f'''
+        WITH delta (rollup_date, payment_status, payment_method, course_id, professor_id, branch_id, amount, cnt) AS (
+            VALUES {values}
+        ), daily AS (
+            INSERT INTO payment_rollup_daily AS t
+                (rollup_date, payment_status, payment_method, course_id, professor_id, branch_id,
+                 total_amount, payment_count)
+            SELECT rollup_date, payment_status, payment_method, course_id, professor_id, branch_id,
+                   SUM(amount), SUM(cnt)
+            FROM delta
+            GROUP BY rollup_date, payment_status, payment_method, course_id, professor_id, branch_id
+            ON CONFLICT (rollup_date, payment_status, payment_method, course_id, professor_id, branch_id)
+            DO UPDATE SET total_amount = t.total_amount + EXCLUDED.total_amount,
+                          payment_count = t.payment_count + EXCLUDED.payment_count
+        )
+        INSERT INTO payment_rollup_monthly AS t
+            (rollup_month, payment_status, payment_method, course_id, professor_id, branch_id,
+             total_amount, payment_count)
+        SELECT date_trunc('month', rollup_date)::date, payment_status, payment_method, course_id, professor_id,
+               branch_id, SUM(amount), SUM(cnt)
+        FROM delta
+        GROUP BY 1, payment_status, payment_method, course_id, professor_id, branch_id
+        ON CONFLICT (rollup_month, payment_status, payment_method, course_id, professor_id, branch_id)
+        DO UPDATE SET total_amount = t.total_amount + EXCLUDED.total_amount,
+                      payment_count = t.payment_count + EXCLUDED.payment_count
+    ''')
+    cursor.close()
+
+def rebuild_payment_rollups(conn):
+    """بازسازی کامل جداول تجمیعی از روی پرداخت‌ها
+    
+    پرداخت‌های بایگانی‌شده همراه ثبت‌نام (registrations_archive) نیز شمرده می‌شوند،
+    چون بایگانی گروهی سهم آن‌ها را از جداول تجمیعی کم نمی‌کند و سابقه درآمد حفظ
+    می‌شود. دوره و استاد آن‌ها از کلاس (یا بایگانی کلاس) به دست می‌آید.
+    پارتیشن‌های ترمی که archive_terms.py در فایل ذخیره و حذف کرده در پایگاه داده
+    نیستند و با بازسازی از گزارش‌ها حذف می‌شوند.
+    """
+    cursor = conn.cursor()
+    cursor.execute('TRUNCATE payment_rollup_daily, payment_rollup_monthly')
+    cursor.execute('''
+        INSERT INTO payment_rollup_daily
+            (rollup_date, payment_status, payment_method, course_id, professor_id, branch_id,
+             total_amount, payment_count)
+        SELECT payment_date, COALESCE(payment_status, ''), COALESCE(payment_method, ''),
+               COALESCE(course_id, 0), COALESCE(professor_id, 0), COALESCE(branch_id, 0),
+               COALESCE(SUM(amount), 0), COUNT(*)
+        FROM (
+            SELECT py.payment_date, py.payment_status, py.payment_method,
+                   cl.course_id, cl.professor_id, py.branch_id, py.amount
+            FROM payments py
+            LEFT JOIN registrations r ON r.payment_id = py.payment_id
+            LEFT JOIN classes cl ON r.class_id = cl.class_id
+            UNION ALL
+            SELECT (ra.payment_record->>'payment_date')::date,
+                   ra.payment_record->>'payment_status', ra.payment_record->>'payment_method',
+                   COALESCE(cl.course_id, (ca.record->>'course_id')::integer),
+                   COALESCE(cl.professor_id, (ca.record->>'professor_id')::integer),
+                   (ra.payment_record->>'branch_id')::integer, (ra.payment_record->>'amount')::numeric
+            FROM registrations_archive ra
+            LEFT JOIN classes cl ON cl.class_id = (ra.record->>'class_id')::integer
+            LEFT JOIN classes_archive ca ON ca.class_id = (ra.record->>'class_id')::integer
+            WHERE ra.payment_record IS NOT NULL
+        ) all_payments
+        WHERE payment_date IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5, 6
+    ''')
+    cursor.execute('''
+        INSERT INTO payment_rollup_monthly
+            (rollup_month, payment_status, payment_method, course_id, professor_id, branch_id,
+             total_amount, payment_count)
+        SELECT date_trunc('month', rollup_date)::date, payment_status, payment_method, course_id, professor_id,
+               branch_id, SUM(total_amount), SUM(payment_count)
+        FROM payment_rollup_daily
+        GROUP BY 1, 2, 3, 4, 5, 6
+    ''')
+    conn.commit()
+    cursor.close()
+
+def ensure_payment_rollups(conn):
+    """پر کردن اولیه جداول تجمیعی برای پایگاه داده‌های موجود"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT NOT EXISTS (SELECT 1 FROM payment_rollup_monthly)
+               AND (EXISTS (SELECT 1 FROM payments)
+                    OR EXISTS (SELECT 1 FROM registrations_archive WHERE payment_record IS NOT NULL))
+    ''')
+    needs_rebuild = cursor.fetchone()[0]
+    cursor.close()
+    
+    if needs_rebuild:
+        rebuild_payment_rollups(conn)
+
+def get_revenue_report(conn, period='monthly', group_by='status', start_date=None, end_date=None):
+    """گزارش درآمد فقط از روی جداول تجمیعی"""
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    
+    if period == 'daily':
+        table, period_column = 'payment_rollup_daily', 'rollup_date'
+    else:
+        table, period_column = 'payment_rollup_monthly', 'rollup_month'
+    group_column = ROLLUP_GROUPS.get(group_by, 'payment_status')
+    
+    if group_column == 'course_id':
+        label = 'COALESCE(c.course_title, \'نامشخص\')'
+        join = 'LEFT JOIN courses c ON c.course_id = t.course_id'
+    elif group_column == 'professor_id':
+        label = 'COALESCE(p.first_name || \' \' || p.last_name, \'نامشخص\')'
+        join = 'LEFT JOIN professors p ON p.professor_id = t.professor_id'
+    elif group_column == 'branch_id':
+        label = 'COALESCE(b.branch_name, \'نامشخص\')'
+        join = 'LEFT JOIN branches b ON b.branch_id = t.branch_id'
+    else:
+        label = f'NULLIF(t.{group_column}, \'\')'
+        join = ''
+    
+    query = f'''
+        SELECT t.{period_column} as period, {label} as group_label,
+               SUM(t.total_amount) as total_amount, SUM(t.payment_count) as payment_count
+        FROM {table} t
+        {join}
+        WHERE t.payment_count <> 0
+    '''
+    params = []
+    
+    if start_date:
+        query += f' AND t.{period_column} >= date_trunc(%s, %s::date)'
+        params.extend(['day' if period == 'daily' else 'month', start_date])
+    
+    if end_date:
+        query += f' AND t.{period_column} <= %s'
+        params.append(end_date)
+    
+    query += ' GROUP BY 1, 2 ORDER BY 1 DESC, 3 DESC'
+    
+    cursor.execute(query, params)
+    report = cursor.fetchall()
+    cursor.close()
+    return report
 # ==================== توابع جستجو ====================
 def search_professors(conn, query, limit=50):
     """جستجوی اساتید"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor = conn.cursor(cursor_factory=RecordCursor)
     cursor.execute('''
         SELECT * FROM professors 
         WHERE first_name ILIKE %s OR last_name ILIKE %s 
@@ -683,7 +2460,7 @@ def search_professors(conn, query, limit=50):
 
 def search_students(conn, query, limit=50):
     """جستجوی دانش‌آموزان"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor = conn.cursor(cursor_factory=RecordCursor)
     cursor.execute('''
         SELECT * FROM students 
         WHERE first_name ILIKE %s OR last_name ILIKE %s 
@@ -697,7 +2474,7 @@ def search_students(conn, query, limit=50):
 
 def search_courses(conn, query, limit=50):
     """جستجوی دوره‌ها"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor = conn.cursor(cursor_factory=RecordCursor)
     cursor.execute('''
         SELECT * FROM courses 
         WHERE course_title ILIKE %s OR course_level ILIKE %s
@@ -710,7 +2487,7 @@ def search_courses(conn, query, limit=50):
 
 def search_classes(conn, query, limit=50):
     """جستجوی کلاس‌ها"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor = conn.cursor(cursor_factory=RecordCursor)
     cursor.execute('''
         SELECT cl.*, c.course_title, p.first_name || ' ' || p.last_name as professor_name
         FROM classes cl
@@ -725,33 +2502,139 @@ def search_classes(conn, query, limit=50):
     return results
 
 # ==================== توابع API ====================
+STUDENT_SEARCH_SQL = '''
+    SELECT membership_id, first_name || ' ' || last_name as name, phone_number
+    FROM students 
+    WHERE first_name ILIKE %s OR last_name ILIKE %s OR phone_number ILIKE %s
+    LIMIT %s
+'''
+
 def api_search_students_db(conn, query, limit=10):
     """جستجوی سریع دانش‌آموزان برای API"""
-    cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('''
-        SELECT membership_id, first_name || ' ' || last_name as name, phone_number
-        FROM students 
-        WHERE first_name ILIKE %s OR last_name ILIKE %s OR phone_number ILIKE %s
-        LIMIT %s
-    ''', (f'%{query}%', f'%{query}%', f'%{query}%', limit))
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute(STUDENT_SEARCH_SQL, (f'%{query}%', f'%{query}%', f'%{query}%', limit))
     
     results = cursor.fetchall()
     cursor.close()
     return results
 
+# ==================== اعلان تغییر ظرفیت کلاس‌ها ====================
+# هر تغییر در ثبت‌نام‌ها یا ظرفیت کلاس، وضعیت جدید کلاس را روی این کانال
+# NOTIFY می‌کند؛ اعلان‌ها پس از commit تراکنش به شنونده‌ها می‌رسند.
+AVAILABILITY_CHANNEL = 'class_availability'
+
+register_schema('''
+    CREATE OR REPLACE FUNCTION notify_class_availability() RETURNS trigger AS $$
+    DECLARE
+        class_ids INTEGER[];
+    BEGIN
+        IF TG_TABLE_NAME = 'classes' THEN
+            class_ids := ARRAY[NEW.class_id];
+        ELSIF TG_OP = 'INSERT' THEN
+            SELECT array_agg(DISTINCT class_id) INTO class_ids FROM new_rows;
+        ELSIF TG_OP = 'DELETE' THEN
+            SELECT array_agg(DISTINCT class_id) INTO class_ids FROM old_rows;
+        ELSE
+            SELECT array_agg(DISTINCT class_id) INTO class_ids
+            FROM (SELECT class_id FROM new_rows UNION SELECT class_id FROM old_rows) changed;
+        END IF;
+
+        PERFORM pg_notify('class_availability', json_build_object(
+            'class_id', cl.class_id,
+            'capacity', cl.capacity,
+            'registered', (SELECT COUNT(*) FROM registrations r WHERE r.class_id = cl.class_id)
+        )::text)
+        FROM classes cl
+        WHERE cl.class_id = ANY(class_ids);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+''', '''
+    DROP TRIGGER IF EXISTS registrations_availability_insert ON registrations;
+    CREATE TRIGGER registrations_availability_insert
+        AFTER INSERT ON registrations REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_class_availability()
+''', '''
+    DROP TRIGGER IF EXISTS registrations_availability_update ON registrations;
+    CREATE TRIGGER registrations_availability_update
+        AFTER UPDATE ON registrations REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_class_availability()
+''', '''
+    DROP TRIGGER IF EXISTS registrations_availability_delete ON registrations;
+    CREATE TRIGGER registrations_availability_delete
+        AFTER DELETE ON registrations REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_class_availability()
+''', '''
+    DROP TRIGGER IF EXISTS classes_availability_capacity ON classes;
+    CREATE TRIGGER classes_availability_capacity
+        AFTER UPDATE OF capacity ON classes
+        FOR EACH ROW WHEN (OLD.capacity IS DISTINCT FROM NEW.capacity)
+        EXECUTE FUNCTION notify_class_availability()
+''')
+
+CLASS_AVAILABILITY_SQL = '''
+    SELECT capacity, 
+           (SELECT COUNT(*) FROM registrations WHERE class_id = %s) as registered
+    FROM classes WHERE class_id = %s
+'''
+
 def get_class_availability_db(conn, class_id):
     """بررسی ظرفیت کلاس برای API"""
     cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('''
-        SELECT capacity, 
-               (SELECT COUNT(*) FROM registrations WHERE class_id = %s) as registered
-        FROM classes WHERE class_id = %s
-    ''', (class_id, class_id))
+    cursor.execute(CLASS_AVAILABILITY_SQL, (class_id, class_id))
     
     result = cursor.fetchone()
     cursor.close()
     return result
 
+# حداکثر تعداد کلاس در یک درخواست گروهی ظرفیت
+MAX_AVAILABILITY_BATCH = 500
+
+def get_classes_availability_db(conn, class_ids=None, course_id=None, level=None, active_only=False,
+                                branch_id=None):
+    """ظرفیت، تعداد ثبت‌نام و جای خالی چند کلاس در یک پرس‌وجوی گروهی
+    
+    کلاس‌ها با فهرست شناسه یا فیلتر دوره / سطح انتخاب می‌شوند و تعداد
+    ثبت‌نام‌ها فقط برای همان کلاس‌ها و با یک GROUP BY شمارش می‌شود.
+    """
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute('''
+        WITH selected AS (
+            SELECT cl.class_id, cl.capacity
+            FROM classes cl
+            JOIN courses c ON cl.course_id = c.course_id
+            WHERE (%(class_ids)s::int[] IS NULL OR cl.class_id = ANY(%(class_ids)s::int[]))
+              AND (%(course_id)s::int IS NULL OR cl.course_id = %(course_id)s::int)
+              AND (%(level)s::text IS NULL OR c.course_level = %(level)s::text)
+              AND (NOT %(active_only)s OR cl.start_date >= CURRENT_DATE)
+              AND (%(branch_id)s::integer IS NULL OR cl.branch_id = %(branch_id)s::integer)
+            ORDER BY cl.class_id
+            LIMIT %(limit)s
+        ),
+        counts AS (
+            SELECT r.class_id, COUNT(*) AS registered
+            FROM registrations r
+            WHERE r.class_id IN (SELECT class_id FROM selected)
+            GROUP BY r.class_id
+        )
+        SELECT s.class_id, s.capacity,
+               COALESCE(counts.registered, 0) AS registered,
+               s.capacity - COALESCE(counts.registered, 0) AS available
+        FROM selected s
+        LEFT JOIN counts ON counts.class_id = s.class_id
+        ORDER BY s.class_id
+    ''', {
+        'class_ids': list(class_ids) if class_ids else None,
+        'course_id': course_id,
+        'level': level,
+        'active_only': active_only,
+        'branch_id': branch_id,
+        'limit': MAX_AVAILABILITY_BATCH
+    })
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
 def get_api_dashboard_stats(conn):
     """دریافت آمار لحظه‌ای برای API"""
     cursor = conn.cursor(cursor_factory=DictCursor)
@@ -772,34 +2655,636 @@ def get_api_dashboard_stats(conn):
     cursor.execute('SELECT COUNT(*) FROM registrations WHERE registration_date >= CURRENT_DATE - INTERVAL \'7 days\'')
     stats['recent_registrations'] = cursor.fetchone()[0]
     
-    cursor.execute('SELECT SUM(amount) FROM payments WHERE payment_date >= CURRENT_DATE - INTERVAL \'30 days\'')
+    cursor.execute('SELECT SUM(total_amount) FROM payment_rollup_daily WHERE rollup_date >= CURRENT_DATE - INTERVAL \'30 days\'')
     total = cursor.fetchone()[0]
     stats['revenue_30days'] = total if total else 0
     
     cursor.close()
     return stats
 
+# ==================== آمار زنده داشبورد ====================
+# هر تغییر در جداول اصلی یک اعلان (بدون محتوا) روی این کانال می‌فرستد تا
+# تجمیع‌کننده داشبورد آمار را یک بار برای همه کاربران متصل از نو محاسبه کند.
+DASHBOARD_CHANNEL = 'dashboard_changed'
+DASHBOARD_TABLES = ('professors', 'students', 'courses', 'classes', 'registrations', 'payments')
+
+register_schema('''
+    CREATE OR REPLACE FUNCTION notify_dashboard_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('dashboard_changed', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+''', *(f'''
+    DROP TRIGGER IF EXISTS {table}_dashboard_changed ON {table};
+    CREATE TRIGGER {table}_dashboard_changed
+        AFTER INSERT OR UPDATE OR DELETE ON {table}
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_dashboard_changed()
+''' for table in DASHBOARD_TABLES))
+
+LIVE_DASHBOARD_SQL = '''
+    SELECT
+        (SELECT COUNT(*) FROM professors) AS professors,
+        (SELECT COUNT(*) FROM students) AS students,
+        (SELECT COUNT(*) FROM courses) AS courses,
+        (SELECT COUNT(*) FROM classes) AS classes,
+        (SELECT COUNT(*) FROM registrations) AS registrations,
+        (SELECT COALESCE(SUM(total_amount), 0)::float8 FROM payment_rollup_monthly
+         WHERE payment_status = %s) AS payments,
+        (SELECT COUNT(*) FROM classes WHERE start_date >= CURRENT_DATE) AS upcoming_classes,
+        (SELECT COUNT(*) FROM registrations
+         WHERE registration_date >= CURRENT_DATE - INTERVAL '7 days') AS recent_registrations,
+        (SELECT COALESCE(SUM(total_amount), 0)::float8 FROM payment_rollup_daily
+         WHERE rollup_date >= CURRENT_DATE - INTERVAL '30 days') AS revenue_30days
+'''
+
+def get_live_dashboard_stats(conn):
+    """آمار کامل داشبورد (آمار صفحه اصلی و API) در یک پرس‌وجو"""
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute(LIVE_DASHBOARD_SQL, ('تکمیل',))
+    stats = dict(cursor.fetchone())
+    cursor.close()
+    return stats
+
+# ==================== REST API (نسخه ۱) ====================
+# هر منبع: جدول‌ها، کلید صفحه‌بندی (یکتا و صعودی)، فیلدهای قابل انتخاب و فیلترها.
+# JSON هر صفحه با json_build_object / json_agg در خود PostgreSQL ساخته و به صورت
+# متن برگردانده می‌شود؛ ردیف‌ها در پایتون به dict تبدیل یا دوباره سریال نمی‌شوند.
+API_DEFAULT_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+def _parse_date(value):
+    return date.fromisoformat(value)
+
+API_RESOURCES = {
+    'professors': {
+        'from': 'professors p',
+        'key': 'p.professor_id',
+        'fields': {
+            'professor_id': 'p.professor_id',
+            'first_name': 'p.first_name',
+            'last_name': 'p.last_name',
+            'specialty': 'p.specialty',
+            'phone_number': 'p.phone_number',
+            'email': 'p.email',
+            'salary': 'p.salary',
+            'session_count': 'p.session_count',
+            'class_count': '(SELECT COUNT(*) FROM classes WHERE professor_id = p.professor_id)',
+        },
+        'filters': {
+            'specialty': ('p.specialty = %s', str),
+        },
+    },
+    'students': {
+        'from': 'students s',
+        'key': 's.membership_id',
+        'fields': {
+            'membership_id': 's.membership_id',
+            'first_name': 's.first_name',
+            'last_name': 's.last_name',
+            'national_id': 's.national_id',
+            'birth_date': 's.birth_date',
+            'phone_number': 's.phone_number',
+            'email': 's.email',
+            'province': 's.province',
+            'city': 's.city',
+            'street': 's.street',
+            'plaque': 's.plaque',
+            'registration_count': '(SELECT COUNT(*) FROM registrations WHERE membership_id = s.membership_id)',
+        },
+        'filters': {
+            'city': ('s.city = %s', str),
+            'province': ('s.province = %s', str),
+        },
+    },
+    'courses': {
+        'from': 'courses c',
+        'key': 'c.course_id',
+        'fields': {
+            'course_id': 'c.course_id',
+            'course_title': 'c.course_title',
+            'course_level': 'c.course_level',
+            'level_id': 'c.level_id',
+            'session_count': 'c.session_count',
+            'course_status': 'c.course_status',
+            'course_capacity': 'c.course_capacity',
+            'class_count': '(SELECT COUNT(*) FROM classes WHERE course_id = c.course_id)',
+        },
+        'filters': {
+            'course_status': ('c.course_status = %s', str),
+            'level_id': ('c.level_id = %s', int),
+        },
+    },
+    'classes': {
+        'from': '''classes cl
+            JOIN courses c ON cl.course_id = c.course_id
+            JOIN professors p ON cl.professor_id = p.professor_id''',
+        'key': 'cl.class_id',
+        'fields': {
+            'class_id': 'cl.class_id',
+            'course_id': 'cl.course_id',
+            'professor_id': 'cl.professor_id',
+            'course_title': 'c.course_title',
+            'course_level': 'c.course_level',
+            'professor_name': "p.first_name || ' ' || p.last_name",
+            'capacity': 'cl.capacity',
+            'start_date': 'cl.start_date',
+            'end_date': 'cl.end_date',
+            'class_time': 'cl.class_time',
+            'class_days': 'cl.class_days',
+            'classroom': 'cl.classroom',
+            'student_count': '(SELECT COUNT(*) FROM registrations WHERE class_id = cl.class_id)',
+        },
+        'filters': {
+            'course_id': ('cl.course_id = %s', int),
+            'professor_id': ('cl.professor_id = %s', int),
+            'active_on': ('%s BETWEEN cl.start_date AND cl.end_date', _parse_date),
+        },
+    },
+    # فیلترها همانند get_registrations_list
+    'registrations': {
+        'from': '''registrations r
+            JOIN students s ON r.membership_id = s.membership_id
+            JOIN classes cl ON r.class_id = cl.class_id
+            JOIN courses c ON cl.course_id = c.course_id
+            JOIN professors p ON cl.professor_id = p.professor_id
+            LEFT JOIN payments py ON r.payment_id = py.payment_id''',
+        'key': 'r.registration_id',
+        'fields': {
+            'registration_id': 'r.registration_id',
+            'membership_id': 'r.membership_id',
+            'class_id': 'r.class_id',
+            'registration_date': 'r.registration_date',
+            'payment_id': 'r.payment_id',
+            'student_name': "s.first_name || ' ' || s.last_name",
+            'student_phone': 's.phone_number',
+            'course_title': 'c.course_title',
+            'course_level': 'c.course_level',
+            'class_time': 'cl.class_time',
+            'class_days': 'cl.class_days',
+            'start_date': 'cl.start_date',
+            'professor_name': "p.first_name || ' ' || p.last_name",
+            'amount': 'py.amount',
+            'payment_status': 'py.payment_status',
+            'payment_method': 'py.payment_method',
+            'payment_date': 'py.payment_date',
+        },
+        'filters': {
+            'class_id': ('r.class_id = %s', int),
+            'student_id': ('r.membership_id = %s', int),
+            'payment_status': ('py.payment_status = %s', str),
+        },
+    },
+    # فیلترها همانند get_payments_list
+    'payments': {
+        'from': '''payments p
+            LEFT JOIN registrations r ON p.payment_id = r.payment_id
+            LEFT JOIN students s ON r.membership_id = s.membership_id
+            LEFT JOIN classes cl ON r.class_id = cl.class_id
+            LEFT JOIN courses c ON cl.course_id = c.course_id''',
+        'key': 'p.payment_id',
+        'fields': {
+            'payment_id': 'p.payment_id',
+            'amount': 'p.amount',
+            'payment_method': 'p.payment_method',
+            'payment_status': 'p.payment_status',
+            'payment_date': 'p.payment_date',
+            'registration_id': 'r.registration_id',
+            'student_name': "s.first_name || ' ' || s.last_name",
+            'course_title': 'c.course_title',
+            'registration_date': 'r.registration_date',
+        },
+        'filters': {
+            'payment_status': ('p.payment_status = %s', str),
+            'start_date': ('p.payment_date >= %s', _parse_date),
+            'end_date': ('p.payment_date <= %s', _parse_date),
+        },
+    },
+}
+
+# شعبه هر منبع از جدول اصلی آن (همان جدول کلید صفحه‌بندی) خوانده می‌شود
+for _spec in API_RESOURCES.values():
+    _alias = _spec['key'].split('.')[0]
+    _spec['fields']['branch_id'] = f'{_alias}.branch_id'
+    _spec['filters']['branch_id'] = (f'{_alias}.branch_id = %s', int)
+
+def build_api_page_query(resource, fields=None, filters=None, after=None, limit=API_DEFAULT_PAGE_SIZE):
+    """ساخت پرس‌وجوی یک صفحه از منبع API (ValueError برای فیلد یا فیلتر نامعتبر)
+    
+    خروجی پرس‌وجو یک ردیف است: آرایه JSON ردیف‌ها (متن)، کلید آخرین ردیف و
+    وجود صفحه بعد. صفحه‌بندی keyset است (key > after)، بنابراین هزینه هر صفحه
+    به شماره صفحه وابسته نیست.
+    """
+    spec = API_RESOURCES[resource]
+    fields = fields or list(spec['fields'])
+    unknown = [name for name in fields if name not in spec['fields']]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    
+    conditions = []
+    params = []
+    for name, value in (filters or {}).items():
+        if name not in spec['filters']:
+            raise ValueError(f'Unknown filter: {name}')
+        if value in (None, ''):
+            continue
+        condition, parse = spec['filters'][name]
+        conditions.append(condition)
+        params.append(parse(value))
+    
+    if after is not None:
+        conditions.append(f"{spec['key']} > %s")
+        params.append(int(after))
+    
+    # نام فیلدها از فهرست مجاز هستند و مستقیماً در متن پرس‌وجو قرار می‌گیرند
+    item = 'json_build_object({})'.format(', '.join(f"'{name}', {spec['fields'][name]}" for name in fields))
+    where = ' AND '.join(conditions) or 'TRUE'
+    query = f'''
+        WITH page AS (
+            SELECT {spec['key']} AS page_key, {item} AS item
+            FROM {spec['from']}
+            WHERE {where}
+            ORDER BY {spec['key']}
+            LIMIT %s
+        ), numbered AS (
+            SELECT page_key, item, row_number() OVER (ORDER BY page_key) AS n FROM page
+        )
+        SELECT COALESCE(json_agg(item ORDER BY page_key) FILTER (WHERE n <= %s), '[]')::text AS data,
+               max(page_key) FILTER (WHERE n <= %s) AS last_key,
+               count(*) > %s AS has_more
+        FROM numbered
+    '''
+    return query, params + [limit + 1, limit, limit, limit]
+
+def get_api_page(conn, resource, fields=None, filters=None, after=None, limit=API_DEFAULT_PAGE_SIZE):
+    """یک صفحه از منبع API: (متن JSON ردیف‌ها، cursor صفحه بعد یا None)"""
+    cursor = conn.cursor()
+    cursor.execute(*build_api_page_query(resource, fields, filters, after, limit))
+    data, last_key, has_more = cursor.fetchone()
+    cursor.close()
+    return data, (last_key if has_more else None)
+
+# ==================== گزارش تغییرات (audit) ====================
+# هر تغییر با تصویر قبل و بعد رکورد (JSONB) در جدول فقط‌افزودنی audit_log ثبت
+# می‌شود. مسیرها تغییرات را در صف audit.py می‌گذارند و یک رشته پس‌زمینه آن‌ها را
+# به صورت گروهی با COPY می‌نویسد؛ ویرایش و حذف ردیف‌ها با trigger ممنوع است.
+register_schema('''
+    CREATE TABLE IF NOT EXISTS audit_log (
+        audit_id BIGSERIAL PRIMARY KEY,
+        occurred_at TIMESTAMP NOT NULL,
+        actor VARCHAR(100),
+        remote_addr VARCHAR(45),
+        action VARCHAR(20) NOT NULL,
+        entity VARCHAR(30) NOT NULL,
+        entity_id VARCHAR(30),
+        before_image JSONB,
+        after_image JSONB
+    )
+''', '''
+    CREATE INDEX IF NOT EXISTS idx_audit_log_entity ON audit_log (entity, entity_id, occurred_at)
+''', '''
+    CREATE INDEX IF NOT EXISTS idx_audit_log_occurred ON audit_log (occurred_at)
+''', '''
+    CREATE OR REPLACE FUNCTION audit_log_append_only() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'audit_log is append-only';
+    END;
+    $$ LANGUAGE plpgsql
+''', '''
+    DROP TRIGGER IF EXISTS audit_log_no_change ON audit_log;
+    CREATE TRIGGER audit_log_no_change
+        BEFORE UPDATE OR DELETE ON audit_log
+        FOR EACH ROW EXECUTE FUNCTION audit_log_append_only()
+''', '''
+    DROP TRIGGER IF EXISTS audit_log_no_truncate ON audit_log;
+    CREATE TRIGGER audit_log_no_truncate
+        BEFORE TRUNCATE ON audit_log
+        FOR EACH STATEMENT EXECUTE FUNCTION audit_log_append_only()
+''')
+
+AUDIT_COLUMNS = ('occurred_at', 'actor', 'remote_addr', 'action', 'entity', 'entity_id',
+                 'before_image', 'after_image')
+
+# پرس‌وجوی تصویر رکورد هر موجودیت (entity_id، image)؛ ثبت‌نام همراه با پرداخت خود ذخیره می‌شود
+AUDIT_ENTITIES = {
+    'professors': ('professor_id', 'SELECT t.professor_id AS entity_id, to_jsonb(t) AS image FROM professors t'),
+    'students': ('membership_id', 'SELECT t.membership_id AS entity_id, to_jsonb(t) AS image FROM students t'),
+    'courses': ('course_id', 'SELECT t.course_id AS entity_id, to_jsonb(t) AS image FROM courses t'),
+    'classes': ('class_id', 'SELECT t.class_id AS entity_id, to_jsonb(t) AS image FROM classes t'),
+    'registrations': ('registration_id', '''
+        SELECT t.registration_id AS entity_id,
+               to_jsonb(t) || jsonb_build_object('payment', to_jsonb(py)) AS image
+        FROM registrations t
+        LEFT JOIN payments py ON py.payment_id = t.payment_id
+    '''),
+}
+
+def get_audit_images(conn, entity, ids, branch_id=None):
+    """تصویر فعلی رکوردها برای گزارش تغییرات: {شناسه: dict} (با تعیین شعبه، فقط از همان شعبه)"""
+    key, query = AUDIT_ENTITIES[entity]
+    cursor = conn.cursor()
+    cursor.execute(f'{query} WHERE t.{key} = ANY(%s) AND (%s::integer IS NULL OR t.branch_id = %s::integer)',
+                   (_parse_ids(ids), branch_id, branch_id))
+    images = dict(cursor.fetchall())
+    cursor.close()
+    return images
+
+def get_audit_image(conn, entity, entity_id, branch_id=None):
+    """تصویر فعلی یک رکورد (None اگر وجود نداشته باشد)"""
+    return get_audit_images(conn, entity, [entity_id], branch_id).get(entity_id)
+
+def _audited_delete(conn, entity, entity_id):
+    """حذف یک رکورد و برگرداندن تصویر پیش از حذف آن در همان دستور (None اگر وجود نداشته باشد)"""
+    key, query = AUDIT_ENTITIES[entity]
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        WITH old AS (
+            {query}
+            WHERE t.{key} = %s
+            FOR UPDATE OF t
+        )
+        DELETE FROM {entity} u USING old
+        WHERE u.{key} = old.entity_id
+        RETURNING old.image
+    ''', (entity_id,))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+def copy_audit_rows(conn, rows):
+    """نوشتن گروهی ردیف‌های گزارش تغییرات با COPY (ردیف‌ها به ترتیب AUDIT_COLUMNS)"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = conn.cursor()
+    cursor.copy_expert(f"COPY audit_log ({', '.join(AUDIT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    cursor.close()
+
+def get_audit_log(conn, entity=None, entity_id=None, actor=None, limit=100):
+    """آخرین تغییرات ثبت‌شده با فیلتر اختیاری"""
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute('''
+        SELECT audit_id, occurred_at, actor, remote_addr, action, entity, entity_id,
+               before_image, after_image
+        FROM audit_log
+        WHERE (%(entity)s::text IS NULL OR entity = %(entity)s)
+          AND (%(entity_id)s::text IS NULL OR entity_id = %(entity_id)s)
+          AND (%(actor)s::text IS NULL OR actor = %(actor)s)
+        ORDER BY occurred_at DESC, audit_id DESC
+        LIMIT %(limit)s
+    ''', {'entity': entity, 'entity_id': None if entity_id is None else str(entity_id),
+          'actor': actor, 'limit': limit})
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+# ==================== صندوق خروجی رویدادها (outbox) ====================
+# هر تغییر ثبت‌نام و پرداخت با trigger در همان تراکنش به صورت یک رویداد در جدول
+# outbox نوشته می‌شود؛ بنابراین رویدادی بدون تغییر (یا تغییری بدون رویداد) ثبت
+# نمی‌شود. outbox_relay.py رویدادهای منتشرنشده را دسته‌ای به مقصد (فایل، صف یا
+# webhook) می‌فرستد و سیستم‌های دیگر می‌توانند با /api/v1/events از آخرین
+# رویداد دیده‌شده به بعد را بخوانند.
+#
+# شناسه رویدادها به ترتیب commit نیست، بنابراین رویدادها به ترتیب (txid، event_id)
+# خوانده می‌شوند و فقط رویدادهای تراکنش‌های پیش از xmin (که همه تمام شده‌اند)
+# برگردانده می‌شوند؛ رویدادی که بعداً قابل مشاهده شود txid بزرگ‌تری از همه
+# رویدادهای خوانده‌شده دارد و با cursor به شکل «txid:event_id» از دست نمی‌رود.
+OUTBOX_CHANNEL = 'outbox'
+OUTBOX_CURSOR_START = '0:0'
+
+register_schema('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        event_id BIGSERIAL PRIMARY KEY,
+        event_type VARCHAR(40) NOT NULL,
+        aggregate_type VARCHAR(30) NOT NULL,
+        aggregate_id VARCHAR(30) NOT NULL,
+        payload JSONB NOT NULL,
+        txid BIGINT NOT NULL DEFAULT txid_current(),
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        published_at TIMESTAMP
+    )
+''', '''
+    DROP INDEX IF EXISTS idx_outbox_unpublished;
+    CREATE INDEX IF NOT EXISTS idx_outbox_unpublished_txid ON outbox (txid, event_id) WHERE published_at IS NULL
+''', '''
+    CREATE INDEX IF NOT EXISTS idx_outbox_txid ON outbox (txid, event_id)
+''', f'''
+    CREATE OR REPLACE FUNCTION write_outbox_events() RETURNS trigger AS $$
+    DECLARE
+        key_column TEXT := TG_ARGV[0];
+        aggregate TEXT := TG_ARGV[1];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO outbox (event_type, aggregate_type, aggregate_id, payload)
+            SELECT aggregate || '.created', aggregate, n.row ->> key_column, n.row
+            FROM (SELECT to_jsonb(x) AS row FROM new_rows x) n;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO outbox (event_type, aggregate_type, aggregate_id, payload)
+            SELECT aggregate || '.updated', aggregate, n.row ->> key_column,
+                   jsonb_build_object('before', o.row, 'after', n.row)
+            FROM (SELECT to_jsonb(x) AS row FROM new_rows x) n
+            JOIN (SELECT to_jsonb(x) AS row FROM old_rows x) o ON o.row -> key_column = n.row -> key_column
+            WHERE o.row <> n.row;
+        ELSE
+            INSERT INTO outbox (event_type, aggregate_type, aggregate_id, payload)
+            SELECT aggregate || '.deleted', aggregate, o.row ->> key_column, o.row
+            FROM (SELECT to_jsonb(x) AS row FROM old_rows x) o;
+        END IF;
+        PERFORM pg_notify('{OUTBOX_CHANNEL}', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+''')
+
+for _table, _key, _aggregate in (('registrations', 'registration_id', 'registration'),
+                                 ('payments', 'payment_id', 'payment')):
+    register_schema(f'''
+        DROP TRIGGER IF EXISTS {_table}_outbox_insert ON {_table};
+        CREATE TRIGGER {_table}_outbox_insert
+            AFTER INSERT ON {_table} REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION write_outbox_events('{_key}', '{_aggregate}')
+    ''', f'''
+        DROP TRIGGER IF EXISTS {_table}_outbox_update ON {_table};
+        CREATE TRIGGER {_table}_outbox_update
+            AFTER UPDATE ON {_table} REFERENCING NEW TABLE AS new_rows OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION write_outbox_events('{_key}', '{_aggregate}')
+    ''', f'''
+        DROP TRIGGER IF EXISTS {_table}_outbox_delete ON {_table};
+        CREATE TRIGGER {_table}_outbox_delete
+            AFTER DELETE ON {_table} REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION write_outbox_events('{_key}', '{_aggregate}')
+    ''')
+
+OUTBOX_EVENT_COLUMNS = ('event_id', 'event_type', 'aggregate_type', 'aggregate_id', 'payload', 'created_at')
+
+def claim_outbox_events(conn, limit):
+    """قفل و دریافت قدیمی‌ترین رویدادهای منتشرنشده به ترتیب تراکنش (txid، event_id)
+
+    رله‌های هم‌زمان رویداد تکراری نمی‌گیرند (SKIP LOCKED).
+    """
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute(f'''
+        SELECT {', '.join(OUTBOX_EVENT_COLUMNS)}
+        FROM outbox
+        WHERE published_at IS NULL
+          AND txid < txid_snapshot_xmin(txid_current_snapshot())
+        ORDER BY txid, event_id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ''', (limit,))
+    events = cursor.fetchall()
+    cursor.close()
+    return events
+
+def mark_outbox_published(conn, event_ids):
+    _write(conn, 'UPDATE outbox SET published_at = CURRENT_TIMESTAMP WHERE event_id = ANY(%s)',
+           (list(event_ids),))
+
+def purge_outbox(conn, retention_days):
+    """حذف رویدادهای منتشرشده قدیمی‌تر از retention_days روز"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM outbox
+        WHERE published_at IS NOT NULL
+          AND created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+    ''', (retention_days,))
+    count = cursor.rowcount
+    cursor.close()
+    return count
+
+def parse_outbox_cursor(value):
+    """تبدیل cursor «txid:event_id» به (txid، event_id)؛ ValueError برای مقدار نامعتبر"""
+    txid, separator, event_id = (value or OUTBOX_CURSOR_START).partition(':')
+    if not separator:
+        raise ValueError('Invalid cursor')
+    return int(txid), int(event_id)
+
+def get_outbox_page(conn, after=OUTBOX_CURSOR_START, limit=API_DEFAULT_PAGE_SIZE, aggregate_type=None):
+    """رویدادهای پس از cursor=after: (متن JSON رویدادها، cursor بعدی)
+
+    cursor بعدی «txid:event_id» آخرین رویداد برگشتی است (یا همان after اگر رویداد جدیدی نباشد).
+    """
+    txid, event_id = parse_outbox_cursor(after)
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        WITH page AS (
+            SELECT {', '.join(OUTBOX_EVENT_COLUMNS)}, txid
+            FROM outbox
+            WHERE (txid, event_id) > (%(txid)s, %(event_id)s)
+              AND txid < txid_snapshot_xmin(txid_current_snapshot())
+              AND (%(aggregate_type)s::text IS NULL OR aggregate_type = %(aggregate_type)s)
+            ORDER BY txid, event_id
+            LIMIT %(limit)s
+        )
+        SELECT COALESCE(json_agg(page ORDER BY txid, event_id), '[]')::text,
+               (SELECT txid || ':' || event_id FROM page ORDER BY txid DESC, event_id DESC LIMIT 1)
+        FROM page
+    ''', {'txid': txid, 'event_id': event_id, 'limit': limit, 'aggregate_type': aggregate_type})
+    data, last_cursor = cursor.fetchone()
+    cursor.close()
+    return data, last_cursor or f'{txid}:{event_id}'
+
+# ==================== کلیدهای idempotency ====================
+# فرم‌ها و فراخوانی‌های API یک کلید یکتا (UUID) همراه درخواست POST می‌فرستند.
+# اولین درخواست کلید را ثبت و پس از اجرا نتیجه (کد وضعیت، آدرس هدایت و بدنه
+# کوتاه) را کنار آن ذخیره می‌کند؛ تکرار همان درخواست (دوبار کلیک یا تلاش مجدد
+# کلاینت) بدون اجرای دوباره تغییرات همان نتیجه را دریافت می‌کند. خلاصه (hash)
+# بدنه درخواست کنار کلید ذخیره می‌شود تا کلید با بدنه دیگری استفاده نشود. کلیدها پس از
+# IDEMPOTENCY_TTL_HOURS ساعت حذف می‌شوند.
+IDEMPOTENCY_TTL_HOURS = int(os.getenv('IDEMPOTENCY_TTL_HOURS', '24'))
+
+register_schema('''
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        idempotency_key UUID PRIMARY KEY,
+        scope VARCHAR(200) NOT NULL,
+        actor VARCHAR(100),
+        status_code SMALLINT,
+        location TEXT,
+        content_type VARCHAR(100),
+        body TEXT,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+''', '''
+    CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)
+''', '''
+    ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS request_hash CHAR(64)
+''')
+
+def claim_idempotency_key(conn, key, scope, actor, request_hash=None):
+    """ثبت کلید برای اجرای درخواست؛ False اگر کلید قبلاً ثبت شده باشد"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO idempotency_keys (idempotency_key, scope, actor, request_hash)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (idempotency_key) DO NOTHING
+        RETURNING idempotency_key
+    ''', (key, scope, actor, request_hash))
+    claimed = cursor.fetchone() is not None
+    cursor.close()
+    return claimed
+
+def get_idempotency_result(conn, key):
+    """کلید ثبت‌شده و نتیجه آن (status_code خالی یعنی درخواست هنوز در حال اجراست)"""
+    cursor = conn.cursor(cursor_factory=RecordCursor)
+    cursor.execute('''
+        SELECT scope, actor, request_hash, status_code, location, content_type, body
+        FROM idempotency_keys
+        WHERE idempotency_key = %s
+    ''', (key,))
+    result = cursor.fetchone()
+    cursor.close()
+    return result
+
+def save_idempotency_result(conn, key, status_code, location=None, content_type=None, body=None):
+    _write(conn, '''
+        UPDATE idempotency_keys
+        SET status_code = %s, location = %s, content_type = %s, body = %s
+        WHERE idempotency_key = %s
+    ''', (status_code, location, content_type, body, key))
+
+def release_idempotency_key(conn, key):
+    """حذف کلید درخواستی که به پایان نرسید تا تلاش مجدد دوباره اجرا شود"""
+    _write(conn, 'DELETE FROM idempotency_keys WHERE idempotency_key = %s AND status_code IS NULL', (key,))
+
+def purge_idempotency_keys(conn, ttl_hours=IDEMPOTENCY_TTL_HOURS):
+    _write(conn, '''
+        DELETE FROM idempotency_keys
+        WHERE created_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+    ''', (ttl_hours,))
+
 # ==================== توابع کمکی ====================
-def get_courses_for_dropdown(conn):
+def get_courses_for_dropdown(conn, branch_id=None):
     """دریافت لیست دوره‌ها برای dropdown"""
     cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('SELECT * FROM courses WHERE course_status = %s ORDER BY course_title', ('فعال',))
+    cursor.execute('''
+        SELECT * FROM courses
+        WHERE course_status = %s AND (%s::integer IS NULL OR branch_id = %s)
+        ORDER BY course_title
+    ''', ('فعال', branch_id, branch_id))
     courses = cursor.fetchall()
     cursor.close()
     return courses
 
-def get_professors_for_dropdown(conn):
+def get_professors_for_dropdown(conn, branch_id=None):
     """دریافت لیست اساتید برای dropdown"""
     cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('SELECT * FROM professors ORDER BY first_name, last_name')
+    cursor.execute('''
+        SELECT * FROM professors
+        WHERE %s::integer IS NULL OR branch_id = %s
+        ORDER BY first_name, last_name
+    ''', (branch_id, branch_id))
     professors = cursor.fetchall()
     cursor.close()
     return professors
 
-def get_students_for_dropdown(conn):
+def get_students_for_dropdown(conn, branch_id=None):
     """دریافت لیست دانش‌آموزان برای dropdown"""
     cursor = conn.cursor(cursor_factory=DictCursor)
-    cursor.execute('SELECT membership_id, first_name || \' \' || last_name as full_name FROM students ORDER BY last_name')
+    cursor.execute('''
+        SELECT membership_id, first_name || ' ' || last_name as full_name FROM students
+        WHERE %s::integer IS NULL OR branch_id = %s
+        ORDER BY last_name
+    ''', (branch_id, branch_id))
     students = cursor.fetchall()
     cursor.close()
     return students
@@ -812,7 +3297,7 @@ def get_levels_for_dropdown(conn):
     cursor.close()
     return levels
 
-def get_active_classes_for_dropdown(conn):
+def get_active_classes_for_dropdown(conn, branch_id=None):
     """دریافت لیست کلاس‌های فعال برای dropdown"""
     cursor = conn.cursor(cursor_factory=DictCursor)
     cursor.execute('''
@@ -828,8 +3313,9 @@ def get_active_classes_for_dropdown(conn):
         JOIN courses c ON cl.course_id = c.course_id
         JOIN professors p ON cl.professor_id = p.professor_id
         WHERE cl.start_date >= CURRENT_DATE
+          AND (%s::integer IS NULL OR cl.branch_id = %s)
         ORDER BY cl.start_date
-    ''')
+    ''', (branch_id, branch_id))
     classes = cursor.fetchall()
     cursor.close()
     return classes
\ No newline at end of file
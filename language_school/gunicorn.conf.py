@@ -0,0 +1,59 @@
+import multiprocessing
+import os
+import signal
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ==================== تنظیمات سرور تولیدی (gunicorn) ====================
+# اجرا: gunicorn -c gunicorn.conf.py wsgi:app
+#
+# چند فرایند کارگر، هر کدام با چند رشته (gthread)؛ جریان‌های SSE هر کدام یک
+# رشته را اشغال می‌کنند و تعداد آن‌ها در هر کارگر به SSE_MAX_STREAMS (پیش‌فرض
+# نیمی از رشته‌ها) محدود است. برای تعداد زیاد صفحات باز اجرای ناهمگام (asgi.py) مناسب‌تر است.
+
+bind = f"{os.getenv('SERVER_HOST') or '0.0.0.0'}:{os.getenv('SERVER_PORT') or '5000'}"
+workers = int(os.getenv('WEB_WORKERS') or multiprocessing.cpu_count() * 2 + 1)
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '8'))
+timeout = int(os.getenv('WEB_TIMEOUT', '60'))
+# مهلت پایان درخواست‌های در حال اجرا هنگام خاموش شدن یا راه‌اندازی مجدد
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+# بازسازی دوره‌ای کارگرها برای جلوگیری از رشد حافظه
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '2000'))
+max_requests_jitter = max_requests // 10
+
+# برنامه (و ساخت جداول جانبی) یک بار در فرایند اصلی بارگذاری می‌شود
+preload_app = True
+accesslog = '-'
+
+def post_fork(server, worker):
+    # اتصال‌های ساخته‌شده در فرایند اصلی نباید بین فرایندها مشترک باشند
+    from database_queries import close_pools
+    close_pools(close=False)
+
+def post_worker_init(worker):
+    from realtime import stop_streams
+    from warmup import warm_up
+
+    warm_up(worker.wsgi)
+
+    # با SIGTERM کارگر درخواست جدید نمی‌گیرد و منتظر درخواست‌های باز می‌ماند؛
+    # جریان‌های SSE بی‌پایان هستند و باید جداگانه بسته شوند
+    handle_exit = signal.getsignal(signal.SIGTERM)
+    def handle_term(sig, frame):
+        stop_streams()
+        handle_exit(sig, frame)
+    signal.signal(signal.SIGTERM, handle_term)
+
+    worker.log.info("Worker %s ready", worker.pid)
+
+def worker_exit(server, worker):
+    from audit import audit_log
+    from database_queries import close_pools
+    from realtime import stop_streams
+    stop_streams()
+    # تغییرات صف‌شده پیش از پایان کارگر نوشته (یا در فایل spool ذخیره) می‌شوند
+    audit_log.stop()
+    close_pools()
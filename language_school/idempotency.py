@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from functools import wraps
+from flask import request, session, redirect, flash, jsonify, make_response, Response, g
+from database_queries import (
+    pooled_connection, claim_idempotency_key, get_idempotency_result, save_idempotency_result,
+    release_idempotency_key, purge_idempotency_keys
+)
+
+# ==================== درخواست‌های POST تکرارپذیر ====================
+# کلید از سرآیند Idempotency-Key (API) یا فیلد مخفی idempotency_key فرم خوانده
+# می‌شود؛ درخواست بدون کلید مانند قبل اجرا می‌شود. فرم‌ها با
+# {{ new_idempotency_key() }} در هر بار نمایش یک کلید تازه می‌گیرند.
+#
+# اگر درخواست تکراری زمانی برسد که درخواست اول هنوز در حال اجراست، تا
+# IDEMPOTENCY_WAIT_SECONDS منتظر نتیجه می‌ماند و در غیر این صورت کاربر بدون
+# اجرای دوباره به صفحه مقصد هدایت می‌شود (API: کد 409). استفاده از همان کلید
+# با بدنه دیگر کد 422 می‌گیرد.
+#
+# نتیجه فقط زمانی ذخیره می‌شود که مسیر پس از commit موفق mark_idempotent_success()
+# را صدا بزند؛ در غیر این صورت (خطای اعتبارسنجی یا پایگاه داده) کلید آزاد می‌شود
+# تا تلاش مجدد دوباره اجرا شود.
+#
+# اگر کلید ثبت نشود مسیر اجرا نمی‌شود (API: کد 503)؛ اگر نتیجه ذخیره یا کلید آزاد
+# نشود، پاسخ سرآیند Idempotency-Stored: false می‌گیرد و کلید تا حذف خودکار
+# (IDEMPOTENCY_TTL_HOURS) در حالت «در حال اجرا» می‌ماند.
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_STORED_HEADER = 'Idempotency-Stored'
+IDEMPOTENCY_FIELD = 'idempotency_key'
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '5'))
+IDEMPOTENCY_MAX_BODY = 64 * 1024
+IDEMPOTENCY_PURGE_SECONDS = 3600
+_last_purge = [0.0]
+
+def new_idempotency_key():
+    """کلید تازه برای فیلد مخفی فرم"""
+    return str(uuid.uuid4())
+
+def mark_idempotent_success():
+    """اعلام انجام تغییرات درخواست (پس از commit) تا نتیجه آن برای تکرارها ذخیره شود"""
+    g.idempotent_success = True
+
+def _request_hash():
+    """خلاصه بدنه درخواست (فیلدهای فرم به جز کلید، یا بدنه خام برای API)"""
+    if request.form:
+        fields = sorted((name, value) for name, value in request.form.items(multi=True)
+                        if name != IDEMPOTENCY_FIELD)
+        data = json.dumps(fields, ensure_ascii=False).encode('utf-8')
+    else:
+        data = request.get_data()
+    return hashlib.sha256(data).hexdigest()
+
+def _replay(result):
+    """بازسازی پاسخ ذخیره‌شده درخواست اول"""
+    response = Response(result.body or '', status=result.status_code, content_type=result.content_type)
+    if result.location:
+        response.headers['Location'] = result.location
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _wait_for_result(key):
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        with pooled_connection() as conn:
+            result = get_idempotency_result(conn, key)
+        if result is None or result.status_code is not None or time.monotonic() >= deadline:
+            return result
+        time.sleep(0.2)
+
+def _store(key, response):
+    """ذخیره نتیجه درخواست موفق یا آزاد کردن کلید؛ بدنه پاسخ‌های بزرگ یا جریانی ذخیره نمی‌شود"""
+    body = None
+    if not response.is_streamed and (response.content_length or 0) <= IDEMPOTENCY_MAX_BODY:
+        body = response.get_data(as_text=True)
+    with pooled_connection() as conn:
+        if not g.get('idempotent_success'):
+            release_idempotency_key(conn, key)
+        else:
+            save_idempotency_result(conn, key, response.status_code, response.headers.get('Location'),
+                                    response.content_type, body)
+        conn.commit()
+        if time.monotonic() - _last_purge[0] >= IDEMPOTENCY_PURGE_SECONDS:
+            # خطای حذف کلیدهای قدیمی به نتیجه ذخیره‌شده این درخواست ربطی ندارد
+            try:
+                purge_idempotency_keys(conn)
+                conn.commit()
+                _last_purge[0] = time.monotonic()
+            except Exception as e:
+                print(f"خطا در حذف کلیدهای قدیمی idempotency: {e}")
+
+def idempotent(pending_url):
+    """دکوراتور مسیرهای POST: اجرای حداکثر یک بار برای هر کلید
+
+    pending_url: صفحه‌ای که فرم تکراری در زمان اجرای درخواست اول به آن هدایت می‌شود.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_HEADER) or request.form.get(IDEMPOTENCY_FIELD)
+            if request.method != 'POST' or not key:
+                return f(*args, **kwargs)
+            from_form = IDEMPOTENCY_HEADER not in request.headers
+            try:
+                key = str(uuid.UUID(key))
+            except ValueError:
+                return jsonify({'error': 'Invalid idempotency key'}), 400
+
+            scope = request.path
+            actor = session.get('username')
+            request_hash = _request_hash()
+            try:
+                with pooled_connection() as conn:
+                    claimed = claim_idempotency_key(conn, key, scope, actor, request_hash)
+                    conn.commit()
+            except Exception as e:
+                # بدون ثبت کلید، اجرای مسیر ممکن است تغییرات را دو بار انجام دهد
+                print(f"خطا در ثبت کلید idempotency ({scope}، {key}): {e}")
+                if from_form:
+                    flash('ثبت درخواست در حال حاضر ممکن نیست؛ لطفاً دوباره تلاش کنید.', 'danger')
+                    return redirect(pending_url)
+                return jsonify({'error': 'Idempotency service unavailable'}), 503, {'Retry-After': '1'}
+
+            if not claimed:
+                result = _wait_for_result(key)
+                if result is not None and (result.scope != scope or result.actor != actor
+                                           or result.request_hash not in (None, request_hash)):
+                    return jsonify({'error': 'Idempotency key reused for another request'}), 422
+                if result is not None and result.status_code is not None:
+                    return _replay(result)
+                if result is not None:
+                    if from_form:
+                        flash('درخواست قبلی هنوز در حال انجام است.', 'warning')
+                        return redirect(pending_url)
+                    return jsonify({'error': 'Request in progress'}), 409
+                # درخواست اول ناموفق بود و کلید آزاد شد؛ این درخواست اجرا می‌شود
+                return decorated_function(*args, **kwargs)
+
+            try:
+                response = make_response(f(*args, **kwargs))
+            except Exception:
+                try:
+                    with pooled_connection() as conn:
+                        release_idempotency_key(conn, key)
+                        conn.commit()
+                except Exception as e:
+                    print(f"خطا در آزاد کردن کلید idempotency ({scope}، {key}): {e}")
+                raise
+            try:
+                _store(key, response)
+            except Exception as e:
+                # کلید در حالت «در حال اجرا» می‌ماند تا تکرار درخواست تغییرات را دوباره اجرا
+                # نکند؛ تکرارها تا حذف خودکار کلید کد 409 (یا پیام فرم) می‌گیرند
+                action = 'ذخیره نتیجه' if g.get('idempotent_success') else 'آزاد کردن کلید'
+                print(f"خطا در {action} idempotency ({scope}، {key}، کد {response.status_code}): {e}")
+                response.headers[IDEMPOTENCY_STORED_HEADER] = 'false'
+            return response
+        return decorated_function
+    return decorator
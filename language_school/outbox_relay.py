@@ -0,0 +1,203 @@
+import json
+import os
+import queue
+import select
+import sys
+import threading
+import time
+import urllib.request
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from database_queries import (
+    get_db_connection, claim_outbox_events, mark_outbox_published, purge_outbox, OUTBOX_CHANNEL
+)
+
+# ==================== انتشار رویدادهای outbox ====================
+# اجرا (یک فرایند جدا در کنار وب‌سرور): python outbox_relay.py
+#
+# رله رویدادهای منتشرنشده را دسته‌ای (تا OUTBOX_BATCH_SIZE) قفل می‌کند، به مقصد
+# OUTBOX_SINK می‌فرستد و در همان تراکنش منتشرشده علامت می‌زند. با اعلان
+# pg_notify بلافاصله بیدار می‌شود و اگر اعلانی نرسد هر OUTBOX_POLL_SECONDS
+# جدول را بررسی می‌کند. ارسال «حداقل یک بار» است: اگر رله پس از ارسال و پیش از
+# commit متوقف شود همان دسته دوباره فرستاده می‌شود، پس مصرف‌کننده‌ها رویداد
+# تکراری را با event_id تشخیص می‌دهند.
+#
+# مقصدها:
+#   file:<مسیر>     افزودن هر رویداد به صورت یک خط JSON به فایل (پیش‌فرض)
+#   webhook:<url>   ارسال هر دسته به صورت آرایه JSON با POST
+#   queue           صف داخل حافظه (برای استفاده از رله درون یک برنامه دیگر)
+
+OUTBOX_SINK = os.getenv('OUTBOX_SINK', 'file:outbox_events.jsonl')
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '200'))
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '5'))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '30'))
+OUTBOX_RETRY_SECONDS = 5
+OUTBOX_PURGE_SECONDS = 3600
+WEBHOOK_TIMEOUT = 10
+
+def event_to_dict(event):
+    return {
+        'event_id': event.event_id,
+        'event_type': event.event_type,
+        'aggregate_type': event.aggregate_type,
+        'aggregate_id': event.aggregate_id,
+        'payload': event.payload,
+        'created_at': event.created_at,
+    }
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+class FileSink:
+    """افزودن رویدادها به فایل JSON Lines (پیش از بازگشت روی دیسک نوشته می‌شوند)"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, events):
+        with open(self.path, 'a', encoding='utf-8') as output:
+            for event in events:
+                output.write(_dumps(event) + '\n')
+            output.flush()
+            os.fsync(output.fileno())
+
+class WebhookSink:
+    """ارسال هر دسته با یک درخواست POST؛ پاسخ غیر 2xx خطا محسوب می‌شود"""
+
+    def __init__(self, url):
+        self.url = url
+
+    def publish(self, events):
+        request = urllib.request.Request(
+            self.url, data=_dumps(events).encode('utf-8'), method='POST',
+            headers={'Content-Type': 'application/json'}
+        )
+        with urllib.request.urlopen(request, timeout=WEBHOOK_TIMEOUT) as response:
+            if not 200 <= response.status < 300:
+                raise RuntimeError(f'webhook status {response.status}')
+
+class QueueSink:
+    """قرار دادن رویدادها در یک queue.Queue"""
+
+    def __init__(self, events=None):
+        self.events = events if events is not None else queue.Queue()
+
+    def publish(self, events):
+        for event in events:
+            self.events.put(event)
+
+def make_sink(spec):
+    """ساخت مقصد از متن تنظیمات (file:<مسیر>، webhook:<url> یا queue)"""
+    kind, _, target = spec.partition(':')
+    if kind == 'file' and target:
+        return FileSink(target)
+    if kind == 'webhook' and target:
+        return WebhookSink(target)
+    if kind == 'queue':
+        return QueueSink()
+    raise ValueError(f'Invalid outbox sink: {spec}')
+
+class OutboxRelay:
+    """خواندن دسته‌ای outbox و انتشار آن در مقصد"""
+
+    def __init__(self, sink, batch_size=OUTBOX_BATCH_SIZE):
+        self.sink = sink
+        self.batch_size = batch_size
+        self._stopping = threading.Event()
+        self._conn = None
+        self._listen_conn = None
+
+    def stop(self):
+        self._stopping.set()
+
+    def publish_batch(self):
+        """انتشار یک دسته؛ تعداد رویدادهای منتشرشده را برمی‌گرداند"""
+        conn = self._conn
+        try:
+            events = claim_outbox_events(conn, self.batch_size)
+            if not events:
+                conn.rollback()
+                return 0
+            self.sink.publish([event_to_dict(event) for event in events])
+            mark_outbox_published(conn, [event.event_id for event in events])
+            conn.commit()
+            return len(events)
+        except Exception:
+            conn.rollback()
+            raise
+
+    def publish_pending(self):
+        """انتشار همه رویدادهای منتشرنشده تا خالی شدن صف"""
+        total = 0
+        while not self._stopping.is_set():
+            count = self.publish_batch()
+            total += count
+            if count < self.batch_size:
+                break
+        return total
+
+    def purge(self):
+        count = purge_outbox(self._conn, OUTBOX_RETENTION_DAYS)
+        self._conn.commit()
+        if count:
+            print(f"{count} رویداد منتشرشده قدیمی از outbox حذف شد")
+
+    def _connect(self):
+        self._conn = get_db_connection()
+        self._listen_conn = get_db_connection()
+        if self._conn is None or self._listen_conn is None:
+            raise RuntimeError('اتصال به دیتابیس برقرار نشد')
+        self._listen_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self._listen_conn.cursor()
+        cursor.execute(f'LISTEN {OUTBOX_CHANNEL}')
+        cursor.close()
+
+    def _close(self):
+        for conn in (self._conn, self._listen_conn):
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        self._conn = self._listen_conn = None
+
+    def _wait(self):
+        """انتظار تا رسیدن اعلان یا پایان مهلت بررسی دوره‌ای"""
+        if select.select([self._listen_conn], [], [], OUTBOX_POLL_SECONDS) != ([], [], []):
+            self._listen_conn.poll()
+            self._listen_conn.notifies.clear()
+
+    def run(self):
+        purged_at = 0.0
+        while not self._stopping.is_set():
+            try:
+                if self._conn is None:
+                    self._connect()
+                # اعلان‌هایی که هنگام انتشار برسند در _wait بعدی دیده می‌شوند
+                count = self.publish_pending()
+                if count:
+                    print(f"{count} رویداد منتشر شد")
+                if time.monotonic() - purged_at >= OUTBOX_PURGE_SECONDS:
+                    self.purge()
+                    purged_at = time.monotonic()
+                self._wait()
+            except Exception as e:
+                print(f"خطا در انتشار رویدادها: {e}")
+                self._close()
+                self._stopping.wait(OUTBOX_RETRY_SECONDS)
+        self._close()
+
+def main():
+    try:
+        sink = make_sink(OUTBOX_SINK)
+    except ValueError as e:
+        print(f"خطا: {e}")
+        return 1
+    relay = OutboxRelay(sink)
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        relay.stop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from database_queries import pooled_connection, DB_MAX_CONN
+
+# ==================== بارگذاری همزمان داده‌های صفحه ====================
+# گروه‌های پرس‌وجوی مستقل یک صفحه هر کدام روی یک اتصال جدا از pool و به صورت
+# همزمان اجرا می‌شوند؛ زمان پاسخ صفحه برابر کندترین پرس‌وجو است نه مجموع آن‌ها.
+# تعداد رشته‌ها برابر حداکثر اتصال pool است. pool با idempotency و warmup مشترک
+# است؛ اگر همه اتصال‌ها در حال استفاده باشند گرفتن اتصال (BlockingConnectionPool)
+# تا آزاد شدن یکی منتظر می‌ماند و فقط پس از DB_POOL_TIMEOUT ثانیه خطا می‌دهد.
+
+_executor = ThreadPoolExecutor(max_workers=DB_MAX_CONN, thread_name_prefix='page-data')
+
+def _run_loader(loader, readonly):
+    try:
+        with pooled_connection(readonly) as conn:
+            return loader(conn)
+    except psycopg2.OperationalError:
+        if not readonly:
+            raise
+        # اتصال replica (یا اتصال قدیمی pool) قطع شده است؛ یک بار روی primary تکرار می‌شود
+        with pooled_connection() as conn:
+            return loader(conn)
+
+def load_page_data(loaders, readonly=True):
+    """اجرای همزمان توابع بارگذاری و برگرداندن نتایج با همان نام‌ها
+
+    loaders: دیکشنری نام -> تابعی که یک اتصال می‌گیرد؛ توابع نباید به یکدیگر
+    وابسته باشند یا خودشان load_page_data را صدا بزنند.
+    """
+    futures = {name: _executor.submit(_run_loader, loader, readonly)
+               for name, loader in loaders.items()}
+    return {name: future.result() for name, future in futures.items()}
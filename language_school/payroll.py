@@ -0,0 +1,121 @@
+import csv
+import io
+from functools import lru_cache
+import numpy as np
+from analytics import _columns, _ratio
+from scheduling import parse_class_days
+
+# ==================== محاسبه حقوق اساتید ====================
+# نرخ هر جلسه = salary / session_count استاد (حقوق قرارداد برای تعداد جلسات آن).
+# جلسات هر کلاس در بازه = تعداد روزهای کلاس (class_days) در اشتراک بازه گزارش با
+# تاریخ شروع و پایان کلاس. شمارش برای همه کلاس‌های دارای الگوی روز یکسان با یک
+# فراخوانی np.busday_count و جمع هر استاد با bincount انجام می‌شود.
+
+PAYROLL_COLUMNS = [
+    ('professor_id', 'کد استاد'),
+    ('professor_name', 'نام استاد'),
+    ('class_count', 'تعداد کلاس'),
+    ('sessions', 'جلسات تدریس'),
+    ('rate', 'نرخ هر جلسه'),
+    ('pay', 'مبلغ قابل پرداخت'),
+    ('unscheduled', 'کلاس بدون روز مشخص'),
+]
+
+def fetch_payroll_data(conn, start_date, end_date):
+    """دریافت ستونی اساتید و کلاس‌های فعال در بازه (بازه هر کلاس به بازه گزارش محدود می‌شود)"""
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        SELECT professor_id, first_name || ' ' || last_name,
+               COALESCE(salary, 0)::float8, COALESCE(session_count, 0)::float8
+        FROM professors
+        ORDER BY professor_id
+    ''')
+    professors = _columns(cursor, ['professor_id', 'professor_name', 'salary', 'session_count'])
+
+    cursor.execute('''
+        SELECT class_id, professor_id,
+               GREATEST(start_date, %(start)s::date), LEAST(end_date, %(end)s::date),
+               COALESCE(class_days, '')
+        FROM classes
+        WHERE start_date <= %(end)s AND end_date >= %(start)s
+        ORDER BY class_id
+    ''', {'start': start_date, 'end': end_date})
+    classes = _columns(cursor, ['class_id', 'professor_id', 'begin', 'end', 'class_days'])
+
+    cursor.close()
+    return professors, classes
+
+@lru_cache(maxsize=256)
+def weekmask(class_days):
+    """الگوی هفت‌رقمی روزهای کلاس از دوشنبه تا یکشنبه (قالب weekmask در numpy)"""
+    days = set(parse_class_days(class_days))
+    return ''.join('1' if day in days else '0' for day in range(7))
+
+def count_class_sessions(classes):
+    """تعداد جلسات هر کلاس در بازه و کلاس‌هایی که روزهای آن‌ها قابل تشخیص نیست"""
+    count = len(classes['class_id'])
+    sessions = np.zeros(count, dtype=np.int64)
+    if not count:
+        return sessions, np.zeros(0, dtype=bool)
+
+    begin = classes['begin'].astype('datetime64[D]')
+    end = classes['end'].astype('datetime64[D]') + np.timedelta64(1, 'D')
+    masks = np.array([weekmask(days) for days in classes['class_days']])
+    unscheduled = masks == '0000000'
+
+    for mask in np.unique(masks[~unscheduled]):
+        selected = masks == mask
+        sessions[selected] = np.busday_count(begin[selected], end[selected], weekmask=mask)
+    return sessions, unscheduled
+
+def build_payroll(conn, start_date, end_date):
+    """حقوق همه اساتید برای یک بازه در یک محاسبه گروهی"""
+    professors, classes = fetch_payroll_data(conn, start_date, end_date)
+    sessions, unscheduled = count_class_sessions(classes)
+
+    professor_ids = professors['professor_id'].astype(np.int64)
+    n = len(professor_ids)
+    class_professor = classes['professor_id'].astype(np.int64)
+    idx = np.searchsorted(professor_ids, class_professor)
+    if n:
+        valid = (idx < n) & (professor_ids[np.minimum(idx, n - 1)] == class_professor)
+    else:
+        valid = np.zeros(len(class_professor), dtype=bool)
+    idx = idx[valid]
+
+    total_sessions = np.bincount(idx, weights=sessions[valid], minlength=n)
+    class_count = np.bincount(idx, minlength=n)
+    unscheduled_count = np.bincount(idx, weights=unscheduled[valid], minlength=n)
+    rate = _ratio(professors['salary'].astype(np.float64), professors['session_count'].astype(np.float64))
+    pay = total_sessions * rate
+
+    order = np.lexsort((professor_ids, -pay))
+    rows = [{
+        'professor_id': int(professor_ids[i]),
+        'professor_name': str(professors['professor_name'][i]),
+        'class_count': int(class_count[i]),
+        'sessions': int(total_sessions[i]),
+        'rate': round(float(rate[i])),
+        'pay': round(float(pay[i])),
+        'unscheduled': int(unscheduled_count[i])
+    } for i in order]
+
+    return {
+        'rows': rows,
+        'summary': {
+            'professor_count': int((class_count > 0).sum()),
+            'sessions': int(total_sessions.sum()),
+            'pay': round(float(pay.sum())),
+            'unscheduled': int(unscheduled.sum())
+        }
+    }
+
+def payroll_csv(report):
+    """فایل CSV گزارش حقوق (با BOM برای نمایش درست فارسی در Excel)"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow([label for _, label in PAYROLL_COLUMNS])
+    for row in report['rows']:
+        writer.writerow([row[name] for name, _ in PAYROLL_COLUMNS])
+    return '\ufeff' + output.getvalue()
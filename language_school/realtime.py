@@ -0,0 +1,263 @@
+import asyncio
+import json
+import os
+import queue
+import select
+import threading
+import time
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from database_queries import get_db_connection, get_live_dashboard_stats, AVAILABILITY_CHANNEL, DASHBOARD_CHANNEL
+
+# ==================== ارسال لحظه‌ای تغییرات (LISTEN/NOTIFY + SSE) ====================
+# یک رشته شنونده با یک اتصال اختصاصی به کانال‌های PostgreSQL گوش می‌دهد و
+# هر اعلان را به صف مشترکین (اتصال‌های Server-Sent Events) می‌فرستد؛ بنابراین
+# تعداد مرورگرهای باز هیچ باری روی پایگاه داده ایجاد نمی‌کند.
+
+HEARTBEAT_SECONDS = 15
+SUBSCRIBER_QUEUE_SIZE = 100
+# حداقل فاصله دو محاسبه آمار داشبورد و بازه محاسبه دوره‌ای (برای آمارهای وابسته به تاریخ)
+DASHBOARD_DEBOUNCE_SECONDS = 2
+DASHBOARD_REFRESH_SECONDS = 60
+
+# در اجرای همگام (gunicorn gthread) هر جریان SSE یک رشته کارگر را تا بسته شدن
+# اشغال می‌کند؛ تعداد جریان‌های هم‌زمان هر فرایند محدود است تا همیشه رشته آزاد
+# برای درخواست‌های معمولی بماند (پیش‌فرض: نیمی از WEB_THREADS). پس از پر شدن
+# سقف، مسیر پاسخ 503 می‌دهد. جریان‌های asgi.py رشته‌ای اشغال نمی‌کنند و محدود نیستند.
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS') or max(int(os.getenv('WEB_THREADS') or '8') // 2, 1))
+SSE_RETRY_SECONDS = 30
+_stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+def acquire_stream_slot():
+    """رزرو یک جایگاه جریان همگام؛ False اگر سقف این فرایند پر باشد"""
+    return _stream_slots.acquire(blocking=False)
+
+def release_stream_slot():
+    """آزاد کردن جایگاه پس از بسته شدن پاسخ جریان"""
+    _stream_slots.release()
+
+# با تنظیم این رویداد (هنگام خاموش شدن سرور) همه جریان‌های SSE بسته می‌شوند تا
+# درخواست‌های باز مانع پایان تخلیه (drain) فرایند نشوند
+_shutdown = threading.Event()
+
+class AsyncSubscriber:
+    """صف مشترک در برنامه ناهمگام (asgi.py)
+
+    رویدادها در رشته شنونده تولید می‌شوند و با call_soon_threadsafe به صف asyncio
+    حلقه مشترک منتقل می‌شوند؛ انتظار مشترک هیچ رشته‌ای را اشغال نمی‌کند. مانند
+    صف‌های همگام، در صورت پر بودن قدیمی‌ترین رویداد کنار گذاشته می‌شود.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put_nowait(self, payload):
+        try:
+            self.loop.call_soon_threadsafe(self._put, payload)
+        except RuntimeError:
+            # حلقه بسته شده است (خاموش شدن سرور)
+            pass
+
+    def _put(self, payload):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(payload)
+
+class NotificationBroadcaster:
+    """پخش اعلان‌های یک کانال PostgreSQL بین مشترکین داخل فرایند"""
+
+    def __init__(self, channel, key='class_id'):
+        self.channel = channel
+        self.key = key
+        self.latest = {}
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """راه‌اندازی رشته شنونده (فقط یک بار)"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen_forever, daemon=True,
+                                                name=f'listen-{self.channel}')
+                self._thread.start()
+
+    def subscribe(self, subscriber=None):
+        """ثبت یک مشترک جدید؛ خروجی صفی است که رویدادها در آن قرار می‌گیرند"""
+        self.start()
+        if subscriber is None:
+            subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, payload):
+        """ارسال یک رویداد به همه مشترکین (مشترک کند رویدادهای قدیمی را از دست می‌دهد)"""
+        self.remember(payload)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(payload)
+            except queue.Full:
+                try:
+                    subscriber.get_nowait()
+                    subscriber.put_nowait(payload)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def wake_all(self):
+        """بیدار کردن همه مشترکین منتظر (برای پایان جریان‌ها هنگام خاموش شدن)"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def remember(self, payload):
+        """نگهداری آخرین وضعیت هر کلید برای مشترکین جدید"""
+        if self.key in payload:
+            self.latest[payload[self.key]] = payload
+
+    def handle_notify(self, conn, notify):
+        """پردازش یک اعلان؛ به‌طور پیش‌فرض محتوای JSON آن پخش می‌شود"""
+        try:
+            self.publish(json.loads(notify.payload))
+        except ValueError:
+            print(f"اعلان نامعتبر در کانال {self.channel}: {notify.payload}")
+
+    def on_connect(self, conn):
+        """پس از برقراری (یا برقراری مجدد) اتصال شنونده"""
+
+    def on_tick(self, conn):
+        """پس از هر دور انتظار برای اعلان‌ها"""
+
+    def poll_timeout(self):
+        return HEARTBEAT_SECONDS
+
+    def _listen_forever(self):
+        """حلقه LISTEN با اتصال مجدد در صورت قطع ارتباط"""
+        while True:
+            conn = get_db_connection()
+            if not conn:
+                time.sleep(5)
+                continue
+            try:
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                cursor.execute(f'LISTEN {self.channel}')
+                cursor.close()
+                self.on_connect(conn)
+
+                while True:
+                    if select.select([conn], [], [], self.poll_timeout()) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            self.handle_notify(conn, conn.notifies.pop(0))
+                    self.on_tick(conn)
+            except Exception as e:
+                print(f"خطا در شنونده کانال {self.channel}: {e}")
+                time.sleep(5)
+            finally:
+                conn.close()
+
+    def _initial_events(self, keys):
+        """آخرین وضعیت شناخته‌شده برای همگام شدن صفحه"""
+        return [f'data: {json.dumps(payload)}\n\n'
+                for key, payload in list(self.latest.items()) if keys is None or key in keys]
+
+    def _matches(self, payload, keys):
+        return keys is None or payload.get(self.key) in keys
+
+    def stream(self, keys=None):
+        """تولید رویدادهای SSE برای یک مشترک (keys: فیلتر اختیاری بر اساس کلید)"""
+        subscriber = self.subscribe()
+        try:
+            yield from self._initial_events(keys)
+
+            while not _shutdown.is_set():
+                try:
+                    payload = subscriber.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if payload is None:
+                    break
+                if self._matches(payload, keys):
+                    yield f'data: {json.dumps(payload)}\n\n'
+        finally:
+            self.unsubscribe(subscriber)
+
+    async def astream(self, keys=None):
+        """نسخه ناهمگام stream برای asgi.py"""
+        subscriber = self.subscribe(AsyncSubscriber(asyncio.get_running_loop()))
+        try:
+            for event in self._initial_events(keys):
+                yield event
+
+            while not _shutdown.is_set():
+                try:
+                    payload = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                if payload is None:
+                    break
+                if self._matches(payload, keys):
+                    yield f'data: {json.dumps(payload)}\n\n'
+        finally:
+            self.unsubscribe(subscriber)
+
+class DashboardBroadcaster(NotificationBroadcaster):
+    """تجمیع‌کننده آمار داشبورد
+
+    اعلان‌های تغییر فقط وضعیت «نیاز به محاسبه» را تنظیم می‌کنند؛ آمار حداکثر
+    یک بار در هر DASHBOARD_DEBOUNCE_SECONDS با اتصال همین شنونده محاسبه و در
+    صورت تغییر برای همه داشبوردهای باز ارسال می‌شود.
+    """
+
+    def __init__(self):
+        super().__init__(DASHBOARD_CHANNEL, key='dashboard')
+        self._dirty = True
+        self._computed_at = 0.0
+
+    def remember(self, payload):
+        self.latest['dashboard'] = payload
+
+    def current(self):
+        """آخرین آمار محاسبه‌شده (در صورت وجود)"""
+        return self.latest.get('dashboard')
+
+    def handle_notify(self, conn, notify):
+        self._dirty = True
+
+    def on_connect(self, conn):
+        # ممکن است در زمان قطع اتصال تغییراتی از دست رفته باشد
+        self._dirty = True
+
+    def poll_timeout(self):
+        return DASHBOARD_DEBOUNCE_SECONDS if self._dirty else HEARTBEAT_SECONDS
+
+    def on_tick(self, conn):
+        elapsed = time.monotonic() - self._computed_at
+        if (self._dirty and elapsed >= DASHBOARD_DEBOUNCE_SECONDS) or elapsed >= DASHBOARD_REFRESH_SECONDS:
+            self._dirty = False
+            self._computed_at = time.monotonic()
+            stats = get_live_dashboard_stats(conn)
+            if stats != self.current():
+                self.publish(stats)
+
+availability_broadcaster = NotificationBroadcaster(AVAILABILITY_CHANNEL)
+dashboard_broadcaster = DashboardBroadcaster()
+
+def stop_streams():
+    """پایان دادن به جریان‌های باز؛ مرورگر با EventSource خودش دوباره وصل می‌شود"""
+    _shutdown.set()
+    availability_broadcaster.wake_all()
+    dashboard_broadcaster.wake_all()
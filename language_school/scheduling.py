@@ -0,0 +1,351 @@
+import re
+import os
+import time
+import threading
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import date, datetime
+from psycopg2.extras import DictCursor
+
+# ==================== موتور زمان‌بندی کلاس‌ها ====================
+# ساعت و روزهای کلاس (class_time / class_days) به صورت متن آزاد ذخیره می‌شوند.
+# این ماژول آن‌ها را به بازه‌های هفتگی ساختاریافته تبدیل می‌کند و برای هر استاد
+# و هر کلاس درس یک فهرست مرتب از بازه‌ها نگه می‌دارد تا بررسی تداخل با جستجوی
+# دودویی (O(log n)) انجام شود.
+
+WeeklySlot = namedtuple('WeeklySlot', ['weekday', 'start_minute', 'end_minute'])
+ClassSchedule = namedtuple('ClassSchedule', ['class_id', 'professor_id', 'classroom',
+                                             'start_date', 'end_date', 'slots'])
+Conflict = namedtuple('Conflict', ['resource', 'class_id', 'weekday', 'start_minute', 'end_minute'])
+
+# شماره روزها مطابق date.weekday() پایتون (دوشنبه = 0)
+WEEKDAYS = {
+    'یکشنبه': 6, 'دوشنبه': 0, 'سهشنبه': 1, 'چهارشنبه': 2,
+    'پنجشنبه': 3, 'جمعه': 4, 'شنبه': 5
+}
+WEEKDAY_NAMES = {
+    5: 'شنبه', 6: 'یکشنبه', 0: 'دوشنبه', 1: 'سه‌شنبه',
+    2: 'چهارشنبه', 3: 'پنجشنبه', 4: 'جمعه'
+}
+# ترتیب نمایش هفته از شنبه
+WEEK_ORDER = (5, 6, 0, 1, 2, 3, 4)
+# «روزهای زوج» و «روزهای فرد» در تقویم آموزشگاه‌ها
+DAY_GROUPS = {'زوج': (5, 0, 2), 'فرد': (6, 1, 3)}
+
+_DIGITS = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+_TIME_PATTERN = re.compile(r'(\d{1,2})(?:\s*[:٫.]\s*(\d{2}))?')
+SCHEDULE_INDEX_TTL = int(os.getenv('SCHEDULE_INDEX_TTL', '300'))
+# آموزشگاه پیش از این ساعت کلاس ندارد؛ ساعت‌های ۱ تا ۷ عصر هستند که ۱۲ ساعته نوشته شده‌اند
+EARLIEST_CLASS_HOUR = 8
+
+def normalize_text(value):
+    """یکسان‌سازی ارقام و حروف فارسی/عربی"""
+    return (value or '').translate(_DIGITS).replace('ي', 'ی').replace('ك', 'ک').strip()
+
+def normalize_classroom(value):
+    """کلید یکسان برای کلاس درس (خالی یعنی بدون کلاس درس مشخص)"""
+    value = re.sub(r'\s+', ' ', normalize_text(value)).lower()
+    return value or None
+
+def _afternoon_hour(hour):
+    """«۴ تا ۶» عصر به صورت ۱۲ ساعته نوشته می‌شود"""
+    return hour + 12 if 1 <= hour < EARLIEST_CLASS_HOUR else hour
+
+def parse_class_time(value):
+    """تبدیل ساعت کلاس (مثلاً «۱۶:۰۰ تا ۱۸:۳۰») به دقیقه شروع و پایان"""
+    times = _TIME_PATTERN.findall(normalize_text(value))
+    if len(times) < 2:
+        return None
+
+    (start_hour, start_min), (end_hour, end_min) = times[0], times[1]
+    start = _afternoon_hour(int(start_hour)) * 60 + int(start_min or 0)
+    end = _afternoon_hour(int(end_hour)) * 60 + int(end_min or 0)
+
+    # «۱۸ تا ۸»: فقط ساعت پایان ۱۲ ساعته نوشته شده است
+    if end <= start and end + 12 * 60 > start:
+        end += 12 * 60
+    if not (0 <= start < end <= 24 * 60):
+        return None
+    return start, end
+
+def parse_class_days(value):
+    """تبدیل روزهای کلاس (مثلاً «یکشنبه و سه‌شنبه» یا «زوج») به شماره روزهای هفته"""
+    text = normalize_text(value).replace('‌', '').replace(' ', '')
+    days = set()
+
+    for group, group_days in DAY_GROUPS.items():
+        if group in text:
+            days.update(group_days)
+            text = text.replace(group, '')
+
+    # نام‌های بلندتر اول بررسی می‌شوند تا «شنبه» درون «یکشنبه» اشتباه گرفته نشود
+    for name in sorted(WEEKDAYS, key=len, reverse=True):
+        if name in text:
+            days.add(WEEKDAYS[name])
+            text = text.replace(name, '')
+    return sorted(days)
+
+def parse_weekly_slots(class_time, class_days):
+    """بازه‌های هفتگی یک کلاس؛ در صورت نامفهوم بودن متن لیست خالی"""
+    times = parse_class_time(class_time)
+    days = parse_class_days(class_days)
+    if not times or not days:
+        return []
+    return [WeeklySlot(day, times[0], times[1]) for day in days]
+
+def _to_date(value):
+    """تبدیل رشته تاریخ فرم به date"""
+    if value is None or isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(str(value).strip(), '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+def build_class_schedule(class_id, professor_id, classroom, start_date, end_date, class_time, class_days):
+    """ساخت برنامه ساختاریافته یک کلاس از ستون‌های جدول یا فرم"""
+    return ClassSchedule(
+        int(class_id) if class_id is not None else None,
+        int(professor_id) if professor_id not in (None, '') else None,
+        normalize_classroom(classroom),
+        _to_date(start_date), _to_date(end_date),
+        parse_weekly_slots(class_time, class_days)
+    )
+
+def format_minutes(minutes):
+    """نمایش دقیقه از ابتدای روز به صورت HH:MM"""
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+def _dates_overlap(a_start, a_end, b_start, b_end):
+    """هم‌پوشانی دو بازه تاریخ (بازه نامشخص یعنی همیشه)"""
+    return (a_start is None or b_end is None or a_start <= b_end) and \
+           (b_start is None or a_end is None or b_start <= a_end)
+
+class ScheduleIndex:
+    """نمایه بازه‌های هفتگی به تفکیک استاد و کلاس درس
+
+    برای هر (منبع، روز هفته) فهرستی مرتب بر اساس دقیقه شروع نگه داشته
+    می‌شود. با دانستن بیشترین طول بازه هر فهرست، بازه‌های هم‌پوشان با دو
+    جستجوی دودویی پیدا می‌شوند.
+    """
+
+    def __init__(self):
+        self._starts = {}
+        self._entries = {}
+        self._max_length = {}
+        self.classes = {}
+
+    @staticmethod
+    def _resources(schedule):
+        resources = []
+        if schedule.professor_id is not None:
+            resources.append(('professor', schedule.professor_id))
+        if schedule.classroom:
+            resources.append(('classroom', schedule.classroom))
+        return resources
+
+    def add(self, schedule):
+        """افزودن برنامه یک کلاس به نمایه"""
+        self.classes[schedule.class_id] = schedule
+        for resource in self._resources(schedule):
+            for slot in schedule.slots:
+                key = (resource, slot.weekday)
+                starts = self._starts.setdefault(key, [])
+                entries = self._entries.setdefault(key, [])
+                entry = (slot.start_minute, slot.end_minute, schedule.class_id)
+                position = bisect_right(entries, entry)
+                entries.insert(position, entry)
+                starts.insert(position, slot.start_minute)
+                length = slot.end_minute - slot.start_minute
+                self._max_length[key] = max(self._max_length.get(key, 0), length)
+
+    def find_conflicts(self, schedule, exclude_class_id=None):
+        """یافتن کلاس‌هایی که با برنامه داده‌شده در استاد یا کلاس درس تداخل دارند"""
+        conflicts = []
+        for resource in self._resources(schedule):
+            for slot in schedule.slots:
+                key = (resource, slot.weekday)
+                starts = self._starts.get(key)
+                if not starts:
+                    continue
+                entries = self._entries[key]
+                low = bisect_right(starts, slot.start_minute - self._max_length[key])
+                high = bisect_left(starts, slot.end_minute)
+                for start, end, class_id in entries[low:high]:
+                    if class_id == exclude_class_id or end <= slot.start_minute:
+                        continue
+                    other = self.classes[class_id]
+                    if _dates_overlap(schedule.start_date, schedule.end_date, other.start_date, other.end_date):
+                        conflicts.append(Conflict(resource[0], class_id, slot.weekday, start, end))
+        return conflicts
+
+TimetableEntry = namedtuple('TimetableEntry', ['class_id', 'weekday', 'start_minute', 'end_minute',
+                                               'course_title', 'course_level', 'professor_id',
+                                               'professor_name', 'classroom', 'start_date', 'end_date'])
+TIMETABLE_GROUPS = ('professor', 'classroom', 'level')
+
+class Timetable:
+    """برنامه هفتگی از پیش محاسبه‌شده به تفکیک استاد، کلاس درس و سطح
+
+    جلسات هر گروه یک بار (هنگام ساخت کش) بر اساس روز و ساعت مرتب می‌شوند
+    تا نمایش جدول هفتگی نیازی به join و تجزیه متن در هر درخواست نداشته باشد.
+    """
+
+    def __init__(self):
+        self.groups = {group: {} for group in TIMETABLE_GROUPS}
+        self.unscheduled = []
+
+    @staticmethod
+    def _group_keys(entry):
+        return {
+            'professor': (entry.professor_id, entry.professor_name or 'نامشخص'),
+            'classroom': (normalize_classroom(entry.classroom), entry.classroom or 'بدون کلاس درس'),
+            'level': (entry.course_level, entry.course_level or 'نامشخص'),
+        }
+
+    def add(self, entry):
+        for group, (key, label) in self._group_keys(entry).items():
+            section = self.groups[group].setdefault(key, {'key': key, 'label': label, 'entries': []})
+            section['entries'].append(entry)
+
+    def finalize(self):
+        """مرتب‌سازی جلسات هر گروه بر اساس ترتیب روزهای هفته و ساعت شروع"""
+        day_position = {day: position for position, day in enumerate(WEEK_ORDER)}
+        for sections in self.groups.values():
+            for section in sections.values():
+                section['entries'].sort(key=lambda e: (day_position[e.weekday], e.start_minute, e.class_id))
+
+    def view(self, group, key=None, active_on=None):
+        """بخش‌های جدول هفتگی یک گروه؛ هر بخش شامل جلسات هر روز هفته است
+
+        active_on: در صورت تعیین، فقط کلاس‌هایی که در آن تاریخ برگزار می‌شوند.
+        """
+        sections = []
+        for section in sorted(self.groups[group].values(), key=lambda s: str(s['label'])):
+            if key is not None and str(section['key']) != str(key):
+                continue
+            days = {day: [] for day in WEEK_ORDER}
+            for entry in section['entries']:
+                if active_on is None or _dates_overlap(entry.start_date, entry.end_date, active_on, active_on):
+                    days[entry.weekday].append(entry)
+            if any(days.values()):
+                sections.append({
+                    'key': section['key'],
+                    'label': section['label'],
+                    'days': [(day, WEEKDAY_NAMES[day], days[day]) for day in WEEK_ORDER]
+                })
+        return sections
+
+    def options(self, group):
+        """فهرست (کلید، عنوان) برای انتخاب در صفحه جدول"""
+        return sorted(((section['key'], section['label']) for section in self.groups[group].values()),
+                      key=lambda option: str(option[1]))
+
+def load_class_rows(conn, branch_id=None):
+    """خواندن برنامه کلاس‌ها (همه شعبه‌ها یا یک شعبه) به همراه عنوان دوره و نام استاد"""
+    cursor = conn.cursor(cursor_factory=DictCursor)
+    cursor.execute('''
+        SELECT cl.class_id, cl.professor_id, cl.classroom, cl.start_date, cl.end_date,
+               cl.class_time, cl.class_days,
+               c.course_title, c.course_level,
+               p.first_name || ' ' || p.last_name AS professor_name
+        FROM classes cl
+        LEFT JOIN courses c ON cl.course_id = c.course_id
+        LEFT JOIN professors p ON cl.professor_id = p.professor_id
+        WHERE %s::integer IS NULL OR cl.branch_id = %s::integer
+    ''', (branch_id, branch_id))
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def build_schedule_cache(rows):
+    """ساخت نمایه تداخل و جدول هفتگی از سطرهای کلاس‌ها (یک بار تجزیه متن)"""
+    index = ScheduleIndex()
+    timetable = Timetable()
+
+    for row in rows:
+        schedule = build_class_schedule(row['class_id'], row['professor_id'], row['classroom'],
+                                        row['start_date'], row['end_date'],
+                                        row['class_time'], row['class_days'])
+        index.add(schedule)
+        if not schedule.slots:
+            timetable.unscheduled.append(row)
+        for slot in schedule.slots:
+            timetable.add(TimetableEntry(
+                schedule.class_id, slot.weekday, slot.start_minute, slot.end_minute,
+                row['course_title'], row['course_level'], schedule.professor_id,
+                row['professor_name'], row['classroom'], schedule.start_date, schedule.end_date
+            ))
+
+    timetable.finalize()
+    return index, timetable
+
+# نمایه و جدول هفتگی در حافظه هر فرایند نگه داشته می‌شوند. هر تغییر کلاس‌ها (یا نام
+# دوره و استاد) با trigger شمارنده schedule_version را در همان تراکنش افزایش
+# می‌دهد؛ هر فرایند پیش از استفاده شمارنده را می‌خواند و اگر تغییر کرده باشد کش
+# را از نو می‌سازد، پس تغییری که در فرایند یا سرور دیگری انجام شده هم دیده می‌شود.
+# کش برای هر شعبه (و None برای همه شعبه‌ها) جداگانه نگه داشته می‌شود.
+_index_lock = threading.Lock()
+_index_cache = {}
+
+def load_schedule_version(conn):
+    """شمارنده تغییرات برنامه کلاس‌ها"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT version FROM schedule_version')
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+def _get_schedule_cache(conn, branch_id=None):
+    """کش زمان‌بندی یک شعبه (در صورت نبود، تغییر شمارنده یا منقضی شدن از نو ساخته می‌شود)"""
+    # شمارنده پیش از کلاس‌ها خوانده می‌شود؛ تغییری که بین این دو commit شود در
+    # بررسی بعدی دوباره باعث ساخت کش می‌شود و کش کهنه با شمارنده جدید ذخیره نمی‌شود
+    version = load_schedule_version(conn)
+    with _index_lock:
+        cache = _index_cache.get(branch_id)
+        if (cache is None or cache['version'] != version
+                or time.monotonic() - cache['built_at'] > SCHEDULE_INDEX_TTL):
+            index, timetable = build_schedule_cache(load_class_rows(conn, branch_id))
+            cache = {'index': index, 'timetable': timetable,
+                     'built_at': time.monotonic(), 'version': version}
+            _index_cache[branch_id] = cache
+        return cache['index'], cache['timetable']
+
+def get_schedule_index(conn, branch_id=None):
+    """نمایه تداخل زمانی کلاس‌ها"""
+    return _get_schedule_cache(conn, branch_id)[0]
+
+def get_timetable(conn, branch_id=None):
+    """جدول هفتگی از پیش محاسبه‌شده کلاس‌ها"""
+    return _get_schedule_cache(conn, branch_id)[1]
+
+def invalidate_schedule_index():
+    """باطل کردن نمایه و جدول هفتگی این فرایند پس از افزودن، ویرایش یا حذف کلاس
+
+    فرایندهای دیگر تغییر را از شمارنده schedule_version تشخیص می‌دهند.
+    """
+    with _index_lock:
+        _index_cache.clear()
+
+def check_class_conflicts(conn, data, class_id=None, branch_id=None):
+    """بررسی تداخل یک کلاس جدید یا ویرایش‌شده با کلاس‌های شعبه branch_id
+
+    خروجی: (تداخل‌ها، هشدارها)؛ هشدار زمانی است که ساعت یا روزها قابل تفسیر نباشند.
+    """
+    schedule = build_class_schedule(class_id if class_id is not None else -1,
+                                    data.get('professor_id'), data.get('classroom'),
+                                    data.get('start_date'), data.get('end_date'),
+                                    data.get('class_time'), data.get('class_days'))
+    warnings = []
+    if not schedule.slots:
+        warnings.append('ساعت یا روزهای کلاس قابل تشخیص نیست؛ تداخل زمانی بررسی نشد.')
+        return [], warnings
+
+    conflicts = get_schedule_index(conn, branch_id).find_conflicts(schedule, exclude_class_id=class_id)
+    return conflicts, warnings
+
+def describe_conflict(conflict):
+    """متن قابل نمایش برای یک تداخل"""
+    resource = 'استاد' if conflict.resource == 'professor' else 'کلاس درس'
+    return (f'تداخل {resource} با کلاس {conflict.class_id} در روز {WEEKDAY_NAMES[conflict.weekday]} '
+            f'({format_minutes(conflict.start_minute)} تا {format_minutes(conflict.end_minute)})')
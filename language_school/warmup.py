@@ -0,0 +1,72 @@
+import os
+import time
+from database_queries import (
+    REPLICA_CONFIG, pooled_connection, api_search_students_db,
+    get_courses_for_dropdown, get_professors_for_dropdown, get_students_for_dropdown,
+    get_levels_for_dropdown, get_active_classes_for_dropdown
+)
+from scheduling import get_timetable
+from realtime import availability_broadcaster, dashboard_broadcaster
+
+# ==================== گرم کردن فرایند پیش از پذیرش درخواست ====================
+# هر فرایند کارگر (worker) پس از fork و پیش از گرفتن اولین درخواست این مراحل را
+# اجرا می‌کند تا اولین کاربران هزینه ساخت اتصال، کامپایل قالب‌ها و ساخت کش‌ها را
+# نپردازند. خطای هر مرحله فقط چاپ می‌شود؛ برنامه بدون کش گرم هم کار می‌کند.
+
+# حداکثر زمان انتظار برای اولین محاسبه آمار داشبورد
+DASHBOARD_WARMUP_SECONDS = 5
+
+# شعبه ثابت این نصب (همان BRANCH_ID در app.py)؛ کش زمان‌بندی برای همین شعبه ساخته می‌شود
+BRANCH_ID = int(os.getenv('BRANCH_ID')) if os.getenv('BRANCH_ID') else None
+
+REFERENCE_LOADERS = (
+    get_courses_for_dropdown,
+    get_professors_for_dropdown,
+    get_students_for_dropdown,
+    get_levels_for_dropdown,
+    get_active_classes_for_dropdown,
+)
+
+def _step(name, func):
+    started = time.monotonic()
+    try:
+        func()
+        print(f"گرم کردن {name}: {time.monotonic() - started:.2f} ثانیه")
+    except Exception as e:
+        print(f"خطا در گرم کردن {name}: {e}")
+
+def warm_pools():
+    """ایجاد pool‌ها (هر pool هنگام ایجاد DB_MIN_CONN اتصال باز می‌کند)"""
+    for readonly in ([False, True] if REPLICA_CONFIG else [False]):
+        with pooled_connection(readonly):
+            pass
+
+def warm_templates(app):
+    """کامپایل همه قالب‌ها در کش Jinja"""
+    for name in app.jinja_env.list_templates():
+        if name.endswith('.html'):
+            app.jinja_env.get_template(name)
+
+def warm_reference_data():
+    """ساخت جدول هفتگی و نمایه تداخل کلاس‌ها و خواندن یک‌باره داده‌های مرجع
+    (لیست‌های کشویی و جستجوی خودکار) تا صفحات آن‌ها در حافظه PostgreSQL باشند"""
+    with pooled_connection(readonly=True) as conn:
+        get_timetable(conn, BRANCH_ID)
+        for loader in REFERENCE_LOADERS:
+            loader(conn)
+        api_search_students_db(conn, '', 10)
+
+def warm_dashboard():
+    """راه‌اندازی شنونده‌ها و انتظار برای اولین آمار داشبورد"""
+    availability_broadcaster.start()
+    dashboard_broadcaster.start()
+    deadline = time.monotonic() + DASHBOARD_WARMUP_SECONDS
+    while dashboard_broadcaster.current() is None and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+def warm_up(app):
+    """اجرای همه مراحل گرم کردن"""
+    _step('اتصال‌های pool', warm_pools)
+    _step('قالب‌ها', lambda: warm_templates(app))
+    _step('داده‌های مرجع', warm_reference_data)
+    _step('آمار داشبورد', warm_dashboard)